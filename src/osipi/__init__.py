@@ -1,4 +1,6 @@
 
+from ._time_grid import TimeGrid
+
 from ._aif import (
     aif_parker,
     aif_georgiou,
@@ -7,9 +9,27 @@ from ._aif import (
 
 from ._tissue import (
     tofts,
-    extended_tofts
+    extended_tofts,
+    ToftsModel,
+    ExtendedToftsModel
+)
+
+from ._analytic import (
+    tofts_analytic,
+    extended_tofts_analytic
 )
 
+from ._fitting import (
+    fit_tofts,
+    fit_extended_tofts
+)
+
+from ._delay import estimate_Ta
+
+from ._dictionary import ToftsDictionary
+
+from ._streaming import ToftsStream
+
 from ._signal import (
     signal_linear,
     signal_SPGR
@@ -20,3 +40,13 @@ from ._signal_to_concentration import (
     S_to_R1_SPGR,
     R1_to_C_linear_relaxivity
 )
+
+from ._pipeline import fit_volume
+
+from ._vfa import S_to_R10_VFA
+
+from ._baseline import estimate_S_baseline
+
+from ._signal_model import SPGRSignalModel
+
+from ._lookup_table import R1LookupTable
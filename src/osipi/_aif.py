@@ -1,21 +1,55 @@
+from functools import lru_cache
+from typing import Tuple, Union
+
 import numpy as np
 from numpy.typing import NDArray
+from scipy.special import gammaln
+
+from ._time_grid import TimeGrid
+
+# Parameters of the Parker AIF in units of mM and min: the scale, mean and standard
+# deviation of the two Gaussians, i.e. A/(SD*sqrt(2*PI)), m and SD with
+# A1 = 0.833, SD1 = 0.055, m1 = 0.171 and A2 = 0.336, SD2 = 0.134, m2 = 0.364
+_PARKER_GAUSSIANS = ((5.73258, 0.17046, 0.0563), (0.997356, 0.365, 0.132))
+# and alpha, beta, s and tau of the sigmoid term, with
+# alpha = 1.064, beta = 0.166, s = 37.772, tau = 0.482
+_PARKER_SIGMOID = (1.050, 0.1685, 38.078, 0.483)
+
+# Parameters of the Georgiou AIF in units of mM and min: the amplitudes and rates of
+# the three exponentials, and alpha, beta and tau of the gamma variates
+_GEORGIOU_EXPONENTIALS = ((0.37, 0.11), (0.33, 1.17), (10.06, 16.02))
+_GEORGIOU_GAMMA = (5.26, 0.032, 0.129)
+# Number of standard deviations over which each gamma variate is evaluated
+_GEORGIOU_GAMMA_WIDTH = 20
+# Time step and length in min of the chunks of the Georgiou AIF table
+_GEORGIOU_TABLE_STEP = 1e-4
+_GEORGIOU_TABLE_CHUNK = 10.0
+
+# Dose of the Weinmann AIF in mmol/kg, and the amplitudes in kg/l and rates in 1/min
+# of its two exponentials
+_WEINMANN_DOSE = 0.1
+_WEINMANN_EXPONENTIALS = ((3.99, 0.144), (4.78, 0.0111))
 
 
 def aif_parker(
-    t: NDArray[np.floating], BAT: np.floating = 0.0, Hct: np.floating = 0.0
+    t: Union[NDArray[np.floating], TimeGrid],
+    BAT: Union[np.floating, NDArray[np.floating]] = 0.0,
+    Hct: np.floating = 0.0,
 ) -> NDArray[np.floating]:
     """AIF model as defined by Parker et al (2005)
 
     Args:
-        t (NDArray[np.floating]): array of time points in units of sec. [OSIPI code Q.GE1.004]
-        BAT (np.floating, optional):
-            Time in seconds before the bolus arrives. Defaults to 0. [OSIPI code Q.BA1.001]
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        BAT (np.floating or NDArray[np.floating], optional):
+            Time in seconds before the bolus arrives. Defaults to 0. If BAT is an array,
+            e.g. one time for each voxel, an AIF is returned for each. [OSIPI code Q.BA1.001]
         Hct (np.floating, optional):
             Hematocrit. Defaults to 0.0. [OSIPI code Q.PH1.012]
 
     Returns:
-        NDArray[np.floating]: Concentrations in mM for each time point in t.
+        NDArray[np.floating]: Concentrations in mM for each time point in t, of shape
+            (..., len(t)) where ... is the shape of BAT.
 
     See Also:
         `aif_georgiou`
@@ -46,46 +80,49 @@ def aif_parker(
 
     """
     # Convert from OSIPI units (sec) to units used internally (mins)
-    t_min = t / 60
-    bat_min = BAT / 60
+    t_min = np.asarray(t) / 60
+    bat_min = np.asarray(BAT, dtype=float) / 60
+    if bat_min.ndim > 0:
+        # One AIF for each bolus arrival time
+        bat_min = bat_min[..., np.newaxis]
 
     t_offset = t_min - bat_min
 
-    # A1/(SD1*sqrt(2*PI)) * exp(-(t_offset-m1)^2/(2*var1))
-    # A1 = 0.833, SD1 = 0.055, m1 = 0.171
-    gaussian1 = 5.73258 * np.exp(
-        -1.0 * (t_offset - 0.17046) * (t_offset - 0.17046) / (2.0 * 0.0563 * 0.0563)
-    )
-
-    # A2/(SD2*sqrt(2*PI)) * exp(-(t_offset-m2)^2/(2*var2))
-    # A2 = 0.336, SD2 = 0.134, m2 = 0.364
-    gaussian2 = 0.997356 * np.exp(
-        -1.0 * (t_offset - 0.365) * (t_offset - 0.365) / (2.0 * 0.132 * 0.132)
+    # A/(SD*sqrt(2*PI)) * exp(-(t_offset-m)^2/(2*var)) for two Gaussians
+    gaussian1, gaussian2 = (
+        A * np.exp(-1.0 * (t_offset - m) * (t_offset - m) / (2.0 * sd * sd))
+        for A, m, sd in _PARKER_GAUSSIANS
     )
     # alpha*exp(-beta*t_offset) / (1+exp(-s(t_offset-tau)))
-    # alpha = 1.064, beta = 0.166, s = 37.772, tau = 0.482
-    sigmoid = 1.050 * np.exp(-0.1685 * t_offset) / (1.0 + np.exp(-38.078 * (t_offset - 0.483)))
+    alpha, beta, s, tau = _PARKER_SIGMOID
+    sigmoid = alpha * np.exp(-beta * t_offset) / (1.0 + np.exp(-s * (t_offset - tau)))
 
     pop_aif = (gaussian1 + gaussian2 + sigmoid) / (1.0 - Hct)
 
     return pop_aif
 
 
-def aif_georgiou(t: NDArray[np.floating], BAT: np.floating = 0.0) -> NDArray[np.floating]:
+def aif_georgiou(
+    t: Union[NDArray[np.floating], TimeGrid],
+    BAT: Union[np.floating, NDArray[np.floating]] = 0.0,
+) -> NDArray[np.floating]:
     """AIF model as defined by Georgiou et al.
 
-    Note:
-        This function is not yet implemented.
-        If you are implementing it yourself please consider submitting a code contribution to OSIPI,
-        so nobody ever has to write this function again!
+    The AIF is a sum of three exponentials multiplying a train of gamma variates, which
+    model the first pass and the recirculations of the bolus. The number of gamma
+    variates grows with time, so the AIF is tabulated once at high resolution and
+    linearly interpolated, with an error of the order of 1e-5 mM.
 
     Args:
-        t (NDArray[np.floating]): array of time points in units of sec. [OSIPI code Q.GE1.004]
-        BAT (np.floating, optional):
-            Time in seconds before the bolus arrives. Defaults to 0sec. [OSIPI code Q.BA1.001]
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        BAT (np.floating or NDArray[np.floating], optional):
+            Time in seconds before the bolus arrives. Defaults to 0sec. If BAT is an array,
+            e.g. one time for each voxel, an AIF is returned for each. [OSIPI code Q.BA1.001]
 
     Returns:
-        NDArray[np.floating]: Concentrations in mM for each time point in t.
+        NDArray[np.floating]: Concentrations in mM for each time point in t, of shape
+            (..., len(t)) where ... is the shape of BAT.
 
     See Also:
         `aif_parker`
@@ -116,30 +153,79 @@ def aif_georgiou(t: NDArray[np.floating], BAT: np.floating = 0.0) -> NDArray[np.
         >>> plt.show()
 
     """
+    # Convert from OSIPI units (sec) to units used internally (mins)
+    t_min = np.asarray(t) / 60
+    bat_min = np.asarray(BAT, dtype=float) / 60
+    if bat_min.ndim > 0:
+        # One AIF for each bolus arrival time
+        bat_min = bat_min[..., np.newaxis]
 
-    msg = "This function is not yet implemented \n"
-    msg += (
-        "If you implement it yourself, please consider submitting it"
-        " as an OSIPI code contribution"
-    )
-    raise NotImplementedError(msg)
+    t_offset = t_min - bat_min
+
+    # Extend the table in chunks to cover the latest time
+    n_chunks = max(int(np.ceil(np.max(t_offset, initial=0) / _GEORGIOU_TABLE_CHUNK)), 1)
+    t_table, ca_table = _georgiou_table(n_chunks)
+    return np.interp(t_offset, t_table, ca_table, left=0)
 
 
-def aif_weinmann(t: NDArray[np.floating], BAT: np.floating = 0.0) -> NDArray[np.floating]:
+@lru_cache(maxsize=4)
+def _georgiou_table(n_chunks: int) -> Tuple[NDArray[np.floating], NDArray[np.floating]]:
+    """Georgiou AIF tabulated for n_chunks table chunks.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.floating]]: read-only arrays of time points
+            in min and concentrations in mM.
+    """
+    n = n_chunks * round(_GEORGIOU_TABLE_CHUNK / _GEORGIOU_TABLE_STEP)
+    t = np.linspace(0, n * _GEORGIOU_TABLE_STEP, n + 1)
+
+    # Sum of gamma variates with shape (j+1)*alpha+j and scale beta, delayed by j*tau,
+    # evaluated in log space as the shape grows large. Each is only evaluated within
+    # _GEORGIOU_GAMMA_WIDTH standard deviations of its mean, beyond which it vanishes.
+    alpha, beta, tau = _GEORGIOU_GAMMA
+    gamma_variates = np.zeros(t.shape)
+    for j in range(int(t[-1] / tau) + 1):
+        a = (j + 1) * alpha + j
+        mean, sd = j * tau + a * beta, np.sqrt(a) * beta
+        start = max(j * tau, mean - _GEORGIOU_GAMMA_WIDTH * sd)
+        window = slice(
+            int(np.floor(start / _GEORGIOU_TABLE_STEP)) + 1,
+            int(np.ceil((mean + _GEORGIOU_GAMMA_WIDTH * sd) / _GEORGIOU_TABLE_STEP)) + 1,
+        )
+        s = t[window] - j * tau
+        gamma_variates[window] += np.exp(
+            (a - 1) * np.log(s) - s / beta - a * np.log(beta) - gammaln(a)
+        )
+
+    # A1*exp(-m1*t) + A2*exp(-m2*t) + A3*exp(-m3*t)
+    exponentials = sum(A * np.exp(-m * t) for A, m in _GEORGIOU_EXPONENTIALS)
+
+    ca = exponentials * gamma_variates
+    t.flags.writeable = False
+    ca.flags.writeable = False
+    return t, ca
+
+
+def aif_weinmann(
+    t: Union[NDArray[np.floating], TimeGrid],
+    BAT: Union[np.floating, NDArray[np.floating]] = 0.0,
+) -> NDArray[np.floating]:
     """AIF model as defined by Weinmann et al.
 
-    Note:
-        This function is not yet implemented.
-        If you are implementing it yourself please consider submitting a code contribution to OSIPI,
-        so nobody ever has to write this function again!
+    The AIF is a biexponential decay starting at the bolus arrival time,
+    D (a1 exp(-m1 t) + a2 exp(-m2 t)), with a dose D = 0.1 mmol/kg,
+    a1 = 3.99 kg/l, a2 = 4.78 kg/l, m1 = 0.144 /min and m2 = 0.0111 /min.
 
     Args:
-        t (NDArray[np.floating]): array of time points in units of sec. [OSIPI code Q.GE1.004]
-        BAT (np.floating, optional):
-            Time in seconds before the bolus arrives. Defaults to 0sec. [OSIPI code Q.BA1.001]
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        BAT (np.floating or NDArray[np.floating], optional):
+            Time in seconds before the bolus arrives. Defaults to 0sec. If BAT is an array,
+            e.g. one time for each voxel, an AIF is returned for each. [OSIPI code Q.BA1.001]
 
     Returns:
-        NDArray[np.floating]: Concentrations in mM for each time point in t.
+        NDArray[np.floating]: Concentrations in mM for each time point in t, of shape
+            (..., len(t)) where ... is the shape of BAT.
 
     See Also:
         `aif_parker`
@@ -169,10 +255,17 @@ def aif_weinmann(t: NDArray[np.floating], BAT: np.floating = 0.0) -> NDArray[np.
         >>> plt.plot(t, ca)
 
     """
+    # Convert from OSIPI units (sec) to units used internally (mins)
+    t_min = np.asarray(t) / 60
+    bat_min = np.asarray(BAT, dtype=float) / 60
+    if bat_min.ndim > 0:
+        # One AIF for each bolus arrival time
+        bat_min = bat_min[..., np.newaxis]
+
+    t_offset = t_min - bat_min
 
-    msg = "This function is not yet implemented \n"
-    msg += (
-        "If you implement it yourself, please consider submitting it"
-        " as an OSIPI code contribution"
+    # D*(a1*exp(-m1*t_offset) + a2*exp(-m2*t_offset)) after the bolus arrival
+    pop_aif = sum(
+        _WEINMANN_DOSE * a * np.exp(-m * np.maximum(t_offset, 0)) for a, m in _WEINMANN_EXPONENTIALS
     )
-    raise NotImplementedError(msg)
+    return (t_offset >= 0) * pop_aif
@@ -0,0 +1,342 @@
+from typing import Union
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy.special import erfcx, expit
+
+from ._aif import (
+    _PARKER_GAUSSIANS,
+    _PARKER_SIGMOID,
+    _WEINMANN_DOSE,
+    _WEINMANN_EXPONENTIALS,
+    aif_parker,
+    aif_weinmann,
+)
+from ._time_grid import TimeGrid, as_time_grid
+
+# Number of array elements (voxels x quadrature nodes) evaluated at once
+_BLOCK_ELEMENTS = 2**22
+
+# Gauss-Legendre rule used for AIF terms without a closed-form convolution
+_GAUSS_NODES, _GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(8)
+
+# Relative size of terms that are left out of the closed forms
+_NEGLIGIBLE = 1e-16
+
+# Largest argument of exp that does not overflow, with a margin
+_MAX_EXPONENT = 700.0
+
+
+def tofts_analytic(
+    t: Union[NDArray[np.floating], TimeGrid],
+    Ktrans: Union[np.floating, NDArray[np.floating]],
+    ve: Union[np.floating, NDArray[np.floating]],
+    Ta: np.floating = 30.0,
+    aif: str = "parker",
+    BAT: np.floating = 0.0,
+    Hct: np.floating = 0.0,
+) -> NDArray[np.floating]:
+    """Tofts model for a population AIF, evaluated without numerical convolution.
+
+    The convolution of the AIF with the exponential impulse response of the Tofts model
+    is evaluated from its closed form at each time point, which avoids the discretization
+    errors of the methods of `tofts`, which sum the AIF samples or interpolate the AIF
+    between time points. The cost per voxel is proportional to the number of time points.
+
+    For the Parker AIF, the Gaussian terms are convolved exactly in terms of error
+    functions. The sigmoid term has no elementary closed form and is integrated with a
+    Gauss-Legendre rule between time points, with a step small enough for the result to
+    be accurate to near machine precision.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        Ktrans (np.floating or NDArray[np.floating]):
+            Volume transfer constant in units of 1/min. [OSIPI code Q.PH1.008]
+        ve (np.floating or NDArray[np.floating]):
+            Relative volume fraction of the extracellular
+            extravascular compartment (e). [OSIPI code Q.PH1.001.[e]]
+        Ta (np.floating, optional):
+            Arterial delay time,
+            i.e., difference in onset time between tissue curve and AIF in units of sec.
+            Defaults to 30 seconds. [OSIPI code Q.PH1.007]
+        aif (str, optional): Population AIF model. Options include
+
+            – 'parker': Parker AIF, see `aif_parker` (default)
+
+            – 'weinmann': Weinmann AIF, see `aif_weinmann`. As the AIF is a sum of
+            exponentials, the tissue curve is a sum of exponentials too.
+        BAT (np.floating, optional):
+            Time in seconds before the bolus arrives. Defaults to 0. [OSIPI code Q.BA1.001]
+        Hct (np.floating, optional):
+            Hematocrit of the Parker AIF. Defaults to 0.0. [OSIPI code Q.PH1.012]
+
+    Returns:
+        NDArray[np.floating]: Tissue concentrations in mM of shape (..., len(t)), where
+            ... is the broadcast shape of Ktrans and ve.
+
+    See Also:
+        `tofts`
+        `extended_tofts_analytic`
+
+    Example:
+
+        Compare the analytic solution with the numerical convolution.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> ct = osipi.tofts_analytic(t, Ktrans=0.6, ve=0.2)
+        >>> ct_conv = osipi.tofts(t, osipi.aif_parker(t), Ktrans=0.6, ve=0.2)
+
+    """
+    return extended_tofts_analytic(t, Ktrans, ve, 0.0, Ta, aif, BAT, Hct)
+
+
+def extended_tofts_analytic(
+    t: Union[NDArray[np.floating], TimeGrid],
+    Ktrans: Union[np.floating, NDArray[np.floating]],
+    ve: Union[np.floating, NDArray[np.floating]],
+    vp: Union[np.floating, NDArray[np.floating]],
+    Ta: np.floating = 30.0,
+    aif: str = "parker",
+    BAT: np.floating = 0.0,
+    Hct: np.floating = 0.0,
+) -> NDArray[np.floating]:
+    """Extended Tofts model for a population AIF, evaluated without numerical convolution.
+
+    See `tofts_analytic` for the evaluation of the convolution.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        Ktrans (np.floating or NDArray[np.floating]):
+            Volume transfer constant in units of 1/min. [OSIPI code Q.PH1.008]
+        ve (np.floating or NDArray[np.floating]):
+            Relative volume fraction of the extracellular
+            extravascular compartment (e). [OSIPI code Q.PH1.001.[e]]
+        vp (np.floating or NDArray[np.floating]):
+            Relative volume fraction of the plasma
+            compartment (p). [OSIPI code Q.PH1.001.[p]]
+        Ta (np.floating, optional):
+            Arterial delay time,
+            i.e., difference in onset time between tissue curve and AIF in units of sec.
+            Defaults to 30 seconds. [OSIPI code Q.PH1.007]
+        aif (str, optional): Population AIF model, 'parker' (default) or 'weinmann'.
+            See `tofts_analytic`.
+        BAT (np.floating, optional):
+            Time in seconds before the bolus arrives. Defaults to 0. [OSIPI code Q.BA1.001]
+        Hct (np.floating, optional):
+            Hematocrit of the Parker AIF. Defaults to 0.0. [OSIPI code Q.PH1.012]
+
+    Returns:
+        NDArray[np.floating]: Tissue concentrations in mM of shape (..., len(t)), where
+            ... is the broadcast shape of Ktrans, ve and vp.
+
+    See Also:
+        `extended_tofts`
+        `tofts_analytic`
+
+    Example:
+
+        Calculate tissue curves for a batch of voxels.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> Ktrans = np.array([0.1, 0.3, 0.6])
+        >>> ct = osipi.extended_tofts_analytic(t, Ktrans, ve=0.2, vp=0.05)
+        >>> ct.shape
+        (3, 360)
+
+    """
+    if aif not in _AIF_MODELS:
+        raise ValueError(f"No analytic solution for the AIF model '{aif}'")
+    if Hct != 0 and aif != "parker":
+        raise ValueError(f"The hematocrit does not apply to the AIF model '{aif}'")
+    aif_function, exp_conv_function = _AIF_MODELS[aif]
+
+    t = as_time_grid(t).t
+    Ktrans, ve, vp = np.broadcast_arrays(
+        np.asarray(Ktrans, dtype=float), np.asarray(ve, dtype=float), np.asarray(vp, dtype=float)
+    )
+    shape = Ktrans.shape
+    Ktrans, ve, vp = Ktrans.ravel(), ve.ravel(), vp.ravel()
+
+    # Voxels without exchange only see the (undelayed) plasma term, as in `extended_tofts`
+    ca = aif_function(t, BAT) / (1.0 - Hct)
+    ct = vp[:, np.newaxis] * ca
+    valid = (Ktrans > 0) & (ve > 0)
+    if np.any(valid):
+        if Ta == 0:
+            ca_delayed = ca
+        else:
+            ca_delayed = (t > Ta) * aif_function(t - Ta, BAT) / (1.0 - Hct)
+
+        # Convolution of the delayed AIF with exp(-kep t), in units of min
+        tau = np.maximum(t - Ta, 0) / 60
+        kep = Ktrans[valid] / ve[valid]
+        G = exp_conv_function(tau, kep, BAT / 60) / (1.0 - Hct)
+        ct[valid] = vp[valid, np.newaxis] * ca_delayed + Ktrans[valid, np.newaxis] * G
+
+    return ct.reshape(shape + t.shape)
+
+
+def _parker_exp_conv(
+    tau: NDArray[np.floating], kep: NDArray[np.floating], bat: np.floating
+) -> NDArray[np.floating]:
+    """Convolution of the Parker AIF (with Hct = 0) with exp(-kep t).
+
+    Args:
+        tau (NDArray[np.floating]): increasing time points in min, starting from 0.
+        kep (NDArray[np.floating]): rate constants in 1/min.
+        bat (np.floating): bolus arrival time in min.
+
+    Returns:
+        NDArray[np.floating]: Convolutions in mM min of shape (len(kep), len(tau)).
+    """
+    decay = np.exp(-kep[:, np.newaxis] * tau)
+    G = sum(A * _gaussian_exp_conv(tau, m + bat, sd, kep, decay) for A, m, sd in _PARKER_GAUSSIANS)
+
+    def sigmoid(u):
+        alpha, beta, s, tau0 = _PARKER_SIGMOID
+        return alpha * np.exp(-beta * (u - bat)) * expit(s * (u - bat - tau0))
+
+    # The sigmoid is analytic within pi/s of the real axis, so a step of half that
+    # keeps the quadrature accurate
+    step = np.pi / (2 * _PARKER_SIGMOID[2])
+    return G + _quadrature_exp_conv(tau, kep, sigmoid, step)
+
+
+def _weinmann_exp_conv(
+    tau: NDArray[np.floating], kep: NDArray[np.floating], bat: np.floating
+) -> NDArray[np.floating]:
+    """Convolution of the Weinmann AIF with exp(-kep t).
+
+    Args:
+        tau (NDArray[np.floating]): increasing time points in min, starting from 0.
+        kep (NDArray[np.floating]): rate constants in 1/min.
+        bat (np.floating): bolus arrival time in min.
+
+    Returns:
+        NDArray[np.floating]: Convolutions in mM min of shape (len(kep), len(tau)).
+    """
+    # The AIF starts at max(bat, 0), with the value of the exponentials at that time
+    start = max(bat, 0.0)
+    s = np.maximum(tau - start, 0)
+    kep = kep[:, np.newaxis]
+    return sum(
+        _WEINMANN_DOSE * a * np.exp(-m * (start - bat)) * _exponential_exp_conv(s, m, kep)
+        for a, m in _WEINMANN_EXPONENTIALS
+    )
+
+
+def _exponential_exp_conv(
+    tau: NDArray[np.floating], m: np.floating, kep: NDArray[np.floating]
+) -> NDArray[np.floating]:
+    """Convolution of exp(-m t) with exp(-kep t), starting at t = 0.
+
+    The closed form (exp(-m tau) - exp(-kep tau)) / (kep - m) is evaluated with expm1,
+    which is accurate when kep is close to m and tends to tau exp(-m tau) when kep = m.
+    """
+    x = (kep - m) * tau
+    nonzero = x != 0
+    ratio = -np.expm1(-x) / np.where(nonzero, x, 1.0)
+    return np.exp(-m * tau) * tau * np.where(nonzero, ratio, 1.0)
+
+
+def _gaussian_exp_conv(
+    tau: NDArray[np.floating],
+    mu: np.floating,
+    sd: np.floating,
+    kep: NDArray[np.floating],
+    decay: NDArray[np.floating],
+) -> NDArray[np.floating]:
+    """Convolution of exp(-(t-mu)^2/(2 sd^2)) with exp(-kep t), starting at t = 0.
+
+    The closed form sd sqrt(pi/2) exp(L) (erf(z1) - erf(z0)) overflows and cancels for
+    large kep, and is evaluated in terms of the scaled complementary error function.
+    decay is exp(-kep tau), which is shared between terms.
+    """
+    kep = kep[:, np.newaxis]
+    r = sd * np.sqrt(2)
+    peak = mu + kep * sd**2
+    z1 = (tau - peak) / r
+    z0 = -peak / r
+
+    # exp(L - z^2) erfcx(|z|) at both ends of the integral, which do not overflow. The
+    # upper end vanishes once the Gaussian has passed, where erfcx(|z1|) <= 1
+    gaussian = np.exp(-((tau - mu) ** 2) / (2 * sd**2))
+    e0 = decay * (np.exp(-(mu**2) / (2 * sd**2)) * erfcx(np.abs(z0)))
+    f = -e0
+    columns = (gaussian > _NEGLIGIBLE) | np.any(z1 < 0, axis=0)
+    e1 = gaussian[columns] * erfcx(np.abs(z1[:, columns]))
+
+    # Where the error functions change sign, exp(L) < 1 and can be used directly
+    mixed = (z0 < 0) & (tau > peak)
+    exponent = kep * mu + (kep * sd) ** 2 / 2
+    overflow = exponent[:, 0] > _MAX_EXPONENT
+    expL = decay * np.exp(np.minimum(exponent, _MAX_EXPONENT))
+    expL[overflow] = np.exp(np.minimum(-kep[overflow] * tau + exponent[overflow], 0))
+    f += np.where(mixed, 2 * expL, 0)
+    f[:, columns] += np.where(mixed[:, columns], -e1, e1)
+
+    # Both error functions positive
+    positive = z0[:, 0] >= 0
+    f[positive] = -f[positive]
+    return sd * np.sqrt(np.pi / 2) * f
+
+
+def _quadrature_exp_conv(
+    tau: NDArray[np.floating],
+    kep: NDArray[np.floating],
+    func,
+    step: np.floating,
+) -> NDArray[np.floating]:
+    """Convolution of a smooth function with exp(-kep t), starting at t = 0.
+
+    The integral over each interval between time points is evaluated with a
+    Gauss-Legendre rule on sub-intervals no longer than step, nor longer than the
+    time constant of the exponential. The intervals are then accumulated with the
+    exponential recursion.
+    """
+    delta = np.diff(tau, prepend=0.0)
+    G = np.zeros(kep.shape + tau.shape)
+    if np.all(delta == 0):
+        return G
+
+    # Quadrature nodes of an interval only depend on its length, which takes few
+    # distinct values on most time grids, so that the exponentials at the nodes can be
+    # shared between intervals. Voxels are grouped by the number of sub-intervals.
+    lengths, interval = np.unique(delta, return_inverse=True)
+    n_subs = np.ceil(np.max(delta) / np.minimum(step, 2 / np.maximum(kep, 1e-12)))
+    for n_sub in np.unique(n_subs).astype(int):
+        # Distance of the nodes to the end of each interval, and their weights
+        sub = lengths[:, np.newaxis, np.newaxis] / n_sub
+        lag = sub * (np.arange(n_sub)[:, np.newaxis] + (1 - _GAUSS_NODES) / 2)
+        lag = lag.reshape(len(lengths), -1)
+        weights = np.broadcast_to(
+            sub * _GAUSS_WEIGHTS / 2, (len(lengths), n_sub, len(_GAUSS_NODES))
+        )
+        wf = weights.reshape(len(lengths), -1)[interval] * func(tau[:, np.newaxis] - lag[interval])
+
+        voxels = np.flatnonzero(n_subs == n_sub)
+        block = max(1, _BLOCK_ELEMENTS // max(lag.size, len(tau)))
+        for i in range(0, len(voxels), block):
+            k = kep[voxels[i : i + block], np.newaxis]
+            Q = np.empty((len(k), len(tau)))
+            for j, exp_lag in enumerate(np.exp(-k[..., np.newaxis] * lag).swapaxes(0, 1)):
+                Q[:, interval == j] = exp_lag @ wf[interval == j].T
+            E = np.exp(-k * lengths)[:, interval]
+            g = np.zeros(len(k))
+            Gi = np.empty(Q.shape)
+            for j in range(len(tau)):
+                g = E[:, j] * g + Q[:, j]
+                Gi[:, j] = g
+            G[voxels[i : i + block]] = Gi
+    return G
+
+
+# Population AIFs with their convolution with exp(-kep t)
+_AIF_MODELS = {
+    "parker": (aif_parker, _parker_exp_conv),
+    "weinmann": (aif_weinmann, _weinmann_exp_conv),
+}
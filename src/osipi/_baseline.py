@@ -0,0 +1,121 @@
+import numpy as np
+from numpy.typing import NDArray
+
+from ._mask import _check_mask
+
+# Number of array elements (voxels x time points) processed at once
+_BLOCK_ELEMENTS = 2**20
+
+
+def estimate_S_baseline(
+    S: NDArray[np.floating],
+    n_baseline: int = None,
+    method: str = "mean",
+    threshold: np.floating = 4.0,
+    min_frames: int = 3,
+    mask: NDArray[np.bool_] = None,
+) -> NDArray[np.floating]:
+    """Voxel-wise pre-contrast signal from the frames before the arrival of the bolus.
+
+    The baseline is the mean or median of the first n_baseline frames of each voxel. If
+    n_baseline is not given, the frames before the bolus are detected in each voxel as
+    those before the first frame that differs from the mean of all frames before it by
+    more than threshold times the standard deviation of the noise, which is estimated
+    from the second differences of consecutive frames. The signals are read in blocks
+    of voxels, each in a single pass over its time series.
+
+    Args:
+        S (NDArray[np.floating]): Magnitude signals in a.u. of shape (..., n_time), e.g.
+            a 4D DCE series or a np.memmap of one. [OSIPI code Q.MS1.001]
+        n_baseline (int, optional): Number of pre-contrast frames, the same for all
+            voxels. Defaults to detecting the arrival of the bolus in each voxel.
+        method (str, optional): 'mean' (default) or 'median' of the pre-contrast frames.
+        threshold (np.floating, optional): Deviation from the mean of the preceding
+            frames, in units of the standard deviation of the noise, that marks the
+            arrival of the bolus. Defaults to 4.
+        min_frames (int, optional): Smallest number of pre-contrast frames when the
+            arrival of the bolus is detected. Defaults to 3.
+        mask (NDArray[np.bool_], optional): Voxels to estimate the baseline of, of shape
+            (...). The other voxels get a baseline of zero. Defaults to all voxels.
+
+    Returns:
+        NDArray[np.floating]: Pre-contrast signal in a.u. of shape (...), which can be
+            passed as S_baseline to `S_to_C_via_R1_SPGR`. [OSIPI code Q.MS1.001]
+
+    Example:
+
+        Convert a noisy series with a bolus arriving after 10 to 15 frames, using the
+        baseline of each voxel:
+
+        >>> import osipi
+        >>> t = np.arange(0, 5 * 60, 2.0)
+        >>> ca = osipi.aif_parker(t)
+        >>> Ta = np.random.uniform(20, 30, (32, 32))
+        >>> ct = osipi.tofts(t, ca, Ktrans=0.3, ve=0.2, Ta=Ta)
+        >>> S = osipi.signal_SPGR(1.0 + 4.5 * ct, 1000.0, 0.002, 13.0)
+        >>> S += np.random.normal(0, 1, S.shape)
+        >>> S_baseline = osipi.estimate_S_baseline(S)
+        >>> C = osipi.S_to_C_via_R1_SPGR(S, S_baseline, 1.0, 0.002, 13.0, 4.5)
+
+    """
+    if method not in ("mean", "median"):
+        raise ValueError(f"Unknown baseline method '{method}'")
+    S = np.asarray(S)
+    if S.ndim < 1:
+        raise ValueError("S must have a time dimension")
+    n_time = S.shape[-1]
+    if n_baseline is not None and not 1 <= n_baseline <= n_time:
+        raise ValueError("n_baseline must be between 1 and the number of time points")
+    shape = S.shape[:-1]
+    S_rows = S.reshape(-1, n_time)
+    if mask is not None:
+        index = np.flatnonzero(_check_mask(mask, shape))
+
+    baseline = np.zeros(len(S_rows))
+    n_voxels = len(S_rows) if mask is None else len(index)
+    block = max(1, _BLOCK_ELEMENTS // n_time)
+    for start in range(0, n_voxels, block):
+        rows = slice(start, start + block)
+        voxels = rows if mask is None else index[rows]
+        S_block = np.asarray(S_rows[voxels], dtype=float)
+        if n_baseline is None:
+            n_pre = _bolus_arrival(S_block, threshold, min_frames)
+        else:
+            n_pre = np.full(len(S_block), n_baseline)
+        baseline[voxels] = _pre_contrast(S_block, n_pre, method)
+    return baseline.reshape(shape)
+
+
+def _bolus_arrival(
+    S: NDArray[np.floating], threshold: np.floating, min_frames: int
+) -> NDArray[np.int_]:
+    """Index of the first frame that deviates from the frames before it, per curve.
+
+    The noise of each curve is estimated from the median absolute second difference of
+    consecutive frames, which is hardly affected by the smooth enhancement of most of
+    the curve, and the running mean of the preceding frames follows from a cumulative
+    sum along time. Curves without such a frame arrive at their end.
+    """
+    n_time = S.shape[-1]
+    n = np.arange(1, n_time)
+    # Standard deviation of the noise: the second difference of three frames has
+    # sqrt(6) times the standard deviation, and 0.6745 times that is its median
+    # absolute value
+    sigma = np.median(np.abs(np.diff(S, n=2, axis=-1)), axis=-1) / (0.6745 * np.sqrt(6))
+    # Mean of frames 0..i-1 for frame i = 1..n_time-1, and the standard deviation of the
+    # deviation of frame i from it
+    mean = np.cumsum(S, axis=-1)[:, :-1] / n
+    std = sigma[:, np.newaxis] * np.sqrt(1 + 1 / n)
+    arrived = np.abs(S[:, 1:] - mean) > threshold * std
+    arrived &= n >= min_frames
+    return np.where(np.any(arrived, axis=-1), np.argmax(arrived, axis=-1) + 1, n_time)
+
+
+def _pre_contrast(
+    S: NDArray[np.floating], n_pre: NDArray[np.int_], method: str
+) -> NDArray[np.floating]:
+    """Mean or median of the first n_pre frames of each curve."""
+    pre = np.arange(S.shape[-1]) < n_pre[:, np.newaxis]
+    if method == "mean":
+        return np.sum(S, axis=-1, where=pre) / n_pre
+    return np.nanmedian(np.where(pre, S, np.nan), axis=-1)
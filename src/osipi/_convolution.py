@@ -1,37 +1,449 @@
+from typing import Union
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from numpy.typing import NDArray
+from scipy import fft
+from scipy.signal import lfilter
+
+from ._time_grid import TimeGrid, as_time_grid
+
+# Signal length below which direct convolution outperforms FFT convolution
+_DIRECT_MAX_LENGTH = 64
+
+# Number of array elements (signals x time points x time points) below which direct
+# convolution outperforms FFT convolution, e.g. for a single voxel
+_DIRECT_MAX_ELEMENTS = 2**18
+
+# Signal length below which direct convolution outperforms FFT convolution for batches
+# of at least _DIRECT_MIN_BATCH_RATIO times as many signals as time points
+_DIRECT_MAX_BATCH_LENGTH = 256
+_DIRECT_MIN_BATCH_RATIO = 16
+
+# Number of array elements (signals x time points x time points) of the Toeplitz
+# matrices built at once by direct convolution with more than one a
+_DIRECT_BLOCK_ELEMENTS = 2**22
+
+# Number of signals from which direct convolution builds Toeplitz matrices rather
+# than convolving the signals one by one
+_DIRECT_MIN_MATRIX_BATCH = 8
+
+# Number of array elements (exponentials x time points) evaluated at once by
+# `linear_exp_conv` between its time points
+_EVAL_BLOCK_ELEMENTS = 2**16
+
+
+def conv_method(n: int, method: str = "auto", batch: int = 1) -> str:
+    """Convolution method used by `conv` for signals of n points.
+
+    Args:
+        n (int): number of points of the signals
+        method (str, optional): requested method, see `conv`. Defaults to 'auto'.
+        batch (int, optional): number of signals convolved at once. Defaults to 1.
+
+    Returns:
+        str: 'direct' or 'fft'
+    """
+    if method == "auto":
+        if n < _DIRECT_MAX_LENGTH or batch * n * n < _DIRECT_MAX_ELEMENTS:
+            return "direct"
+        if n < _DIRECT_MAX_BATCH_LENGTH and batch >= _DIRECT_MIN_BATCH_RATIO * n:
+            return "direct"
+        return "fft"
+    if method not in ("direct", "fft"):
+        raise ValueError(f"Unknown convolution method '{method}'")
+    return method
+
+
+def conv_fft(a: NDArray[np.floating]) -> NDArray[np.complexfloating]:
+    """Transform of a as used by FFT convolution in `conv`.
+
+    Args:
+        a (NDArray[np.floating]): array of shape (..., n)
+
+    Returns:
+        NDArray[np.complexfloating]: real FFT of a, zero-padded to avoid wrap-around.
+    """
+    n = a.shape[-1]
+    return fft.rfft(a, fft.next_fast_len(2 * n - 1, real=True))
+
+
+def conv(
+    a: NDArray[np.floating],
+    b: NDArray[np.floating],
+    method: str = "auto",
+    a_fft: NDArray[np.complexfloating] = None,
+) -> NDArray[np.floating]:
+    """Discrete convolution of a with b, truncated to the length of the inputs.
+
+    Both inputs are sampled on the same uniform time grid and may be stacks of
+    signals along the leading dimensions, which are broadcast against each other.
+    The typical use is one AIF convolved with a stack of impulse responses, in which
+    case the transform of the AIF is computed once and reused for all of them.
+
+    Args:
+        a (NDArray[np.floating]): array of shape (..., n) to be convolved, e.g. an AIF
+        b (NDArray[np.floating]): array of shape (..., n), e.g. impulse responses
+        method (str, optional): Defines the convolution method. Options include
+
+            – 'direct': product with the lower triangular Toeplitz matrix of a, O(n^2)
+            per signal
+
+            – 'fft': multiplication of real FFTs zero-padded to avoid wrap-around
+
+            – 'auto': 'direct' for signals of less than 64 points, for batches of less
+            than 2^18 / n^2 signals (e.g. a single signal of up to 511 points), or for
+            signals of less than 256 points in batches of at least 16 times as many
+            signals as points, and 'fft' otherwise (default)
+        a_fft (NDArray[np.complexfloating], optional): transform of a as returned by
+            `conv_fft`, to reuse over several calls with the same a. Only used by FFT
+            convolution.
+
+    Returns:
+        NDArray[np.floating]: the first n points of the convolution, with shape given by
+            broadcasting the shapes of a and b.
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    n = a.shape[-1]
+    if b.shape[-1] != n:
+        raise ValueError("a and b must have the same number of time points")
+
+    shape = np.broadcast_shapes(a.shape, b.shape)
+    method = conv_method(n, method, int(np.prod(shape[:-1])))
+    if method == "direct":
+        return _conv_direct(a, b)
+
+    else:
+        if a_fft is None:
+            a_fft = conv_fft(a)
+        n_fft = fft.next_fast_len(2 * n - 1, real=True)
+        f = fft.irfft(a_fft * fft.rfft(b, n_fft), n_fft)[..., :n]
+
+        # Remove round-off errors before the onset of the convolution,
+        # which is exactly zero up to the first non-zero points of a and b
+        onset = np.argmax(a != 0, axis=-1) + np.argmax(b != 0, axis=-1)
+        f[np.arange(n) < onset[..., np.newaxis]] = 0
+        return f
+
+
+def _conv_direct(a: NDArray[np.floating], b: NDArray[np.floating]) -> NDArray[np.floating]:
+    """Direct convolution of `conv` as a product with the Toeplitz matrices of a.
+
+    A single a (e.g. one AIF) gives one matrix that is applied to all b at once, several
+    give one matrix per signal, built in blocks of signals. A few signals are convolved
+    one by one instead, which is cheaper than building their matrices.
+    """
+    if a.ndim > 1 and b.ndim == 1:
+        a, b = b, a
+    n = a.shape[-1]
+    shape = np.broadcast_shapes(a.shape, b.shape)
+    n_rows = int(np.prod(shape[:-1]))
+    if n_rows < _DIRECT_MIN_MATRIX_BATCH:
+        if len(shape) == 1:
+            return np.convolve(a, b)[:n]
+        a_rows = np.broadcast_to(a, shape).reshape(-1, n)
+        b_rows = np.broadcast_to(b, shape).reshape(-1, n)
+        f = np.empty((n_rows, n))
+        for i in range(n_rows):
+            f[i] = np.convolve(a_rows[i], b_rows[i])[:n]
+        return f.reshape(shape)
+
+    # Lower triangular Toeplitz matrix T[i, j] = a[i - j], so that (T @ b)[i] is the
+    # truncated convolution at time point i. Its rows are the reversed windows of n
+    # points of a, zero-padded in front.
+    padded = np.concatenate([np.zeros(a.shape[:-1] + (n - 1,)), a], axis=-1)
+    if a.ndim == 1:
+        toeplitz = sliding_window_view(padded, n)[:, ::-1]
+        return b @ np.ascontiguousarray(toeplitz.T)
+
+    padded_rows = np.broadcast_to(padded, shape[:-1] + (2 * n - 1,)).reshape(-1, 2 * n - 1)
+    b_rows = np.broadcast_to(b, shape).reshape(-1, n)
+    f = np.empty((n_rows, n))
+    block = max(1, _DIRECT_BLOCK_ELEMENTS // (n * n))
+    for start in range(0, n_rows, block):
+        rows = slice(start, start + block)
+        toeplitz = sliding_window_view(padded_rows[rows], n, axis=-1)[..., ::-1]
+        f[rows] = np.matmul(toeplitz, b_rows[rows, :, np.newaxis])[..., 0]
+    return f.reshape(shape)
 
 
 def exp_conv(
-    T: np.floating, t: NDArray[np.floating], a: NDArray[np.floating]
+    T: Union[np.floating, NDArray[np.floating]],
+    t: Union[NDArray[np.floating], TimeGrid],
+    a: NDArray[np.floating],
+    derivative: bool = False,
 ) -> NDArray[np.floating]:
     """Exponential convolution operation of (1/T)exp(-t/T) with a.
 
     Args:
-        T (np.floating): exponent in time units
-        t (NDArray[np.floating]): array of time points
-        a (NDArray[np.floating]): array to be convolved with time exponential
+        T (np.floating or NDArray[np.floating]): exponent in time units. If T is an array,
+            e.g. one time constant per voxel, a is convolved with each exponential and
+            the recursion is run for all of them simultaneously.
+        t (NDArray[np.floating] or TimeGrid): array of time points
+        a (NDArray[np.floating]): array to be convolved with time exponential, of shape
+            (len(t),) or (..., len(t)) broadcastable with the shape of T.
+        derivative (bool, optional): If True, also return the exact derivative of the
+            recursion with respect to T, which is zero where T is zero. Defaults to False.
 
     Returns:
-        NDArray[np.floating]: convolved array
+        NDArray[np.floating]: convolved array of shape (..., len(t)), where ... is the
+            broadcast shape of T and the leading dimensions of a. If derivative is True,
+            the convolution and its derivative stacked along the first axis into an
+            array of shape (2, ..., len(t)).
     """
-    if T == 0:
+    T = np.asarray(T, dtype=float)
+    a = np.asarray(a)
+    if T.ndim == 0 and T == 0 and not derivative:
         return a
 
-    n = len(t)
-    f = np.zeros((n,))
+    grid = as_time_grid(t)
+    n = len(grid)
+    shape = np.broadcast_shapes(T.shape, a.shape[:-1])
+    f = np.zeros((1 + derivative,) + shape + (n,))
 
-    x = (t[1 : n - 1] - t[0 : n - 2]) / T
-    da = (a[1 : n - 1] - a[0 : n - 2]) / x
+    # Time constants of zero leave a unchanged - use a dummy value in the recursion
+    no_conv = T == 0
+    T = np.where(no_conv, 1, T)
+    x, E = grid.exp_table(T)
+    x = x[..., : n - 2]
+    E = E[..., : n - 2]
+    da = (a[..., 1 : n - 1] - a[..., 0 : n - 2]) / x
 
-    E = np.exp(-x)
     E0 = 1 - E
     E1 = x - E0
 
-    add = a[0 : n - 2] * E0 + da * E1
+    add = np.broadcast_to(a[..., 0 : n - 2] * E0 + da * E1, shape + (n - 2,))
+    E = np.broadcast_to(E, shape + (n - 2,))
+    _exp_recursion(f[0], E, add, grid.uniform)
+
+    if derivative:
+        # Differentiating the recursion with respect to T, with dx/dT = -x/T, gives the
+        # same recursion for the derivative, with terms that depend on the convolution
+        add = E * x * (f[0, ..., 0 : n - 2] - a[..., 0 : n - 2]) - da * (E0 - x * E)
+        _exp_recursion(f[1], E, add / T[..., np.newaxis], grid.uniform)
+
+    f[..., n - 1] = f[..., n - 2]
+    if no_conv.any():
+        f[0][no_conv] = np.broadcast_to(a, shape + (n,))[no_conv]
+        if derivative:
+            f[1][no_conv] = 0
+    return f if derivative else f[0]
+
+
+def _exp_recursion(
+    f: NDArray[np.floating],
+    E: NDArray[np.floating],
+    add: NDArray[np.floating],
+    uniform: bool,
+):
+    """Run the recursion f[i + 1] = E[i] * f[i] + add[i] of `exp_conv` in place.
+
+    f has shape (..., n) and starts from f[..., 0] = 0, and E and add have shape
+    (..., n - 2), so that f[..., n - 1] is left to the caller.
+    """
+    n = f.shape[-1]
+    n_conv = int(np.prod(f.shape[:-1]))
+    if n_conv == 1 and uniform:
+        # A single exponential on a uniform grid, e.g. one voxel: the recursion is a
+        # first order IIR filter with a constant coefficient
+        f[..., 1 : n - 1] = lfilter([1.0], [1.0, -E.flat[0]], add.reshape(n - 2))
+    elif n_conv < n - 2 and uniform:
+        # Uniform grid: each exponential decays by a constant factor per step, so the
+        # recursion is a prefix sum that is run for all exponentials in log2(n) steps,
+        # each adding the sum over the preceding s steps decayed by E^s
+        f[..., 1 : n - 1] = add
+        E_s = E[..., :1].copy()
+        s = 1
+        while s < n - 2:
+            f[..., s + 1 : n - 1] += E_s * f[..., 1 : n - 1 - s]
+            E_s *= E_s
+            s *= 2
+    else:
+        # Run the recursion along time for all exponentials at once
+        for i in range(0, n - 2):
+            f[..., i + 1] = E[..., i] * f[..., i] + add[..., i]
+
+
+def riemann_exp_conv(
+    T: Union[np.floating, NDArray[np.floating]],
+    t: Union[NDArray[np.floating], TimeGrid],
+    a: NDArray[np.floating],
+    order: int = 0,
+) -> NDArray[np.floating]:
+    """Riemann sum of the convolution of a with exp(-t/T) on any time grid.
+
+    Each sample of a is weighted by the time step that follows it, and the last one by
+    the last time step. On a uniform grid this is the convolution of the samples with
+    exp(-t/T) by `conv` times the time step, and the sums change continuously with the
+    time points. They are accumulated by a recursion over the time points, so that the
+    cost is proportional to their number.
+
+    Args:
+        T (np.floating or NDArray[np.floating]): positive time constant(s) in time units.
+            If T is an array, e.g. one time constant per voxel, a is convolved with each
+            exponential and the recursion is run for all of them simultaneously.
+        t (NDArray[np.floating] or TimeGrid): array of time points
+        a (NDArray[np.floating]): array to be convolved, of shape (len(t),) or
+            (..., len(t)) broadcastable with the shape of T.
+        order (int, optional): Also convolve a with t^n exp(-t/T) for n up to order,
+            which is 0 (default) or 1.
+
+    Returns:
+        NDArray[np.floating]: convolutions with t^n exp(-t/T) for n = 0, ..., order,
+            stacked along the first axis into an array of shape (order + 1, ..., len(t)),
+            where ... is the broadcast shape of T and the leading dimensions of a.
+    """
+    if order not in (0, 1):
+        raise ValueError("order must be 0 or 1")
+    T = np.asarray(T, dtype=float)
+    a = np.asarray(a)
+    grid = as_time_grid(t)
+    n = len(grid)
+    shape = np.broadcast_shapes(T.shape, a.shape[:-1])
 
-    for i in range(0, n - 2):
-        f[i + 1] = E[i] * f[i] + add[i]
+    _, E = grid.exp_table(T)
+    h = grid.diff
+    add = np.broadcast_to(a * np.append(h, h[-1]), shape + (n,))
+    E = np.broadcast_to(E, shape + (n - 1,))
 
-    f[n - 1] = f[n - 2]
+    # Over a step h the sums decay by exp(-h/T) and pick up the next weighted sample,
+    # and the sums with t exp(-t/T) also pick up h times the former
+    f = np.zeros((order + 1,) + shape + (n,))
+    f[0, ..., 0] = add[..., 0]
+    for i in range(n - 1):
+        f[0, ..., i + 1] = E[..., i] * f[0, ..., i] + add[..., i + 1]
+        if order == 1:
+            f[1, ..., i + 1] = E[..., i] * (f[1, ..., i] + h[i] * f[0, ..., i])
     return f
+
+
+def linear_exp_conv(
+    T: Union[np.floating, NDArray[np.floating]],
+    t: Union[NDArray[np.floating], TimeGrid],
+    a: NDArray[np.floating],
+    order: int = 0,
+    t_eval: NDArray[np.floating] = None,
+) -> NDArray[np.floating]:
+    """Exact convolution of a piecewise linear signal with exp(-t/T).
+
+    The signal is linearly interpolated between its time points, which may be spaced
+    non-uniformly, and the convolution integrals are evaluated exactly at the same time
+    points. Each interval contributes in closed form, so that the cost is proportional to
+    the number of time points, whatever the smallest time step. The convolutions can
+    also be evaluated at other times, from the value at the preceding time point and the
+    integral over the remainder of the interval.
+
+    Args:
+        T (np.floating or NDArray[np.floating]): positive time constant(s) in time units.
+            If T is an array, e.g. one time constant per voxel, a is convolved with each
+            exponential and the recursion is run for all of them simultaneously.
+        t (NDArray[np.floating] or TimeGrid): array of time points
+        a (NDArray[np.floating]): array to be convolved, of shape (len(t),) or
+            (..., len(t)) broadcastable with the shape of T.
+        order (int, optional): Also convolve a with t^n exp(-t/T) for n up to order,
+            which is 0 (default) or 1.
+        t_eval (NDArray[np.floating], optional): times between t[0] and t[-1] at which
+            to evaluate the convolutions. Defaults to t.
+
+    Returns:
+        NDArray[np.floating]: convolutions with t^n exp(-t/T) for n = 0, ..., order,
+            stacked along the first axis into an array of shape
+            (order + 1, ..., len(t_eval)), where ... is the broadcast shape of T and the
+            leading dimensions of a.
+    """
+    if order not in (0, 1):
+        raise ValueError("order must be 0 or 1")
+    T = np.asarray(T, dtype=float)
+    a = np.asarray(a)
+    grid = as_time_grid(t)
+    n = len(grid)
+    shape = np.broadcast_shapes(T.shape, a.shape[:-1])
+
+    x, E = grid.exp_table(T)
+    h = grid.diff
+    T_steps = T[..., np.newaxis]
+    slope = np.diff(a, axis=-1) / h
+    add = _interval_conv(T_steps, x, E, h, a[..., 1:n], slope, order)
+    add = [np.broadcast_to(add_n, shape + (n - 1,)) for add_n in add]
+    E = np.broadcast_to(E, shape + (n - 1,))
+
+    # Run the recursion along time for all exponentials at once. Over a step h the
+    # convolution with exp(-t/T) decays by exp(-h/T), and the one with t exp(-t/T)
+    # also picks up h times the former.
+    f = np.zeros((order + 1,) + shape + (n,))
+    if f[0].size == n:
+        # A single exponential, e.g. one voxel: the recursion is faster on floats than
+        # on arrays of one element
+        E_n, h_n = E.ravel().tolist(), h.tolist()
+        add_n = [x.ravel().tolist() for x in add]
+        f_n = [[0.0] * n for _ in range(order + 1)]
+        for i in range(n - 1):
+            f_n[0][i + 1] = E_n[i] * f_n[0][i] + add_n[0][i]
+            if order == 1:
+                f_n[1][i + 1] = E_n[i] * (f_n[1][i] + h_n[i] * f_n[0][i]) + add_n[1][i]
+        f[:] = np.reshape(f_n, f.shape)
+    else:
+        for i in range(n - 1):
+            f[0, ..., i + 1] = E[..., i] * f[0, ..., i] + add[0][..., i]
+            if order == 1:
+                f[1, ..., i + 1] = E[..., i] * (f[1, ..., i] + h[i] * f[0, ..., i]) + add[1][..., i]
+    if t_eval is None:
+        return f
+
+    # Continue the recursion from the preceding time point over part of the interval,
+    # in blocks of exponentials small enough for the intermediate arrays to stay in cache
+    t_eval = np.asarray(t_eval, dtype=float)
+    m = len(t_eval)
+    i = np.clip(np.searchsorted(grid.t, t_eval, side="right") - 1, 0, n - 2)
+    h_eval = t_eval - grid.t[i]
+    T_rows = np.broadcast_to(T_steps, shape + (1,)).reshape(-1, 1)
+    if a.ndim > 1:
+        a = np.broadcast_to(a, shape + (n,)).reshape(-1, n)
+        slope = np.broadcast_to(slope, shape + (n - 1,)).reshape(-1, n - 1)
+    f = f.reshape(order + 1, -1, n)
+    f_eval = np.empty(f.shape[:2] + (m,))
+    block = max(1, _EVAL_BLOCK_ELEMENTS // m)
+    for start in range(0, len(T_rows), block):
+        rows = slice(start, start + block)
+        T_block = T_rows[rows]
+        a_block, slope_block = (a[rows], slope[rows]) if a.ndim > 1 else (a, slope)
+        slope_eval = slope_block[..., i]
+        a_eval = a_block[..., i] + slope_eval * h_eval
+        x_eval = h_eval / T_block
+        E_eval = np.exp(-x_eval)
+        add = _interval_conv(T_block, x_eval, E_eval, h_eval, a_eval, slope_eval, order)
+        f0 = f[0, rows][:, i]
+        f_eval[0, rows] = E_eval * f0 + add[0]
+        if order == 1:
+            f_eval[1, rows] = E_eval * (f[1, rows][:, i] + h_eval * f0) + add[1]
+    return f_eval.reshape((order + 1,) + shape + (m,))
+
+
+def _interval_conv(
+    T: NDArray[np.floating],
+    x: NDArray[np.floating],
+    E: NDArray[np.floating],
+    h: NDArray[np.floating],
+    a: NDArray[np.floating],
+    slope: NDArray[np.floating],
+    order: int,
+) -> list:
+    """Convolutions of linear segments with t^n exp(-t/T) over steps h = x * T.
+
+    A segment ending at a with the given slope contributes a * A[n] - slope * A[n+1],
+    where A[n] is the integral of u^n exp(-u/T) over [0, h] and E = exp(-x). The
+    integrals lose precision relative to h^(n+1) for small x, but the error is of the
+    order of T^n h times the machine precision, which is negligible next to the
+    convolutions themselves.
+
+    Returns:
+        list: the convolutions for n = 0, ..., order.
+    """
+    A0 = -T * np.expm1(-x)
+    A1 = T * (A0 - h * E)
+    add = [a * A0 - slope * A1]
+    if order == 1:
+        A2 = T * (2 * A1 - h * h * E)
+        add.append(a * A1 - slope * A2)
+    return add
@@ -0,0 +1,244 @@
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy.integrate import cumulative_trapezoid
+
+from ._mask import _check_mask, _scatter
+from ._time_grid import TimeGrid, as_time_grid
+from ._tissue import _shift_aif
+
+# Number of array elements (voxels x time points x regressors) processed at once
+_BLOCK_ELEMENTS = 2**22
+
+
+def estimate_Ta(
+    t: Union[NDArray[np.floating], TimeGrid],
+    ct: NDArray[np.floating],
+    ca: NDArray[np.floating],
+    model: str = "tofts",
+    Ta_range: Tuple[np.floating, np.floating] = (0.0, 60.0),
+    n_grid: int = 31,
+    tol: np.floating = 0.1,
+    discretization_method: str = "conv",
+    mask: NDArray[np.bool_] = None,
+) -> NDArray[np.floating]:
+    """Voxel-wise estimation of the arterial delay time.
+
+    For each candidate delay, the AIF is shifted and a linear form of the model is
+    solved for all voxels at once. For the 'conv' discretization on a uniform time grid
+    this is the recurrence of the discrete convolution,
+
+    ct[k] = exp(-kep * dt) * ct[k - 1] + Ktrans * dt * ca[k]
+
+    plus vp * (ca[k] - exp(-kep * dt) * ca[k - 1]) for the Extended Tofts model, which
+    the model curves satisfy exactly. Otherwise these are the integrated model
+    equations (Murase 2004, see `fit_tofts`). The delay of a voxel is the candidate with
+    the smallest sum of squared residuals, where delays that give a negative Ktrans, kep
+    or vp count as not explaining the curve at all. The candidates are first a regular
+    grid over Ta_range, shared by all voxels, and then a bisection around the best delay
+    of each voxel until the step is below tol.
+
+    Comparing against the model rather than cross-correlating the curves with the AIF
+    avoids the bias from the dispersion of the bolus in the tissue, which delays the
+    peak of the tissue curve by an amount that depends on kep.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        ct (NDArray[np.floating]):
+            Tissue concentrations in mM of shape (..., len(t)), one curve per voxel.
+        ca (NDArray[np.floating]):
+            Arterial concentrations in mM for each time point in t. [OSIPI code Q.IC1.001]
+        model (str, optional): 'tofts' (default) or 'extended_tofts'.
+        Ta_range (Tuple[np.floating, np.floating], optional): Smallest and largest delay
+            time in units of sec. Defaults to (0, 60).
+        n_grid (int, optional): Number of delays of the initial grid. Defaults to 31.
+        tol (np.floating, optional): Resolution of the delay times in sec.
+            Defaults to 0.1.
+        discretization_method (str, optional): Discretization method of the model the
+            delays are used with, 'conv' (default), 'exp', 'linear' or 'adaptive'. See
+            `tofts`.
+        mask (NDArray[np.bool_], optional): Voxels to estimate the delay of, of shape
+            (...). The other voxels get a delay of zero. Defaults to all voxels.
+
+    Returns:
+        NDArray[np.floating]: Arterial delay time in units of sec for each voxel, of
+            shape (...). This can be passed as Ta to the tissue models and fitting
+            functions. [OSIPI code Q.PH1.007]
+
+    Example:
+
+        Estimate the delay of noisy Tofts curves and use it in the fit:
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1.0)
+        >>> ca = osipi.aif_parker(t)
+        >>> Ta = np.array([5.0, 12.5, 20.0])
+        >>> ct = osipi.tofts(t, ca, Ktrans=0.3, ve=0.2, Ta=Ta)
+        >>> Ta_est = osipi.estimate_Ta(t, ct, ca)
+        >>> Ktrans, ve, converged = osipi.fit_tofts(t, ct, ca, Ta=Ta_est)
+
+    """
+    if model not in ("tofts", "extended_tofts"):
+        raise ValueError(f"Unknown model '{model}'")
+    if discretization_method not in ("conv", "exp", "linear", "adaptive"):
+        raise ValueError(f"Unknown discretization method '{discretization_method}'")
+    if n_grid < 2:
+        raise ValueError("n_grid must be at least 2")
+    t = np.asarray(t, dtype=float)
+    ca = np.asarray(ca, dtype=float)
+    ct = np.asarray(ct, dtype=float)
+    n_time = len(t)
+    if ct.shape[-1:] != (n_time,):
+        raise ValueError("ct must have one concentration for each time point in t")
+    if mask is not None:
+        mask = _check_mask(mask, ct.shape[:-1])
+        Ta = estimate_Ta(t, ct[mask], ca, model, Ta_range, n_grid, tol, discretization_method)
+        return _scatter(mask, Ta)
+
+    extended = model == "extended_tofts"
+    recurrence = discretization_method == "conv" and as_time_grid(t).uniform
+    shape = ct.shape[:-1]
+    ct = ct.reshape(-1, n_time)
+    Ta_min, Ta_max = (float(x) for x in Ta_range)
+    grid = np.linspace(Ta_min, Ta_max, n_grid)
+
+    # The time integral of a delayed AIF is the delayed time integral of the AIF
+    ca_int = cumulative_trapezoid(ca, t, initial=0)
+
+    def delayed(Ta):
+        # AIF regressors of the linear form, the one scaled by Ktrans first
+        ca_Ta = _shift_aif(t, ca, Ta)
+        if recurrence:
+            return ca_Ta[..., 1:], ca_Ta[..., :-1]
+        return _shift_aif(t, ca_int, Ta), ca_Ta
+
+    # Delayed AIFs of the grid, shared by all voxels
+    ca_grid = delayed(grid)
+
+    Ta = np.empty(len(ct))
+    block = max(1, _BLOCK_ELEMENTS // (n_time * 6))
+    for i in range(0, len(ct), block):
+        curves = ct[i : i + block]
+        # Data and curve regressor of the linear form
+        if recurrence:
+            y, curves_reg = curves[:, 1:], curves[:, :-1]
+        else:
+            y, curves_reg = curves, -cumulative_trapezoid(curves, t, initial=0)
+
+        # Coarse search on the grid
+        costs = _linear_costs(*ca_grid, curves_reg, y, extended, recurrence, shared=True)
+        best = np.argmin(costs, axis=1)
+        Ta_best, cost_best = grid[best], costs[np.arange(len(curves)), best]
+
+        # Bisection around the best delay, with one delayed AIF per voxel
+        step = (grid[1] - grid[0]) / 2
+        while step >= tol:
+            for Ta_candidate in (Ta_best - step, Ta_best + step):
+                Ta_candidate = np.clip(Ta_candidate, Ta_min, Ta_max)
+                cost_candidate = _linear_costs(
+                    *delayed(Ta_candidate), curves_reg, y, extended, recurrence, shared=False
+                )
+                better = cost_candidate < cost_best
+                Ta_best = np.where(better, Ta_candidate, Ta_best)
+                cost_best = np.where(better, cost_candidate, cost_best)
+            step /= 2
+        Ta[i : i + block] = Ta_best
+
+    return Ta.reshape(shape)
+
+
+def _linear_costs(
+    ca_0: NDArray[np.floating],
+    ca_2: NDArray[np.floating],
+    ct_1: NDArray[np.floating],
+    y: NDArray[np.floating],
+    extended: bool,
+    recurrence: bool,
+    shared: bool,
+) -> NDArray[np.floating]:
+    """Residuals of the linear forms of the Tofts or Extended Tofts model.
+
+    The regressors are (ca_0, ct_1) for the Tofts model and (ca_0, ct_1, ca_2) for the
+    Extended Tofts model, with the AIF regressors ca_0 and ca_2 and the curve regressor
+    ct_1: the time integrals of the AIF and curve (negated) and the AIF for the
+    integrated model equations of `_fit_linear`, and the AIF and the curve and AIF at
+    the preceding time point for the recurrence of the 'conv' discretization. Their
+    normal equations are assembled from inner products of the regressors, so that for
+    AIFs shared by all voxels the terms coupling voxels and AIFs are matrix products.
+
+    Args:
+        ca_0, ca_2 (NDArray[np.floating]): AIF regressors of shape (m, T), each of
+            which is compared with all curves if shared, or of shape (n, T) for one AIF
+            per curve.
+        ct_1 (NDArray[np.floating]): curve regressors of shape (n, T).
+        y (NDArray[np.floating]): Tissue concentrations of shape (n, T).
+        extended (bool): Use the Extended Tofts model.
+        recurrence (bool): The regressors are those of the recurrence.
+        shared (bool): The AIFs are compared with all curves.
+
+    Returns:
+        NDArray[np.floating]: sum of squared residuals, of shape (n, m) for shared AIFs
+            or (n,) for one AIF per curve. Voxels where the solution has a negative Ktrans,
+            kep or vp are given the sum of squares of the curve.
+    """
+
+    def own(a, b):
+        return np.einsum("...t,...t->...", a, b)
+
+    def cross(a, b):
+        # Products of curve regressors a with AIF regressors b
+        return a @ b.T if shared else own(a, b)
+
+    def curve(a, b):
+        return own(a, b)[:, np.newaxis] if shared else own(a, b)
+
+    yy = curve(y, y)
+    products = {
+        (0, 0): own(ca_0, ca_0),
+        (0, 1): cross(ct_1, ca_0),
+        (1, 1): curve(ct_1, ct_1),
+        (0, "y"): cross(y, ca_0),
+        (1, "y"): curve(ct_1, y),
+    }
+    if extended:
+        products.update(
+            {
+                (0, 2): own(ca_0, ca_2),
+                (1, 2): cross(ct_1, ca_2),
+                (2, 2): own(ca_2, ca_2),
+                (2, "y"): cross(y, ca_2),
+            }
+        )
+    k = 2 + extended
+    shape = np.shape(yy * products[(0, 1)])
+    A = np.empty(shape + (k, k))
+    b = np.empty(shape + (k,))
+    for i in range(k):
+        b[..., i] = products[(i, "y")]
+        for j in range(i, k):
+            A[..., i, j] = A[..., j, i] = products[(i, j)]
+
+    # Small ridge to keep degenerate (e.g. all-zero) curves solvable
+    ridge = 1e-12 * np.trace(A, axis1=-2, axis2=-1)[..., np.newaxis, np.newaxis] + 1e-300
+    beta = np.linalg.solve(A + ridge * np.eye(k), b[..., np.newaxis])[..., 0]
+    # |y - X beta|^2 expanded in terms of the normal equations
+    cost = yy - 2 * np.einsum("...i,...i->...", b, beta)
+    cost = np.maximum(cost + np.einsum("...i,...ij,...j->...", beta, A, beta), 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if recurrence:
+            # beta = (Ktrans * dt + vp, E, -E * vp) with E = exp(-kep * dt)
+            E = beta[..., 1]
+            vp = -beta[..., 2] / E if extended else 0.0
+            valid = (E > 0) & (E < 1) & (beta[..., 0] - vp > 0)
+        else:
+            # beta = (Ktrans + kep * vp, kep, vp)
+            kep = beta[..., 1]
+            vp = beta[..., 2] if extended else 0.0
+            valid = (kep > 0) & (beta[..., 0] - kep * vp > 0)
+    if extended:
+        # A negative vp can mimic a different delay of the AIF
+        valid &= vp >= 0
+    return np.where(valid, cost, yy)
@@ -0,0 +1,228 @@
+import os
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ._fitting import _fit_model
+from ._mask import _check_mask, _scatter
+from ._time_grid import TimeGrid
+from ._tissue import ExtendedToftsModel, ToftsModel
+
+# Number of array elements (voxels x atoms) matched at once
+_BLOCK_ELEMENTS = 2**22
+
+
+class ToftsDictionary:
+    """Dictionary of Tofts model curves for fitting by matching.
+
+    For a given time grid, AIF and arterial delay, the Tofts and Extended Tofts tissue
+    curves depend linearly on Ktrans (and vp) once kep = Ktrans/ve is fixed. The
+    dictionary stores normalized curves (atoms) for a dense grid of kep values. A voxel
+    is fitted by finding the atom with the largest inner product with its curve, which
+    gives kep, after which Ktrans (and vp) follow by projection. The cost per voxel is
+    one inner product with each atom, independent of the data and of any convergence.
+
+    For the Extended Tofts model the atoms are orthogonalized against the AIF, so that
+    the plasma term is projected out before matching.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        ca (NDArray[np.floating]):
+            Arterial concentrations in mM for each time point in t. [OSIPI code Q.IC1.001]
+        model (str, optional): 'tofts' (default) or 'extended_tofts'.
+        Ta (np.floating, optional):
+            Arterial delay time in units of sec. Defaults to 30 seconds. [OSIPI code Q.PH1.007]
+        discretization_method (str, optional): Defines the discretization method of the
+            model, 'conv' (default) or 'exp'. See `tofts`.
+        kep_range (Tuple[np.floating, np.floating], optional): Smallest and largest kep in
+            units of 1/min. Defaults to (1e-3, 20).
+        n_atoms (int, optional): Number of kep values, spaced logarithmically.
+            Defaults to 1000.
+
+    Attributes:
+        kep (NDArray[np.floating]): kep of each atom in units of 1/min.
+        atoms (NDArray[np.floating]): normalized curves of shape (n_atoms, len(t)).
+
+    See Also:
+        `fit_tofts`
+        `fit_extended_tofts`
+
+    Example:
+
+        Build a dictionary, store it on disk and fit a batch of curves.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> ca = osipi.aif_parker(t)
+        >>> dictionary = osipi.ToftsDictionary(t, ca)
+        >>> dictionary.save("tofts_dictionary")
+        >>> dictionary = osipi.ToftsDictionary.load("tofts_dictionary")
+        >>> ct = osipi.tofts(t, ca, np.random.uniform(0.05, 0.6, 1000), 0.3)
+        >>> Ktrans, ve, valid = dictionary.fit(ct)
+
+    """
+
+    def __init__(
+        self,
+        t: Union[NDArray[np.floating], TimeGrid],
+        ca: NDArray[np.floating],
+        model: str = "tofts",
+        Ta: np.floating = 30.0,
+        discretization_method: str = "conv",
+        kep_range: Tuple[np.floating, np.floating] = (1e-3, 20.0),
+        n_atoms: int = 1000,
+    ):
+        if model not in ("tofts", "extended_tofts"):
+            raise ValueError(f"Unknown model '{model}'")
+        self.model = model
+        self.Ta = Ta
+        self.discretization_method = discretization_method
+        self._tissue_model = self._build_model(t, ca)
+
+        # Curves for Ktrans = 1/sec, i.e. the convolution of the AIF with exp(-kep t)
+        self.kep = np.geomspace(kep_range[0], kep_range[1], n_atoms)
+        params = [np.full(n_atoms, 60.0), 60 / self.kep]
+        if model == "extended_tofts":
+            params.append(np.zeros(n_atoms))
+        curves = self._tissue_model.evaluate(np.stack(params, axis=-1))
+
+        if model == "extended_tofts":
+            # Remove the component along the delayed AIF, which is fitted by vp
+            ca_delayed = self._tissue_model._aif().ca
+            self._ca_norm = np.linalg.norm(ca_delayed)
+            q = ca_delayed / self._ca_norm
+            self._overlap = curves @ q
+            curves = curves - self._overlap[:, np.newaxis] * q
+        self.norms = np.linalg.norm(curves, axis=-1)
+        self.atoms = curves / self.norms[:, np.newaxis]
+
+    def _build_model(self, t, ca):
+        if self.model == "tofts":
+            return ToftsModel(t, ca, self.Ta, self.discretization_method)
+        return ExtendedToftsModel(t, ca, self.Ta, self.discretization_method)
+
+    def save(self, path: str):
+        """Save the dictionary to a directory.
+
+        The atoms are stored as an uncompressed .npy file, so that they can be
+        memory-mapped when the dictionary is loaded.
+
+        Args:
+            path (str): directory to save to, created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "atoms.npy"), self.atoms)
+        meta = dict(
+            model=self.model,
+            Ta=self.Ta,
+            discretization_method=self.discretization_method,
+            t=self._tissue_model.t,
+            ca=self._tissue_model.ca,
+            kep=self.kep,
+            norms=self.norms,
+        )
+        if self.model == "extended_tofts":
+            meta.update(ca_norm=self._ca_norm, overlap=self._overlap)
+        np.savez(os.path.join(path, "meta.npz"), **meta)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = "r") -> "ToftsDictionary":
+        """Load a dictionary saved with `save`.
+
+        Args:
+            path (str): directory the dictionary was saved to.
+            mmap_mode (str, optional): memory-map mode of the atoms, see `numpy.load`.
+                Defaults to 'r'. Use None to read the atoms into memory.
+
+        Returns:
+            ToftsDictionary: the loaded dictionary.
+        """
+        self = cls.__new__(cls)
+        with np.load(os.path.join(path, "meta.npz")) as meta:
+            self.model = str(meta["model"])
+            self.Ta = float(meta["Ta"])
+            self.discretization_method = str(meta["discretization_method"])
+            self._tissue_model = self._build_model(meta["t"], meta["ca"])
+            self.kep = meta["kep"]
+            self.norms = meta["norms"]
+            if self.model == "extended_tofts":
+                self._ca_norm = float(meta["ca_norm"])
+                self._overlap = meta["overlap"]
+        self.atoms = np.load(os.path.join(path, "atoms.npy"), mmap_mode=mmap_mode)
+        return self
+
+    def fit(
+        self,
+        ct: NDArray[np.floating],
+        refine: bool = False,
+        bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]] = None,
+        max_iter: int = 100,
+        tol: np.floating = 1e-8,
+        mask: NDArray[np.bool_] = None,
+    ) -> Tuple[NDArray[np.floating], ...]:
+        """Fit tissue curves by matching them against the dictionary.
+
+        Args:
+            ct (NDArray[np.floating]):
+                Tissue concentrations in mM of shape (..., len(t)), one curve per voxel.
+            refine (bool, optional): If True, refine the matched parameters with a
+                Levenberg-Marquardt fit, see `fit_tofts`. Defaults to False.
+            bounds (Tuple, optional): Lower and upper bounds of the parameters for the
+                refinement. Defaults to the bounds of `fit_tofts` or `fit_extended_tofts`.
+            max_iter (int, optional): Maximum number of iterations of the refinement.
+                Defaults to 100.
+            tol (np.floating, optional): Convergence tolerance of the refinement.
+                Defaults to 1e-8.
+            mask (NDArray[np.bool_], optional): Voxels to fit, of shape (...). The other
+                voxels get zero parameters and False flags. Defaults to all voxels.
+
+        Returns:
+            Tuple[NDArray[np.floating], ...]: Maps of Ktrans in units of 1/min, ve, vp
+                (Extended Tofts model only) and flags, each of shape (...). Without
+                refinement the flags mark voxels with a positive match, with refinement
+                they are the convergence flags.
+        """
+        ct = np.asarray(ct, dtype=float)
+        n_time = self.atoms.shape[-1]
+        if ct.shape[-1:] != (n_time,):
+            raise ValueError("ct must have one concentration for each time point in t")
+        if mask is not None:
+            mask = _check_mask(mask, ct.shape[:-1])
+            *params, valid = self.fit(ct[mask], refine, bounds, max_iter, tol)
+            return tuple(_scatter(mask, p) for p in params) + (_scatter(mask, valid, fill=False),)
+        shape = ct.shape[:-1]
+        ct = ct.reshape(-1, n_time)
+        n_params = 3 if self.model == "extended_tofts" else 2
+
+        params = np.empty((len(ct), n_params))
+        valid = np.empty(len(ct), dtype=bool)
+        block = max(1, _BLOCK_ELEMENTS // max(len(self.kep), n_time))
+        for i in range(0, len(ct), block):
+            params[i : i + block], valid[i : i + block] = self._match(ct[i : i + block])
+
+        if refine:
+            if bounds is None:
+                bounds = ((1e-5, 1e-5, 0.0), (5.0, 1.0, 1.0))
+                bounds = tuple(b[:n_params] for b in bounds)
+            params, valid = _fit_model(self._tissue_model, ct, "lm", params, bounds, max_iter, tol)
+
+        params = params.reshape(shape + (n_params,))
+        return tuple(params[..., k] for k in range(n_params)) + (valid.reshape(shape),)
+
+    def _match(self, ct: NDArray[np.floating]) -> Tuple[NDArray[np.floating], NDArray[np.bool_]]:
+        """Match a block of curves of shape (n, len(t)) to the atoms."""
+        products = ct @ np.asarray(self.atoms).T
+        best = np.argmax(products, axis=-1)
+        product = products[np.arange(len(ct)), best]
+        valid = product > 0
+
+        Ktrans = np.where(valid, product / self.norms[best], 0.0)  # in 1/sec
+        kep = self.kep[best]
+        params = [Ktrans * 60, Ktrans * 60 / kep]
+        if self.model == "extended_tofts":
+            ca_delayed = self._tissue_model._aif().ca
+            vp = (ct @ ca_delayed / self._ca_norm - Ktrans * self._overlap[best]) / self._ca_norm
+            params.append(vp)
+        return np.stack(params, axis=-1), valid
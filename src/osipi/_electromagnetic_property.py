@@ -1,9 +1,17 @@
+from typing import Union
+
 import numpy as np
 from numpy.typing import NDArray
 
+from ._mask import _check_mask, _compact, _scatter
+
 
 def R1_to_C_linear_relaxivity(
-    R1: NDArray[np.floating], R10: np.floating, r1: np.floating
+    R1: NDArray[np.floating],
+    R10: Union[np.floating, NDArray[np.floating]],
+    r1: np.floating,
+    out: NDArray[np.floating] = None,
+    mask: NDArray[np.bool_] = None,
 ) -> NDArray[np.floating]:
     """
     Electromagnetic property inverse model:
@@ -12,16 +20,25 @@ def R1_to_C_linear_relaxivity(
     Converts R1 to tissue concentration
 
     Args:
-        R1 (1D array of np.floating):
-            Vector of longitudinal relaxation rate in units of /s. [OSIPI code Q.EL1.001]
-        R10 (np.floating):
-            Native longitudinal relaxation rate in units of /s. [OSIPI code Q.EL1.002]
+        R1 (NDArray[np.floating]):
+            Longitudinal relaxation rates in units of /s of shape (..., n_time).
+            [OSIPI code Q.EL1.001]
+        R10 (np.floating or NDArray[np.floating]):
+            Native longitudinal relaxation rate in units of /s, of shape (...) or
+            broadcastable to it, e.g. one value per voxel. [OSIPI code Q.EL1.002]
         r1 (np.floating):
             Longitudinal relaxivity in units of /s/mM. [OSIPI code Q.EL1.015]
+        out (NDArray[np.floating], optional):
+            Array of the shape of R1 to store the concentrations in, which may be R1
+            itself. Defaults to a new array.
+        mask (NDArray[np.bool_], optional):
+            Voxels to convert, of shape (...). The concentrations of the other voxels
+            are set to zero without computing them. Defaults to all voxels.
 
     Returns:
         NDArray[np.floating]:
-            Vector of indicator concentration in units of mM. [OSIPI code Q.IC1.001]
+            Indicator concentration in units of mM of shape (..., n_time).
+            [OSIPI code Q.IC1.001]
 
     References:
         - Lexicon URL: https://osipi.github.io/OSIPI_CAPLEX/perfusionProcesses/#
@@ -32,9 +49,36 @@ def R1_to_C_linear_relaxivity(
             longitudinal relaxation rate, linear with relaxivity model [OSIPI code M.EL1.003]
         - Adapted from equation given in lexicon
     """
-    # Check R1 is a 1D array of floats
-    if not (isinstance(R1, np.ndarray) and R1.ndim == 1 and np.issubdtype(R1.dtype, np.floating)):
-        raise TypeError("R1 must be a 1D NumPy array of np.floating")
+    # Check R1 is an array of floats with a time dimension
+    if not (isinstance(R1, np.ndarray) and R1.ndim >= 1 and np.issubdtype(R1.dtype, np.floating)):
+        raise TypeError("R1 must be a NumPy array of np.floating with at least 1 dimension")
     elif not (r1 >= 0):
         raise ValueError("r1 must be positive")
-    return (R1 - R10) / r1  # C
+    (R10,) = _voxel_maps(R1, R10)
+    if mask is not None:
+        mask = _check_mask(mask, R1.shape[:-1])
+        C = (_compact(mask, R1, trailing=1) - _compact(mask, R10, trailing=1)) / r1
+        return _scatter(mask, C, out=out)
+    out = np.subtract(R1, R10, out=out)
+    out /= r1
+    return out  # C
+
+
+def _voxel_maps(S: NDArray[np.floating], *maps) -> list:
+    """Per-voxel parameter maps aligned with the voxels of a time series array.
+
+    Args:
+        S (NDArray[np.floating]): time series of shape (..., n_time).
+        *maps (np.floating or NDArray[np.floating]): values broadcastable to shape (...).
+
+    Returns:
+        list: the maps with a trailing axis, so that they broadcast against S.
+    """
+    maps = [np.asarray(m, dtype=float) for m in maps]
+    shape = np.broadcast_shapes(S.shape[:-1], *(m.shape for m in maps))
+    if shape != S.shape[:-1]:
+        raise ValueError(
+            f"Parameter maps of shapes {[m.shape for m in maps]} do not match the "
+            f"{S.shape[:-1]} voxels of the time series"
+        )
+    return [m[..., np.newaxis] for m in maps]
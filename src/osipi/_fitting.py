@@ -0,0 +1,420 @@
+from functools import partial
+from typing import Callable, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy.integrate import cumulative_trapezoid
+
+from ._mask import _check_mask, _compact, _scatter
+from ._time_grid import TimeGrid
+from ._tissue import ExtendedToftsModel, ToftsModel, _shift_aif, _TissueModel
+
+# Number of array elements (voxels x time points x parameters) fitted at once
+_BLOCK_ELEMENTS = 2**22
+
+
+def fit_tofts(
+    t: Union[NDArray[np.floating], TimeGrid],
+    ct: NDArray[np.floating],
+    ca: NDArray[np.floating],
+    Ta: Union[np.floating, NDArray[np.floating]] = 30.0,
+    discretization_method: str = "conv",
+    method: str = "lm",
+    p0: Union[str, NDArray[np.floating]] = (0.1, 0.2),
+    bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]] = ((1e-5, 1e-5), (5.0, 1.0)),
+    max_iter: int = 100,
+    tol: np.floating = 1e-8,
+    mask: NDArray[np.bool_] = None,
+) -> Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+    """Voxel-wise least-squares fit of the Tofts model.
+
+    All voxels are fitted simultaneously, either with a bounded Levenberg-Marquardt
+    algorithm with a damping factor and convergence test for each voxel, or with a
+    linearized formulation of the model that is solved in closed form.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        ct (NDArray[np.floating]):
+            Tissue concentrations in mM of shape (..., len(t)), one curve per voxel.
+        ca (NDArray[np.floating]):
+            Arterial concentrations in mM for each time point in t. [OSIPI code Q.IC1.001]
+        Ta (np.floating or NDArray[np.floating], optional):
+            Arterial delay time in units of sec. Defaults to 30 seconds. An array gives
+            the delay of each voxel, broadcast against the shape (...) of ct.
+            [OSIPI code Q.PH1.007]
+        discretization_method (str, optional): Defines the discretization method of the
+            model, 'conv' (default) or 'exp'. See `tofts`.
+        method (str, optional): Defines the fitting method. Options include
+
+            – 'lm': Levenberg-Marquardt least-squares fit of the model (default)
+
+            – 'linear': Linear least-squares fit of the integrated model equations
+            (Murase 2004). This is a single linear solve for all voxels and does not
+            depend on the discretization method or initial values.
+        p0 (str or NDArray[np.floating], optional): Initial values of (Ktrans, ve) for
+            the 'lm' method, either one pair for all voxels, an array of shape (..., 2) or
+            'linear' to start from the result of the 'linear' method. Defaults to (0.1, 0.2).
+        bounds (Tuple, optional): Lower and upper bounds of (Ktrans, ve).
+            Defaults to ((1e-5, 1e-5), (5.0, 1.0)).
+        max_iter (int, optional): Maximum number of iterations. Defaults to 100.
+        tol (np.floating, optional): Relative reduction of the sum of squared residuals,
+            or relative change of the parameters, below which a voxel is considered
+            converged. Defaults to 1e-8.
+        mask (NDArray[np.bool_], optional): Voxels to fit, of shape (...). The other
+            voxels are not fitted and get zero parameters and False flags. Defaults to
+            all voxels.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+            Maps of Ktrans in units of 1/min [OSIPI code Q.PH1.008], ve
+            [OSIPI code Q.PH1.001.[e]] and convergence flags, each of shape (...).
+            For the 'linear' method the flags mark voxels where the linear solution
+            has positive Ktrans and ve; the parameters are clipped to the bounds.
+
+    See Also:
+        `tofts`
+        `fit_extended_tofts`
+
+    Example:
+
+        Fit noisy tissue curves of 1000 voxels.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> ca = osipi.aif_parker(t)
+        >>> Ktrans = np.random.uniform(0.05, 0.6, 1000)
+        >>> ct = osipi.tofts(t, ca, Ktrans, 0.3)
+        >>> ct += np.random.normal(0, 0.01, ct.shape)
+        >>> Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca)
+
+        Quick linear fit, and a nonlinear fit initialized with it:
+
+        >>> Ktrans_fit, ve_fit, valid = osipi.fit_tofts(t, ct, ca, method="linear")
+        >>> Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca, p0="linear")
+
+    """
+    model = ToftsModel(t, ca, Ta, discretization_method)
+    params, converged = _fit_model(model, ct, method, p0, bounds, max_iter, tol, mask)
+    return params[..., 0], params[..., 1], converged
+
+
+def fit_extended_tofts(
+    t: Union[NDArray[np.floating], TimeGrid],
+    ct: NDArray[np.floating],
+    ca: NDArray[np.floating],
+    Ta: Union[np.floating, NDArray[np.floating]] = 30.0,
+    discretization_method: str = "conv",
+    method: str = "lm",
+    p0: Union[str, NDArray[np.floating]] = (0.1, 0.2, 0.05),
+    bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]] = (
+        (1e-5, 1e-5, 0.0),
+        (5.0, 1.0, 1.0),
+    ),
+    max_iter: int = 100,
+    tol: np.floating = 1e-8,
+    mask: NDArray[np.bool_] = None,
+) -> Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+    """Voxel-wise least-squares fit of the Extended Tofts model.
+
+    All voxels are fitted simultaneously, either with a bounded Levenberg-Marquardt
+    algorithm with a damping factor and convergence test for each voxel, or with a
+    linearized formulation of the model that is solved in closed form.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        ct (NDArray[np.floating]):
+            Tissue concentrations in mM of shape (..., len(t)), one curve per voxel.
+        ca (NDArray[np.floating]):
+            Arterial concentrations in mM for each time point in t. [OSIPI code Q.IC1.001]
+        Ta (np.floating or NDArray[np.floating], optional):
+            Arterial delay time in units of sec. Defaults to 30 seconds. An array gives
+            the delay of each voxel, broadcast against the shape (...) of ct.
+            [OSIPI code Q.PH1.007]
+        discretization_method (str, optional): Defines the discretization method of the
+            model, 'conv' (default) or 'exp'. See `extended_tofts`.
+        method (str, optional): Defines the fitting method. Options include
+
+            – 'lm': Levenberg-Marquardt least-squares fit of the model (default)
+
+            – 'linear': Linear least-squares fit of the integrated model equations
+            (Murase 2004). This is a single linear solve for all voxels and does not
+            depend on the discretization method or initial values.
+        p0 (str or NDArray[np.floating], optional): Initial values of (Ktrans, ve, vp)
+            for the 'lm' method, either one triplet for all voxels, an array of shape
+            (..., 3) or 'linear' to start from the result of the 'linear' method.
+            Defaults to (0.1, 0.2, 0.05).
+        bounds (Tuple, optional): Lower and upper bounds of (Ktrans, ve, vp).
+            Defaults to ((1e-5, 1e-5, 0), (5.0, 1.0, 1.0)).
+        max_iter (int, optional): Maximum number of iterations. Defaults to 100.
+        tol (np.floating, optional): Relative reduction of the sum of squared residuals,
+            or relative change of the parameters, below which a voxel is considered
+            converged. Defaults to 1e-8.
+        mask (NDArray[np.bool_], optional): Voxels to fit, of shape (...). The other
+            voxels are not fitted and get zero parameters and False flags. Defaults to
+            all voxels.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+            Maps of Ktrans in units of 1/min [OSIPI code Q.PH1.008], ve
+            [OSIPI code Q.PH1.001.[e]], vp [OSIPI code Q.PH1.001.[p]] and convergence
+            flags, each of shape (...). For the 'linear' method the flags mark voxels
+            where the linear solution has positive Ktrans and ve; the parameters are
+            clipped to the bounds.
+
+    See Also:
+        `extended_tofts`
+        `fit_tofts`
+
+    Example:
+
+        Fit noisy tissue curves of 1000 voxels.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> ca = osipi.aif_parker(t)
+        >>> Ktrans = np.random.uniform(0.05, 0.6, 1000)
+        >>> ct = osipi.extended_tofts(t, ca, Ktrans, 0.3, 0.05)
+        >>> ct += np.random.normal(0, 0.01, ct.shape)
+        >>> Ktrans_fit, ve_fit, vp_fit, converged = osipi.fit_extended_tofts(t, ct, ca)
+
+    """
+    model = ExtendedToftsModel(t, ca, Ta, discretization_method)
+    params, converged = _fit_model(model, ct, method, p0, bounds, max_iter, tol, mask)
+    return params[..., 0], params[..., 1], params[..., 2], converged
+
+
+def _fit_model(
+    model: _TissueModel,
+    ct: NDArray[np.floating],
+    method: str,
+    p0: Union[str, NDArray[np.floating]],
+    bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]],
+    max_iter: int,
+    tol: np.floating,
+    mask: NDArray[np.bool_] = None,
+) -> Tuple[NDArray[np.floating], NDArray[np.bool_]]:
+    """Fit a tissue or signal model to a batch of curves, in blocks of voxels.
+
+    With a mask, only the curves in the mask are fitted and the other voxels get zero
+    parameters and False flags.
+    """
+    if method not in ("lm", "linear"):
+        raise ValueError(f"Unknown fitting method '{method}'")
+    ct = np.asarray(ct, dtype=float)
+    n_params = len(model.parameter_names)
+    n_time = len(model.t)
+    if ct.shape[-1:] != (n_time,):
+        raise ValueError("ct must have one concentration for each time point in t")
+
+    linear_p0 = isinstance(p0, str) and p0 == "linear"
+    # Arguments of the model with one value per voxel, such as delay times
+    arguments = model._voxel_arguments
+    if mask is not None:
+        mask = _check_mask(mask, ct.shape[:-1])
+        ct = ct[mask]
+        arguments = {name: _compact(mask, value) for name, value in arguments.items()}
+        if not linear_p0:
+            p0 = _compact(mask, p0, trailing=1)
+
+    shape = ct.shape[:-1]
+    ct = ct.reshape(-1, n_time)
+    if not linear_p0:
+        p0 = np.broadcast_to(np.asarray(p0, dtype=float), shape + (n_params,))
+        p0 = p0.reshape(-1, n_params)
+    lower, upper = (np.asarray(b, dtype=float) for b in bounds)
+    arguments = {
+        name: np.broadcast_to(np.asarray(value, dtype=float), shape).reshape(-1)
+        if np.ndim(value) > 0
+        else value
+        for name, value in arguments.items()
+    }
+
+    def select(arguments, index):
+        return {
+            name: value if np.ndim(value) == 0 else value[index]
+            for name, value in arguments.items()
+        }
+
+    def fun(p, index, arguments):
+        return model._evaluate(p, True, **select(arguments, index))
+
+    params = np.empty((len(ct), n_params))
+    converged = np.empty(len(ct), dtype=bool)
+    block = max(1, _BLOCK_ELEMENTS // (n_time * (n_params + 1)))
+    for i in range(0, len(ct), block):
+        arguments_block = select(arguments, slice(i, i + block))
+        if method == "linear" or linear_p0:
+            p_block, converged[i : i + block] = _fit_linear(
+                model, ct[i : i + block], arguments_block["Ta"]
+            )
+            params[i : i + block] = np.clip(p_block, lower, upper)
+        if method == "lm":
+            p_block = params[i : i + block] if linear_p0 else p0[i : i + block]
+            params[i : i + block], converged[i : i + block] = _levenberg_marquardt(
+                partial(fun, arguments=arguments_block),
+                ct[i : i + block],
+                p_block,
+                lower,
+                upper,
+                max_iter,
+                tol,
+            )
+    params, converged = params.reshape(shape + (n_params,)), converged.reshape(shape)
+    if mask is not None:
+        return _scatter(mask, params), _scatter(mask, converged, fill=False)
+    return params, converged
+
+
+def _fit_linear(
+    model: _TissueModel,
+    ct: NDArray[np.floating],
+    Ta: Union[np.floating, NDArray[np.floating]],
+) -> Tuple[NDArray[np.floating], NDArray[np.bool_]]:
+    """Linear least-squares fit of a Tofts model to a batch of curves.
+
+    Integrating the model equations gives a linear relation between the tissue
+    concentrations and the time integrals of the AIF and the tissue concentrations:
+
+    ct = Ktrans * int(ca) - kep * int(ct)
+
+    for the Tofts model, and with an additional vp * ca + kep * vp * int(ca) for the
+    Extended Tofts model (Murase 2004). The integrals are calculated with the trapezoidal
+    rule on the time grid of the model, and the normal equations of all voxels are
+    solved together. Ta is the delay time of the model, or of each curve.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.bool_]]: parameters of shape (n, n_params)
+            and flags marking voxels with positive Ktrans and ve.
+    """
+    t = model.t
+    ca = model._aif().ca if np.ndim(Ta) == 0 else _shift_aif(t, model.ca, Ta)
+    ca_int = cumulative_trapezoid(ca, t, initial=0)
+    ct_int = cumulative_trapezoid(ct, t, initial=0)
+
+    # Regressors of each voxel, shape (n, T, k)
+    columns = [np.broadcast_to(ca_int, ct.shape), -ct_int]
+    if "vp" in model.parameter_names:
+        columns.append(np.broadcast_to(ca, ct.shape))
+    X = np.stack(columns, axis=-1)
+    A = np.einsum("nti,ntj->nij", X, X)
+    b = np.einsum("nti,nt->ni", X, ct)
+    # Small ridge to keep degenerate (e.g. all-zero) curves solvable
+    ridge = 1e-12 * np.trace(A, axis1=1, axis2=2)[:, np.newaxis, np.newaxis] + 1e-300
+    beta = np.linalg.solve(A + ridge * np.eye(len(columns)), b[..., np.newaxis])[..., 0]
+
+    kep = beta[:, 1]
+    if "vp" in model.parameter_names:
+        vp = beta[:, 2]
+        Ktrans = beta[:, 0] - kep * vp
+    else:
+        Ktrans = beta[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ve = np.where(kep > 0, Ktrans / kep, 0.0)
+    valid = (Ktrans > 0) & (kep > 0)
+
+    params = [Ktrans * 60, ve]  # Ktrans from 1/sec to 1/min
+    if "vp" in model.parameter_names:
+        params.append(vp)
+    return np.stack(params, axis=-1), valid
+
+
+def _levenberg_marquardt(
+    fun: Callable,
+    y: NDArray[np.floating],
+    p0: NDArray[np.floating],
+    lower: NDArray[np.floating],
+    upper: NDArray[np.floating],
+    max_iter: int = 100,
+    tol: np.floating = 1e-8,
+) -> Tuple[NDArray[np.floating], NDArray[np.bool_]]:
+    """Bounded Levenberg-Marquardt least-squares fit of many independent problems.
+
+    Each problem (voxel) has its own damping factor and convergence test, and only the
+    problems that have not converged are evaluated in each iteration. Bounds are
+    enforced by projecting each step onto the feasible box.
+
+    Args:
+        fun (Callable): fun(p, index) returns the model values of shape (n, m) and their
+            Jacobians of shape (n, m, k) for the parameters p of shape (n, k) of the
+            problems with the given indices.
+        y (NDArray[np.floating]): data of shape (N, m).
+        p0 (NDArray[np.floating]): initial values of shape (N, k).
+        lower (NDArray[np.floating]): lower bounds of shape (k,).
+        upper (NDArray[np.floating]): upper bounds of shape (k,).
+        max_iter (int, optional): maximum number of iterations. Defaults to 100.
+        tol (np.floating, optional): relative reduction of the cost, or relative change
+            of the parameters, below which a problem is converged. Defaults to 1e-8.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.bool_]]: fitted parameters of shape (N, k)
+            and convergence flags of shape (N,). Problems with a non-finite cost at p0,
+            e.g. with NaN data, keep their initial values and are not converged.
+    """
+    n, k = p0.shape
+    p = np.clip(p0, lower, upper)
+    f, jac = fun(p, np.arange(n))
+    jac = np.ascontiguousarray(jac)  # rows of problems, copied into the buffers below
+    r = f - y
+    cost = np.sum(r**2, axis=-1)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    # Problems with non-finite data or model values cannot be fitted and are not
+    # converged. The cost of the others stays finite, as steps only reduce it.
+    active = np.flatnonzero(np.isfinite(cost))
+
+    # Buffers of the active problems, allocated once and reused by all iterations. The
+    # indices are valid, so that np.take need not buffer its output to check them.
+    J_buffer = np.empty_like(jac)
+    r_buffer = np.empty_like(r)
+    A_buffer = np.empty((n, k, k))
+    g_buffer = np.empty((n, k, 1))
+    diagonal = np.arange(k)
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        n_active = len(active)
+
+        # Damped normal equations, scaled by the diagonal of J^T J
+        J = np.take(jac, active, axis=0, out=J_buffer[:n_active], mode="clip")
+        r_active = np.take(r, active, axis=0, out=r_buffer[:n_active], mode="clip")
+        J_T = J.transpose(0, 2, 1)
+        A = np.matmul(J_T, J, out=A_buffer[:n_active])
+        g = np.matmul(J_T, r_active[..., np.newaxis], out=g_buffer[:n_active])[..., 0]
+        diag = np.diagonal(A, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-12 * np.max(diag, axis=-1, keepdims=True) + 1e-300)
+        A[:, diagonal, diagonal] += damping[active, np.newaxis] * diag
+        step = -np.linalg.solve(A, g[..., np.newaxis])[..., 0]
+
+        p_new = np.clip(p[active] + step, lower, upper)
+        f_new, jac_new = fun(p_new, active)
+        # Residuals in place of the model values
+        y_active = np.take(y, active, axis=0, out=r_buffer[:n_active], mode="clip")
+        r_new = np.subtract(f_new, y_active, out=f_new)
+        cost_new = np.einsum("nm,nm->n", r_new, r_new)
+
+        # Accept steps that reduce the cost and relax their damping
+        better = cost_new < cost[active]
+        accepted = active[better]
+        small = cost[accepted] - cost_new[better] <= tol * cost[accepted]
+        small |= np.all(
+            np.abs(p_new[better] - p[accepted]) <= tol * (np.abs(p[accepted]) + tol), axis=-1
+        )
+        p[accepted] = p_new[better]
+        r[accepted] = r_new[better]
+        jac[accepted] = jac_new[better]
+        cost[accepted] = cost_new[better]
+        damping[accepted] /= 10
+        converged[accepted[small]] = True
+
+        # Increase damping of rejected steps. A voxel where no step reduces the cost
+        # even with very strong damping is at a (possibly bounded) minimum.
+        rejected = active[~better]
+        damping[rejected] *= 10
+        converged[rejected[damping[rejected] > 1e10]] = True
+
+        active = active[~converged[active]]
+
+    return p, converged
@@ -0,0 +1,238 @@
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ._signal import signal_SPGR
+
+# Number of SPGR tables kept in memory by `R1LookupTable.from_SPGR`
+_TABLE_CACHE_SIZE = 8
+_table_cache = OrderedDict()
+
+# Number of R1 values at which the signal model is checked to be monotone
+_MONOTONE_SAMPLES = 10001
+
+
+class R1LookupTable:
+    """Table of R1 against the normalized signal of a signal model, for its inversion.
+
+    The signal model is a function f(R1) that gives the signal up to a factor that is
+    constant in each voxel, so that the signal of a voxel is S = K * f(R1). The table
+    holds R1 at equally spaced values of f, so that the R1 of a signal is found by linear
+    interpolation between the two nodes around it, which are found without a search.
+    The factor K follows from the pre-contrast signal and R10 of each voxel, which makes
+    the table independent of the voxel. This inverts signal models without a closed-form
+    inverse. For the SPGR model itself, the table is slower than the analytical
+    inversion, by about a third in NumPy.
+
+    The R1 of the nodes are found by bisection, so f need not have a closed-form
+    inverse, but it must be strictly monotone on R1_range. The number of nodes is doubled
+    until the interpolated R1 at the midpoints of all intervals is within tol of the
+    exact R1, where the interpolation error of a smooth model is largest.
+
+    Args:
+        signal (Callable): normalized signal f(R1) as a function of an array of R1 in
+            units of /s.
+        R1_range (Tuple[np.floating, np.floating], optional): Smallest and largest R1 in
+            units of /s. Defaults to (0, 50).
+        tol (np.floating, optional): Largest interpolation error of R1 in units of /s.
+            Defaults to 1e-3.
+        max_nodes (int, optional): Largest number of nodes, beyond which a ValueError is
+            raised. Defaults to 2**24.
+
+    Attributes:
+        R1 (NDArray[np.floating]): R1 in units of /s at the nodes.
+        signal_range (Tuple[np.floating, np.floating]): normalized signal of the first and
+            last node.
+        error (np.floating): Largest interpolation error of R1 at the midpoints of the
+            intervals in units of /s.
+
+    See Also:
+        `S_to_R1_SPGR`
+
+    Example:
+
+        Invert SPGR signals with T2* decay at an echo time of 2 ms, where R2* increases
+        with a relaxivity ratio r2/r1 of 2, and reuse the table in later sessions:
+
+        >>> import osipi
+        >>> TR, TE, a = 0.005, 0.002, 20.0
+        >>> def signal(R1):
+        ...     return osipi.signal_SPGR(R1, 1.0, TR, a) * np.exp(-TE * 2 * R1)
+        >>> table = osipi.R1LookupTable(signal)
+        >>> table.save("spgr_t2star.npz")
+        >>> table = osipi.R1LookupTable.load("spgr_t2star.npz")
+        >>> S = np.random.uniform(90, 150, (16, 16, 60))
+        >>> R1 = osipi.S_to_R1_SPGR(S, S[..., 0], 1.0, TR, a, method=table)
+
+    """
+
+    def __init__(
+        self,
+        signal: Callable,
+        R1_range: Tuple[np.floating, np.floating] = (0.0, 50.0),
+        tol: np.floating = 1e-3,
+        max_nodes: int = 2**24,
+    ):
+        R1_min, R1_max = (float(x) for x in R1_range)
+        if not R1_min < R1_max:
+            raise ValueError("R1_range must be an increasing pair of values")
+        if not tol > 0:
+            raise ValueError("tol must be positive")
+        y = signal(np.linspace(R1_min, R1_max, _MONOTONE_SAMPLES))
+        dy = np.diff(y)
+        if not (np.all(dy > 0) or np.all(dy < 0)):
+            raise ValueError("The signal model must be strictly monotone on R1_range")
+        invert = partial(_bisect, signal, R1_range=(R1_min, R1_max), tol=tol / 100)
+
+        n = 257
+        while True:
+            y = np.linspace(signal(R1_min), signal(R1_max), n)
+            R1 = invert(y)
+            R1_mid = invert((y[:-1] + y[1:]) / 2)
+            error = np.max(np.abs((R1[:-1] + R1[1:]) / 2 - R1_mid))
+            if error <= tol:
+                break
+            if n >= max_nodes:
+                raise ValueError(f"R1 is not within tol with {max_nodes} nodes")
+            n = 2 * n - 1
+        self.R1 = R1
+        self.signal_range = (float(y[0]), float(y[-1]))
+        self.error = float(error)
+        self._pad()
+
+    @classmethod
+    def from_SPGR(
+        cls,
+        TR: np.floating,
+        a: np.floating,
+        R1_range: Tuple[np.floating, np.floating] = (0.0, 50.0),
+        tol: np.floating = 1e-3,
+    ) -> "R1LookupTable":
+        """Table of the SPGR model, cached for each protocol.
+
+        Args:
+            TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
+            a (np.floating): Actual flip angle in units of deg. [OSIPI code Q.MS1.007]
+            R1_range (Tuple[np.floating, np.floating], optional): Smallest and largest R1
+                in units of /s. Defaults to (0, 50).
+            tol (np.floating, optional): Largest interpolation error of R1 in units of /s.
+                Defaults to 1e-3.
+
+        Returns:
+            R1LookupTable: table of `signal_SPGR` with S0 = 1, which is shared by all
+                calls with the same arguments.
+        """
+        key = (float(TR), float(a), tuple(float(x) for x in R1_range), float(tol))
+        if key in _table_cache:
+            _table_cache.move_to_end(key)
+        else:
+            signal = partial(signal_SPGR, S0=1.0, TR=TR, a=a)
+            _table_cache[key] = cls(signal, R1_range, tol)
+            if len(_table_cache) > _TABLE_CACHE_SIZE:
+                _table_cache.popitem(last=False)
+        return _table_cache[key]
+
+    def __call__(
+        self, y: NDArray[np.floating], out: NDArray[np.floating] = None
+    ) -> NDArray[np.floating]:
+        """R1 of normalized signals, NaN outside the range of the table.
+
+        The signal of the last node is taken to be outside the table.
+
+        Args:
+            y (NDArray[np.floating]): normalized signals.
+            out (NDArray[np.floating], optional): floating point array of the shape of y
+                to store R1 in, which may be y itself. Defaults to a new array.
+
+        Returns:
+            NDArray[np.floating]: R1 in units of /s of the shape of y.
+        """
+        y = np.asarray(y, dtype=float)
+        if out is None:
+            out = np.empty(y.shape)
+        # Position in the padded table, with interval i between nodes i - 1 and i
+        np.multiply(y, self._scale, out=out)
+        out += self._offset
+        with np.errstate(invalid="ignore"):
+            index = out.astype(np.intp)  # NaN signals are clipped to the padding
+        np.clip(index, 0, len(self._slope) - 1, out=index)
+        out -= index  # position within the interval
+        out *= self._slope[index]
+        out += self._intercept[index]
+        return out
+
+    def _pad(self):
+        """Intercepts and slopes of the intervals, padded with NaN for signals outside."""
+        n = len(self.R1)
+        y_first, y_last = self.signal_range
+        self._scale = (n - 1) / (y_last - y_first)
+        self._offset = 1 - y_first * self._scale
+        self._intercept = np.concatenate([[np.nan], self.R1[:-1], [np.nan]])
+        self._slope = np.concatenate([[np.nan], np.diff(self.R1), [np.nan]])
+
+    def signal(self, R1: NDArray[np.floating]) -> NDArray[np.floating]:
+        """Normalized signals of R1, interpolated between the nodes.
+
+        This is the exact inverse of calling the table, so that the pre-contrast signal
+        of a voxel maps back to its R10.
+
+        Args:
+            R1 (NDArray[np.floating]): R1 in units of /s.
+
+        Returns:
+            NDArray[np.floating]: normalized signals of the shape of R1, NaN outside
+                R1_range.
+        """
+        y = np.linspace(*self.signal_range, len(self.R1))
+        R1_nodes = self.R1
+        if R1_nodes[0] > R1_nodes[-1]:
+            y, R1_nodes = y[::-1], R1_nodes[::-1]
+        return np.interp(R1, R1_nodes, y, left=np.nan, right=np.nan)
+
+    def save(self, path: str):
+        """Save the table to a .npz file.
+
+        Args:
+            path (str): file to save to.
+        """
+        np.savez(path, R1=self.R1, signal_range=self.signal_range, error=self.error)
+
+    @classmethod
+    def load(cls, path: str) -> "R1LookupTable":
+        """Load a table saved with `save`.
+
+        Args:
+            path (str): file the table was saved to.
+
+        Returns:
+            R1LookupTable: the loaded table.
+        """
+        self = cls.__new__(cls)
+        with np.load(path) as data:
+            self.R1 = data["R1"]
+            self.signal_range = tuple(float(y) for y in data["signal_range"])
+            self.error = float(data["error"])
+        self._pad()
+        return self
+
+
+def _bisect(
+    signal: Callable,
+    y: NDArray[np.floating],
+    R1_range: Tuple[np.floating, np.floating],
+    tol: np.floating,
+) -> NDArray[np.floating]:
+    """R1 of the normalized signals y of a monotone signal model, to within tol."""
+    R1_min, R1_max = R1_range
+    increasing = signal(R1_max) > signal(R1_min)
+    lower = np.full(y.shape, R1_min)
+    upper = np.full(y.shape, R1_max)
+    for _ in range(int(np.ceil(np.log2((R1_max - R1_min) / tol)))):
+        R1 = (lower + upper) / 2
+        below = (signal(R1) < y) == increasing
+        lower = np.where(below, R1, lower)
+        upper = np.where(below, upper, R1)
+    return (lower + upper) / 2
@@ -0,0 +1,63 @@
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+def _check_mask(mask: NDArray[np.bool_], shape: Tuple[int, ...] = None) -> NDArray[np.bool_]:
+    """Boolean mask of the voxels to compute, checked against the shape of the voxels."""
+    mask = np.asarray(mask, dtype=bool)
+    if shape is not None and mask.shape != tuple(shape):
+        raise ValueError(f"mask of shape {mask.shape} does not match the {tuple(shape)} voxels")
+    return mask
+
+
+def _compact(
+    mask: NDArray[np.bool_], values: Union[np.floating, NDArray[np.floating]], trailing: int = 0
+) -> Union[np.floating, NDArray[np.floating]]:
+    """Values of the voxels in mask, stacked along the first axis.
+
+    Args:
+        mask (NDArray[np.bool_]): mask of shape (...).
+        values (np.floating or NDArray[np.floating]): values of shape (...) + trailing
+            dimensions, or broadcastable to it.
+        trailing (int, optional): number of trailing dimensions that are not voxel
+            dimensions, e.g. 1 for a time axis. Defaults to 0.
+
+    Returns:
+        np.floating or NDArray[np.floating]: values of shape (n,) + trailing dimensions,
+            where n is the number of voxels in the mask. Values without voxel
+            dimensions are shared by all voxels and returned unchanged.
+    """
+    values = np.asarray(values)
+    if values.ndim <= trailing:
+        return values
+    values = np.broadcast_to(values, mask.shape + values.shape[values.ndim - trailing :])
+    return values[mask]
+
+
+def _scatter(
+    mask: NDArray[np.bool_],
+    values: NDArray,
+    fill: Union[np.floating, bool] = 0,
+    out: NDArray = None,
+) -> NDArray:
+    """Inverse of `_compact`: values of the voxels in mask, and fill everywhere else.
+
+    Args:
+        mask (NDArray[np.bool_]): mask of shape (...).
+        values (NDArray): values of shape (n,) + trailing dimensions, where n is the number
+            of voxels in the mask.
+        fill (np.floating or bool, optional): value of the voxels outside the mask.
+            Defaults to 0.
+        out (NDArray, optional): array of shape (...) + trailing dimensions to store the
+            result in. Defaults to a new array.
+
+    Returns:
+        NDArray: values of shape (...) + trailing dimensions.
+    """
+    if out is None:
+        out = np.empty(mask.shape + values.shape[1:], dtype=values.dtype)
+    out[~mask] = fill
+    out[mask] = values
+    return out
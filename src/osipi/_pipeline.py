@@ -0,0 +1,170 @@
+import os
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ._fitting import fit_extended_tofts, fit_tofts
+from ._mask import _check_mask
+from ._signal_to_concentration import S_to_C_via_R1_SPGR
+from ._time_grid import TimeGrid, as_time_grid
+
+# Number of double precision values held in memory while a chunk is processed, per
+# voxel, time point and column of the Jacobian of the fit (the parameters plus the
+# residuals): the signals, the concentrations, and the working arrays of the fit
+_VALUES_PER_SAMPLE = 8
+
+
+def fit_volume(
+    t: Union[NDArray[np.floating], TimeGrid],
+    S: Union[str, NDArray[np.floating]],
+    ca: NDArray[np.floating],
+    S_baseline: Union[np.floating, NDArray[np.floating]],
+    R10: Union[np.floating, NDArray[np.floating]],
+    TR: np.floating,
+    a: Union[np.floating, NDArray[np.floating]],
+    r1: np.floating,
+    path: str,
+    model: str = "tofts",
+    B1: Union[np.floating, NDArray[np.floating]] = 1.0,
+    Ta: Union[np.floating, NDArray[np.floating]] = 30.0,
+    memory: int = 2**30,
+    mask: NDArray[np.bool_] = None,
+    **fit_options,
+) -> Tuple[np.memmap, ...]:
+    """Fit a tissue model to a signal series that may be larger than the memory.
+
+    The signals are read in chunks of voxels, converted to concentrations with
+    `S_to_C_via_R1_SPGR` and fitted with `fit_tofts` or `fit_extended_tofts`. The
+    concentrations and the parameter maps are written to memory-mapped .npy files, so
+    that only one chunk is held in memory at a time. The number of voxels per chunk is
+    chosen so that the arrays of a chunk stay within the memory budget.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid):
+            array of time points in units of sec. [OSIPI code Q.GE1.004]
+        S (str or NDArray[np.floating]): Magnitude signals in a.u. of shape (..., len(t)),
+            e.g. a np.memmap, or the path of a .npy file, which is memory-mapped.
+            [OSIPI code Q.MS1.001]
+        ca (NDArray[np.floating]):
+            Arterial concentrations in mM for each time point in t. [OSIPI code Q.IC1.001]
+        S_baseline (np.floating or NDArray[np.floating]): Pre-contrast magnitude signal
+            in a.u., of shape (...) or broadcastable to it. [OSIPI code Q.MS1.001]
+        R10 (np.floating or NDArray[np.floating]): Native longitudinal relaxation rate in
+            units of /s, of shape (...) or broadcastable to it. [OSIPI code Q.EL1.002]
+        TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
+        a (np.floating or NDArray[np.floating]): Prescribed flip angle in units of deg,
+            of shape (...) or broadcastable to it. [OSIPI code Q.MS1.007]
+        r1 (np.floating): Longitudinal relaxivity in units of /s/mM. [OSIPI code Q.EL1.015]
+        path (str): directory to write the outputs to, created if it does not exist.
+        model (str, optional): 'tofts' (default) or 'extended_tofts'.
+        B1 (np.floating or NDArray[np.floating], optional): Ratio of the actual to the
+            prescribed flip angle, of shape (...) or broadcastable to it. Defaults to 1.
+        Ta (np.floating or NDArray[np.floating], optional): Arterial delay time in units
+            of sec, of shape (...) or broadcastable to it. Defaults to 30 seconds.
+            [OSIPI code Q.PH1.007]
+        memory (int, optional): Memory budget in bytes for the arrays of a chunk.
+            Defaults to 1 GiB.
+        mask (NDArray[np.bool_], optional): Voxels to process, of shape (...). Only
+            their signals are read, and the other voxels get zero concentrations and
+            parameters and False flags. Defaults to all voxels.
+        **fit_options: further arguments of `fit_tofts` or `fit_extended_tofts`, e.g.
+            the fitting method. They apply to all voxels.
+
+    Returns:
+        Tuple[np.memmap, ...]: Memory-mapped maps of Ktrans in units of 1/min, ve,
+            vp (Extended Tofts model only) and convergence flags, each of shape (...),
+            followed by the concentrations in mM of shape (..., len(t)). They are saved
+            in path as Ktrans.npy, ve.npy, vp.npy, converged.npy and C.npy.
+
+    See Also:
+        `S_to_C_via_R1_SPGR`
+        `fit_tofts`
+        `fit_extended_tofts`
+
+    Example:
+
+        Fit a series stored as .npy with a budget of 256 MiB, using one R10 map:
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1.0)
+        >>> ca = osipi.aif_parker(t)
+        >>> S = np.load("signal.npy", mmap_mode="r")  # doctest: +SKIP
+        >>> R10 = np.load("R10.npy")  # doctest: +SKIP
+        >>> Ktrans, ve, converged, C = osipi.fit_volume(
+        ...     t, S, ca, S[..., 0], R10, 0.002, 13, 4.5, "results", memory=2**28
+        ... )  # doctest: +SKIP
+
+    """
+    if model not in ("tofts", "extended_tofts"):
+        raise ValueError(f"Unknown model '{model}'")
+    fit = fit_extended_tofts if model == "extended_tofts" else fit_tofts
+    names = ["Ktrans", "ve", "vp"] if model == "extended_tofts" else ["Ktrans", "ve"]
+
+    S = np.load(S, mmap_mode="r") if isinstance(S, str) else np.asarray(S)
+    if not S.flags.c_contiguous:
+        raise ValueError("S must be stored in C order")
+    grid = as_time_grid(t)
+    n_time = len(grid)
+    if S.shape[-1:] != (n_time,):
+        raise ValueError("S must have one signal for each time point in t")
+    shape = S.shape[:-1]
+    n_voxels = int(np.prod(shape))
+
+    os.makedirs(path, exist_ok=True)
+
+    def output(name, shape, dtype=float):
+        file = os.path.join(path, name + ".npy")
+        return np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=shape)
+
+    params = [output(name, shape) for name in names]
+    converged = output("converged", shape, dtype=bool)
+    C = output("C", S.shape)
+
+    # Voxels are taken in storage order, without copying the memory-mapped series
+    S_rows = S.reshape(n_voxels, n_time)
+    C_rows = C.reshape(n_voxels, n_time)
+    maps = [_voxel_rows(m, shape) for m in (S_baseline, R10, a, B1, Ta)]
+    if mask is not None:
+        index = np.flatnonzero(_check_mask(mask, shape))
+    n_fit = n_voxels if mask is None else len(index)
+    chunk = max(1, memory // (8 * _VALUES_PER_SAMPLE * n_time * (len(names) + 1)))
+    for start in range(0, n_fit, chunk):
+        rows = slice(start, start + chunk)
+        voxels = rows if mask is None else index[rows]
+        S_chunk = np.asarray(S_rows[voxels], dtype=float)
+        S_baseline_chunk, R10_chunk, a_chunk, B1_chunk, Ta_chunk = (m[voxels] for m in maps)
+        # Concentrations of a contiguous chunk are written straight to the output,
+        # those of scattered voxels over their (copied) signals
+        C_chunk = S_to_C_via_R1_SPGR(
+            S_chunk,
+            S_baseline_chunk,
+            R10_chunk,
+            TR,
+            a_chunk,
+            r1,
+            B1=B1_chunk,
+            out=C_rows[voxels] if mask is None else S_chunk,
+        )
+        if mask is not None:
+            C_rows[voxels] = C_chunk
+        *p, flags = fit(grid, C_chunk, ca, Ta=_constant(Ta_chunk), **fit_options)
+        for param, p_chunk in zip(params, p):
+            param.reshape(n_voxels)[voxels] = p_chunk
+        converged.reshape(n_voxels)[voxels] = flags
+
+    for array in params + [converged, C]:
+        array.flush()
+    return tuple(params) + (converged, C)
+
+
+def _voxel_rows(
+    values: Union[np.floating, NDArray[np.floating]], shape: Tuple[int, ...]
+) -> NDArray[np.floating]:
+    """Values of a voxel map as a flat array, a view if the map has the full shape."""
+    return np.broadcast_to(np.asarray(values), shape).reshape(-1)
+
+
+def _constant(values: NDArray[np.floating]) -> Union[np.floating, NDArray[np.floating]]:
+    """A single value if all values are equal, so that models are shared by the voxels."""
+    return values[0] if np.all(values == values[0]) else values
@@ -1,3 +1,5 @@
+from typing import Tuple, Union
+
 import numpy as np
 from numpy.typing import NDArray
 
@@ -44,3 +46,22 @@ def signal_SPGR(
     a_rad = a * np.pi / 180
     exp_TR_R1 = np.exp(-TR * R1)
     return S0 * (((1.0 - exp_TR_R1) * np.sin(a_rad)) / (1.0 - exp_TR_R1 * np.cos(a_rad)))  # S
+
+
+def _spgr(
+    R1: NDArray[np.floating],
+    S0: NDArray[np.floating],
+    TR: np.floating,
+    a: NDArray[np.floating],
+    jacobian: bool = False,
+) -> Union[NDArray[np.floating], Tuple[NDArray[np.floating], NDArray[np.floating]]]:
+    """`signal_SPGR` for flip angles a in rad, and its derivatives to (R1, S0)."""
+    S = signal_SPGR(R1, S0, TR, a * 180 / np.pi)
+    if not jacobian:
+        return S
+    E = np.exp(-TR * R1)
+    cos_a = np.cos(a)
+    dS_dS0 = signal_SPGR(R1, 1.0, TR, a * 180 / np.pi)
+    dS_dE = S0 * np.sin(a) * (cos_a - 1) / (1 - E * cos_a) ** 2
+    dS_dR1 = -TR * E * dS_dE
+    return S, np.stack(np.broadcast_arrays(dS_dR1, dS_dS0), axis=-1)
@@ -0,0 +1,196 @@
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ._fitting import _fit_model
+from ._signal import _spgr
+from ._tissue import _TissueModel
+
+
+class SPGRSignalModel:
+    """SPGR signals of a tissue model, for fitting in the signal domain.
+
+    The tissue concentrations C of the tissue model are converted to longitudinal
+    relaxation rates with the linear relaxivity model, R1 = R10 + r1 * C, and to
+    signals with the SPGR model (see `signal_SPGR`). The derivatives with respect to
+    the model parameters follow from the chain rule, so that signal curves can be fitted
+    directly, without converting them to concentrations first. The concentrations of a
+    block of voxels only exist while the block is evaluated.
+
+    Args:
+        tissue_model (ToftsModel or ExtendedToftsModel): model of the tissue
+            concentrations, including the time points, AIF and arterial delay.
+        R10 (np.floating or NDArray[np.floating]): Native longitudinal relaxation rate in
+            units of /s, a single value or one per voxel. [OSIPI code Q.EL1.002]
+        S0 (np.floating or NDArray[np.floating]): Fully T1-relaxed signal in a.u., a
+            single value or one per voxel, e.g. from `S_to_R10_VFA`. [OSIPI code Q.MS1.010]
+        TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
+        a (np.floating or NDArray[np.floating]): Prescribed flip angle in units of deg,
+            a single value or one per voxel. [OSIPI code Q.MS1.007]
+        r1 (np.floating): Longitudinal relaxivity in units of /s/mM. [OSIPI code Q.EL1.015]
+        B1 (np.floating or NDArray[np.floating], optional): Ratio of the actual to the
+            prescribed flip angle, a single value or one per voxel. Defaults to 1.
+
+    Attributes:
+        parameter_names (Tuple[str, ...]): names of the parameters of the tissue model.
+
+    See Also:
+        `signal_SPGR`
+        `ToftsModel`
+        `ExtendedToftsModel`
+
+    Example:
+
+        Fit the Tofts model to noisy signals of 1000 voxels with their own R10 and S0:
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 2.0)
+        >>> tissue_model = osipi.ToftsModel(t, osipi.aif_parker(t))
+        >>> R10 = np.random.uniform(0.5, 1.5, 1000)
+        >>> S0 = np.random.uniform(500, 1500, 1000)
+        >>> model = osipi.SPGRSignalModel(tissue_model, R10, S0, 0.002, 13.0, 4.5)
+        >>> params = np.stack([np.random.uniform(0.05, 0.6, 1000), np.full(1000, 0.3)], -1)
+        >>> S = model.evaluate(params)
+        >>> S += np.random.normal(0, 1, S.shape)
+        >>> Ktrans, ve, converged = model.fit(S)
+
+    """
+
+    def __init__(
+        self,
+        tissue_model: _TissueModel,
+        R10: Union[np.floating, NDArray[np.floating]],
+        S0: Union[np.floating, NDArray[np.floating]],
+        TR: np.floating,
+        a: Union[np.floating, NDArray[np.floating]],
+        r1: np.floating,
+        B1: Union[np.floating, NDArray[np.floating]] = 1.0,
+    ):
+        self.tissue_model = tissue_model
+        self.R10 = np.asarray(R10, dtype=float)
+        self.S0 = np.asarray(S0, dtype=float)
+        self.TR = TR
+        self.a = np.asarray(a, dtype=float)
+        self.r1 = r1
+        self.B1 = np.asarray(B1, dtype=float)
+
+    @property
+    def parameter_names(self) -> Tuple[str, ...]:
+        return self.tissue_model.parameter_names
+
+    @property
+    def t(self) -> NDArray[np.floating]:
+        """Array of time points in units of sec."""
+        return self.tissue_model.t
+
+    @property
+    def _voxel_arguments(self) -> dict:
+        """Arguments of `_evaluate` that may have one value per voxel."""
+        return {
+            **self.tissue_model._voxel_arguments,
+            "R10": self.R10,
+            "S0": self.S0,
+            "a": self.B1 * self.a * np.pi / 180,  # actual flip angles in rad
+        }
+
+    def __call__(self, params: NDArray[np.floating]) -> NDArray[np.floating]:
+        """Signals for one set of parameters.
+
+        Args:
+            params (NDArray[np.floating]): parameter values in the order of
+                `parameter_names`.
+
+        Returns:
+            NDArray[np.floating]: Magnitude signals in a.u. for each time point in t.
+        """
+        return self.evaluate(params)
+
+    def evaluate(
+        self, params: NDArray[np.floating], jacobian: bool = False
+    ) -> Union[NDArray[np.floating], Tuple[NDArray[np.floating], NDArray[np.floating]]]:
+        """Signals for a batch of parameter sets.
+
+        Args:
+            params (NDArray[np.floating]): array of shape (..., n) with the n parameter
+                values of each voxel in the last dimension, in the order of
+                `parameter_names`. The shape (...) is broadcast against the maps of R10,
+                S0, a and B1.
+            jacobian (bool, optional): If True, also return the derivatives with respect
+                to the parameters. Defaults to False.
+
+        Returns:
+            NDArray[np.floating]: Magnitude signals in a.u. of shape (..., len(t)).
+
+            NDArray[np.floating]: Only if jacobian is True. Derivatives with respect to
+                the parameters, of shape (..., len(t), n).
+        """
+        params = np.asarray(params, dtype=float)
+        if params.shape[-1:] != (len(self.parameter_names),):
+            raise ValueError(
+                f"params must have {len(self.parameter_names)} values in the last dimension"
+            )
+        return self._evaluate(params, jacobian, **self._voxel_arguments)
+
+    def _evaluate(
+        self,
+        params: NDArray[np.floating],
+        jacobian: bool,
+        R10: Union[np.floating, NDArray[np.floating]],
+        S0: Union[np.floating, NDArray[np.floating]],
+        a: Union[np.floating, NDArray[np.floating]],
+        **tissue_arguments,
+    ) -> Union[NDArray[np.floating], Tuple[NDArray[np.floating], NDArray[np.floating]]]:
+        """`evaluate` with the given voxel maps, e.g. for a block of voxels."""
+        result = self.tissue_model._evaluate(params, jacobian, **tissue_arguments)
+        C, jac_C = result if jacobian else (result, None)
+        R10, S0, a = (np.asarray(x)[..., np.newaxis] for x in (R10, S0, a))
+        R1 = R10 + self.r1 * C
+        if not jacobian:
+            return _spgr(R1, S0, self.TR, a)
+        S, jac_spgr = _spgr(R1, S0, self.TR, a, jacobian=True)
+        dS_dC = self.r1 * jac_spgr[..., 0]
+        return S, dS_dC[..., np.newaxis] * jac_C
+
+    def fit(
+        self,
+        S: NDArray[np.floating],
+        p0: NDArray[np.floating] = None,
+        bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]] = None,
+        max_iter: int = 100,
+        tol: np.floating = 1e-8,
+        mask: NDArray[np.bool_] = None,
+    ) -> Tuple[NDArray[np.floating], ...]:
+        """Voxel-wise Levenberg-Marquardt fit of the signals.
+
+        Args:
+            S (NDArray[np.floating]): Magnitude signals in a.u. of shape (..., len(t)),
+                one curve per voxel, with (...) broadcastable against the maps of R10,
+                S0, a and B1. [OSIPI code Q.MS1.001]
+            p0 (NDArray[np.floating], optional): Initial values of the parameters, one
+                set for all voxels or an array of shape (..., n). Defaults to the
+                initial values of `fit_tofts` or `fit_extended_tofts`.
+            bounds (Tuple, optional): Lower and upper bounds of the parameters.
+                Defaults to the bounds of `fit_tofts` or `fit_extended_tofts`.
+            max_iter (int, optional): Maximum number of iterations. Defaults to 100.
+            tol (np.floating, optional): Convergence tolerance, see `fit_tofts`.
+                Defaults to 1e-8.
+            mask (NDArray[np.bool_], optional): Voxels to fit, of shape (...). The other
+                voxels are not fitted and get zero parameters and False flags. Defaults
+                to all voxels.
+
+        Returns:
+            Tuple[NDArray[np.floating], ...]: Maps of each parameter in the order of
+                `parameter_names`, followed by the convergence flags, each of shape (...).
+        """
+        S = np.asarray(S, dtype=float)
+        if S.shape[-1:] != (len(self.t),):
+            raise ValueError("S must have one signal for each time point in t")
+        n_params = len(self.parameter_names)
+        if p0 is None:
+            p0 = (0.1, 0.2, 0.05)[:n_params]
+        if bounds is None:
+            bounds = ((1e-5, 1e-5, 0.0), (5.0, 1.0, 1.0))
+            bounds = tuple(b[:n_params] for b in bounds)
+        params, converged = _fit_model(self, S, "lm", p0, bounds, max_iter, tol, mask)
+        return tuple(params[..., i] for i in range(n_params)) + (converged,)
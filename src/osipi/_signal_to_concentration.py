@@ -1,16 +1,28 @@
+from typing import Union
+
 import numpy as np
 from numpy.typing import NDArray
 
-from ._electromagnetic_property import R1_to_C_linear_relaxivity
+from ._electromagnetic_property import R1_to_C_linear_relaxivity, _voxel_maps
+from ._lookup_table import R1LookupTable
+from ._mask import _check_mask
+from ._signal import signal_SPGR
+
+# Number of array elements (voxels x time points) converted at once
+_BLOCK_ELEMENTS = 2**16
 
 
 def S_to_C_via_R1_SPGR(
     S: NDArray[np.floating],
-    S_baseline: np.floating,
-    R10: np.floating,
+    S_baseline: Union[np.floating, NDArray[np.floating]],
+    R10: Union[np.floating, NDArray[np.floating]],
     TR: np.floating,
-    a: np.floating,
+    a: Union[np.floating, NDArray[np.floating]],
     r1: np.floating,
+    B1: Union[np.floating, NDArray[np.floating]] = 1.0,
+    out: NDArray[np.floating] = None,
+    mask: NDArray[np.bool_] = None,
+    method: Union[str, R1LookupTable] = "analytical",
 ) -> NDArray[np.floating]:
     """
     Signal to concentration via
@@ -18,18 +30,53 @@ def S_to_C_via_R1_SPGR(
 
     Converts S -> R1 -> C
 
+    The signals can be a single time series or an array of them, e.g. a 4D DCE series
+    of shape (x, y, z, t), in which case the baseline signal, native relaxation rate,
+    flip angle and B1 correction may be maps of one value per voxel, of shape
+    (x, y, z) or broadcastable to it. Both conversions are applied to blocks of voxels
+    in turn, without temporary arrays of the size of the series, and the
+    concentrations can be written to a preallocated array or over the signals.
+
     Args:
-        S (1D array of np.floating): Vector of magnitude signals in a.u. [OSIPI code Q.MS1.001]
-        S_baseline (np.floating): Pre-contrast magnitude signal in a.u. [OSIPI code Q.MS1.001]
-        R10 (np.floating): Native longitudinal relaxation rate in units of /s. [OSIPI code Q.EL1.002]
+        S (NDArray[np.floating]): Magnitude signals in a.u. of shape (..., n_time).
+            [OSIPI code Q.MS1.001]
+        S_baseline (np.floating or NDArray[np.floating]): Pre-contrast magnitude signal
+            in a.u., of shape (...) or broadcastable to it. [OSIPI code Q.MS1.001]
+        R10 (np.floating or NDArray[np.floating]): Native longitudinal relaxation rate in
+            units of /s, of shape (...) or broadcastable to it. [OSIPI code Q.EL1.002]
         TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
-        a (np.floating): Prescribed flip angle in units of deg. [OSIPI code Q.MS1.007]
+        a (np.floating or NDArray[np.floating]): Prescribed flip angle in units of deg,
+            of shape (...) or broadcastable to it. [OSIPI code Q.MS1.007]
         r1 (np.floating): Longitudinal relaxivity in units of /s/mM. [OSIPI code Q.EL1.015]
+        B1 (np.floating or NDArray[np.floating], optional): Ratio of the actual to the
+            prescribed flip angle, of shape (...) or broadcastable to it. Defaults to 1.
+        out (NDArray[np.floating], optional): C-contiguous floating point array of the
+            shape of S to store the concentrations in, which may be S itself. Defaults to
+            a new array.
+        mask (NDArray[np.bool_], optional): Voxels to convert, of shape (...). The
+            concentrations of the other voxels are set to zero without computing them.
+            Defaults to all voxels.
+        method (str or R1LookupTable, optional): Defines the inversion of the SPGR
+            model. Options include
+
+            – 'analytical': analytical inversion of each signal (default)
+
+            – 'table': linear interpolation in the `R1LookupTable` of the SPGR model
+            for TR and the actual flip angle, with an error of R1 below 1e-3 /s between
+            0 and 50 /s. The scale of each voxel is computed from the exact model. The
+            table is cached, and requires the same actual flip angle in all voxels.
+            It is slower than 'analytical' and serves as a check of the table
+            inversion.
+
+            – an `R1LookupTable`, e.g. of a signal model with T2* decay, which
+            replaces the SPGR model, so that TR, a and B1 are not used. The scale of
+            each voxel is interpolated in the table at R10, so that the error of R1
+            is up to twice the error of the table.
 
     Returns:
          NDArray[np.floating]:
-            Vector of indicator total (across all compartments) indicator
-            concentration in units of mM. [OSIPI code Q.IC1.001]
+            Indicator total (across all compartments) indicator concentration in units
+            of mM, of shape (..., n_time). [OSIPI code Q.IC1.001]
 
     References:
         - Lexicon URL: https://osipi.github.io/OSIPI_CAPLEX/perfusionProcesses/
@@ -45,16 +92,21 @@ def S_to_C_via_R1_SPGR(
             - Forward model:
                 longitudinal relaxation rate, linear with relaxivity model [OSIPI code M.EL1.003]
     """
-    R1 = S_to_R1_SPGR(S, S_baseline, R10, TR, a)  # S -> R1
-    return R1_to_C_linear_relaxivity(R1, R10, r1)  # R1 -> C
+    if not (r1 >= 0):
+        raise ValueError("r1 must be positive")
+    return _S_to_R1_SPGR(S, S_baseline, R10, TR, a, B1, out, mask, method, r1)  # S -> R1 -> C
 
 
 def S_to_R1_SPGR(
     S: NDArray[np.floating],
-    S_baseline: np.floating,
-    R10: np.floating,
+    S_baseline: Union[np.floating, NDArray[np.floating]],
+    R10: Union[np.floating, NDArray[np.floating]],
     TR: np.floating,
-    a: np.floating,
+    a: Union[np.floating, NDArray[np.floating]],
+    B1: Union[np.floating, NDArray[np.floating]] = 1.0,
+    out: NDArray[np.floating] = None,
+    mask: NDArray[np.bool_] = None,
+    method: Union[str, R1LookupTable] = "analytical",
 ) -> NDArray[np.floating]:
     """
     Signal to electromagnetic property conversion (analytical, SPGR, FXL)
@@ -62,14 +114,41 @@ def S_to_R1_SPGR(
     Converts Signal to R1
 
     Args:
-        S (1D array of np.floating): Vector of magnitude signals in a.u. [OSIPI code Q.MS1.001]
-        S_baseline (np.floating): Pre-contrast magnitude signal in a.u. [OSIPI code Q.MS1.001]
-        R10 (np.floating): Native longitudinal relaxation rate in units of /s. [OSIPI code Q.EL1.002]
+        S (NDArray[np.floating]): Magnitude signals in a.u. of shape (..., n_time).
+            [OSIPI code Q.MS1.001]
+        S_baseline (np.floating or NDArray[np.floating]): Pre-contrast magnitude signal
+            in a.u., of shape (...) or broadcastable to it. [OSIPI code Q.MS1.001]
+        R10 (np.floating or NDArray[np.floating]): Native longitudinal relaxation rate in
+            units of /s, of shape (...) or broadcastable to it. [OSIPI code Q.EL1.002]
         TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
-        a (np.floating): Prescribed flip angle in units of deg. [OSIPI code Q.MS1.007]
+        a (np.floating or NDArray[np.floating]): Prescribed flip angle in units of deg,
+            of shape (...) or broadcastable to it. [OSIPI code Q.MS1.007]
+        B1 (np.floating or NDArray[np.floating], optional): Ratio of the actual to the
+            prescribed flip angle, of shape (...) or broadcastable to it. Defaults to 1.
+        out (NDArray[np.floating], optional): C-contiguous floating point array of the
+            shape of S to store R1 in, which may be S itself. Defaults to a new array.
+        mask (NDArray[np.bool_], optional): Voxels to convert, of shape (...). R1 of the
+            other voxels is set to zero without computing it. Defaults to all voxels.
+        method (str or R1LookupTable, optional): Defines the inversion of the SPGR
+            model. Options include
+
+            – 'analytical': analytical inversion of each signal (default)
+
+            – 'table': linear interpolation in the `R1LookupTable` of the SPGR model
+            for TR and the actual flip angle, with an error of R1 below 1e-3 /s between
+            0 and 50 /s. The scale of each voxel is computed from the exact model. The
+            table is cached, and requires the same actual flip angle in all voxels.
+            It is slower than 'analytical' and serves as a check of the table
+            inversion.
+
+            – an `R1LookupTable`, e.g. of a signal model with T2* decay, which
+            replaces the SPGR model, so that TR, a and B1 are not used. The scale of
+            each voxel is interpolated in the table at R10, so that the error of R1
+            is up to twice the error of the table.
 
     Returns:
-        NDArray[np.floating]: Vector of R1 in units of /s. [OSIPI code Q.EL1.001]
+        NDArray[np.floating]: R1 in units of /s of shape (..., n_time).
+            [OSIPI code Q.EL1.001]
 
     References:
         - Lexicon URL: https://osipi.github.io/OSIPI_CAPLEX/perfusionProcesses/#
@@ -79,14 +158,91 @@ def S_to_R1_SPGR(
           - Forward model: Spoiled gradient recalled echo model [OSIPI code M.SM2.002]
         - Adapted from contribution of LEK_UoEdinburgh_UK
     """
-    # Check S is a 1D array of floats
-    if not (isinstance(S, np.ndarray) and S.ndim == 1 and np.issubdtype(S.dtype, np.floating)):
-        raise TypeError("S must be a 1D NumPy array of np.floating")
-
-    a_rad = a * np.pi / 180
-    # Estimate fully T1-relaxed signal S0 in units of a.u. [OSIPI code Q.MS1.010], then R1
-    exp_TR_R10 = np.exp(-TR * R10)
-    sin_a = np.sin(a_rad)
-    cos_a = np.cos(a_rad)
-    S0 = S_baseline * (1 - cos_a * exp_TR_R10) / (sin_a * (1 - exp_TR_R10))
-    return np.log(((S0 * sin_a) - S) / (S0 * sin_a - (S * cos_a))) * (-1 / TR)  # R1
+    return _S_to_R1_SPGR(S, S_baseline, R10, TR, a, B1, out, mask, method)
+
+
+def _S_to_R1_SPGR(
+    S: NDArray[np.floating],
+    S_baseline: Union[np.floating, NDArray[np.floating]],
+    R10: Union[np.floating, NDArray[np.floating]],
+    TR: np.floating,
+    a: Union[np.floating, NDArray[np.floating]],
+    B1: Union[np.floating, NDArray[np.floating]],
+    out: NDArray[np.floating],
+    mask: NDArray[np.bool_],
+    method: Union[str, R1LookupTable],
+    r1: np.floating = None,
+) -> NDArray[np.floating]:
+    """R1, or the concentration if r1 is given, from SPGR signals in blocks of voxels."""
+    if not (isinstance(method, R1LookupTable) or method in ("analytical", "table")):
+        raise ValueError(f"Unknown inversion method '{method}'")
+    # Check S is an array of floats with a time dimension
+    if not (isinstance(S, np.ndarray) and S.ndim >= 1 and np.issubdtype(S.dtype, np.floating)):
+        raise TypeError("S must be a NumPy array of np.floating with at least 1 dimension")
+    if out is None:
+        out = np.empty(S.shape)
+    elif not (
+        isinstance(out, np.ndarray)
+        and out.shape == S.shape
+        and np.issubdtype(out.dtype, np.floating)
+        and out.flags.c_contiguous
+    ):
+        raise ValueError("out must be a C-contiguous floating point array of the shape of S")
+    S_baseline, R10, a, B1 = _voxel_maps(S, S_baseline, R10, a, B1)
+
+    n = S.shape[-1]
+    S_rows = S.reshape(-1, n)
+    out_rows = out.reshape(-1, n)
+    S_baseline, R10, a, B1 = (
+        np.broadcast_to(m, S.shape[:-1] + (1,)).reshape(-1, 1) for m in (S_baseline, R10, a, B1)
+    )
+    if mask is not None:
+        # Only the voxels in the mask are computed, the others are set to zero
+        mask = _check_mask(mask, S.shape[:-1]).reshape(-1)
+        out_rows[~mask] = 0
+        index = np.flatnonzero(mask)
+        S_baseline, R10, a, B1 = (m[index] for m in (S_baseline, R10, a, B1))
+
+    table = method if isinstance(method, R1LookupTable) else None
+    if method == "table":
+        a_actual = B1 * a
+        if not np.all(a_actual == a_actual.flat[0]):
+            raise ValueError("The 'table' method requires the same actual flip angle in all voxels")
+        table = R1LookupTable.from_SPGR(TR, a_actual.flat[0])
+        # Signal of each voxel relative to the normalized signal of the table, S0 for
+        # the SPGR model, from the exact model so that only R1 is interpolated
+        S_scale = S_baseline / signal_SPGR(R10, 1.0, TR, a_actual)
+    elif table is not None:
+        # The model of a table is only known through its nodes
+        S_scale = S_baseline / table.signal(R10)
+    else:
+        # Estimate fully T1-relaxed signal S0 in units of a.u. [OSIPI code Q.MS1.010]
+        # times sin(a) once per voxel, then R1 for all time points
+        a_rad = B1 * a * np.pi / 180
+        exp_TR_R10 = np.exp(-TR * R10)
+        cos_a = np.cos(a_rad)
+        S0_sin_a = S_baseline * (1 - cos_a * exp_TR_R10) / (1 - exp_TR_R10)
+
+    n_voxels = len(R10)
+    block = max(1, _BLOCK_ELEMENTS // n)
+    # Buffers for one block, in double precision whatever the precision of out
+    num, den = np.empty((2, min(block, n_voxels), n))
+    for start in range(0, n_voxels, block):
+        rows = slice(start, start + block)
+        voxels = rows if mask is None else index[rows]
+        S_block = S_rows[voxels]
+        num_block, den_block = num[: len(S_block)], den[: len(S_block)]
+        if table is not None:
+            np.divide(S_block, S_scale[rows], out=num_block)
+            table(num_block, out=num_block)  # R1
+        else:
+            np.subtract(S0_sin_a[rows], S_block, out=num_block)
+            np.multiply(S_block, cos_a[rows], out=den_block)
+            np.subtract(S0_sin_a[rows], den_block, out=den_block)
+            np.divide(num_block, den_block, out=num_block)
+            np.log(num_block, out=num_block)
+            num_block *= -1 / TR  # R1
+        if r1 is not None:
+            R1_to_C_linear_relaxivity(num_block, R10[rows, 0], r1, out=num_block)  # C
+        out_rows[voxels] = num_block
+    return out
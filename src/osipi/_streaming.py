@@ -0,0 +1,148 @@
+from typing import Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class ToftsStream:
+    """Streaming evaluation of the (Extended) Tofts model, one frame at a time.
+
+    Tissue concentrations are computed with the recursion of the exponential convolution
+    (see `exp_conv`), which only needs the previous convolution value and the previous
+    AIF sample. Each new frame therefore costs a constant amount of work per voxel,
+    however many frames were received before, which makes it suitable for predictions
+    that are updated during the acquisition. Only the AIF samples needed for the
+    arterial delay are kept in memory.
+
+    The concentrations are those of `extended_tofts` with the 'exp' discretization
+    method. The only difference is the last time point, which the batch version copies
+    from the one before as the following AIF sample is not known.
+
+    Args:
+        Ktrans (np.floating or NDArray[np.floating]):
+            Volume transfer constant in units of 1/min. [OSIPI code Q.PH1.008]
+        ve (np.floating or NDArray[np.floating]):
+            Relative volume fraction of the extracellular
+            extravascular compartment (e). [OSIPI code Q.PH1.001.[e]]
+        vp (np.floating or NDArray[np.floating], optional):
+            Relative volume fraction of the plasma compartment (p). Defaults to 0,
+            i.e. the Tofts model. [OSIPI code Q.PH1.001.[p]]
+        Ta (np.floating, optional):
+            Arterial delay time in units of sec. Defaults to 30 seconds.
+            [OSIPI code Q.PH1.007]
+
+    Attributes:
+        shape (Tuple[int, ...]): broadcast shape of Ktrans, ve and vp, i.e. of the voxels.
+        n_frames (int): number of frames received so far.
+
+    See Also:
+        `extended_tofts`
+        `exp_conv`
+
+    Example:
+
+        Update the tissue curves of a map of voxels as the AIF samples arrive.
+
+        >>> import osipi
+        >>> t = np.arange(0, 6 * 60, 1)
+        >>> ca = osipi.aif_parker(t)
+        >>> stream = osipi.ToftsStream(np.full((64, 64), 0.6), 0.2, vp=0.05)
+        >>> for i in range(len(t)):
+        ...     ct = stream.update(t[i], ca[i])
+        >>> ct.shape
+        (64, 64, 1)
+
+    """
+
+    def __init__(
+        self,
+        Ktrans: Union[np.floating, NDArray[np.floating]],
+        ve: Union[np.floating, NDArray[np.floating]],
+        vp: Union[np.floating, NDArray[np.floating]] = 0.0,
+        Ta: np.floating = 30.0,
+    ):
+        Ktrans, ve, vp = np.broadcast_arrays(
+            np.asarray(Ktrans, dtype=float),
+            np.asarray(ve, dtype=float),
+            np.asarray(vp, dtype=float),
+        )
+        self.shape = Ktrans.shape
+        self.Ta = float(Ta)
+
+        # Voxels without exchange only see the (undelayed) plasma term, as in `tofts`
+        self._vp = vp.ravel()
+        self._valid = ((Ktrans > 0) & (ve > 0)).ravel()
+        self._ve = ve.ravel()[self._valid]
+        self._Tc = self._ve / (Ktrans.ravel()[self._valid] / 60)
+        self.reset()
+
+    def reset(self):
+        """Discard all frames received so far and start a new series."""
+        self.n_frames = 0
+        self._t = np.empty(0)
+        self._ca = np.empty(0)
+        self._ca_delayed = 0.0
+        self._f = np.zeros(self._Tc.shape)
+
+    def update(
+        self,
+        t: Union[np.floating, NDArray[np.floating]],
+        ca: Union[np.floating, NDArray[np.floating]],
+    ) -> NDArray[np.floating]:
+        """Add one or more frames and return the tissue concentrations at those frames.
+
+        Args:
+            t (np.floating or NDArray[np.floating]): time of the new frames in units of
+                sec, strictly increasing and after the frames received before.
+            ca (np.floating or NDArray[np.floating]): Arterial concentrations in mM at
+                the new frames.
+
+        Returns:
+            NDArray[np.floating]: Tissue concentrations in mM of shape (..., len(t)),
+                where ... is the shape of the voxels.
+        """
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        ca = np.atleast_1d(np.asarray(ca, dtype=float))
+        if t.ndim != 1 or ca.shape != t.shape:
+            raise ValueError("ca must have one concentration for each time point in t")
+        t_all = np.concatenate([self._t, t])
+        if np.any(np.diff(t_all) <= 0):
+            raise ValueError("t must be strictly increasing")
+        ca_all = np.concatenate([self._ca, ca])
+
+        # The delayed AIF at a new frame only needs samples up to that frame
+        n_old = len(self._t)
+        t_new = t_all[n_old:]
+        if self.Ta == 0:
+            ca_delayed = ca
+        else:
+            ca_delayed = (t_new > self.Ta) * np.interp(
+                t_new - self.Ta, t_all, ca_all, left=0, right=0
+            )
+        ca_prev = np.concatenate([[self._ca_delayed], ca_delayed[:-1]])
+
+        ct = self._vp[:, np.newaxis] * ca
+        f = self._f
+        ce = np.zeros((len(f), len(t)))
+        for i in range(len(t)):
+            if n_old + i > 0:
+                # One step of the exponential convolution, see `exp_conv`
+                x = (t_all[n_old + i] - t_all[n_old + i - 1]) / self._Tc
+                E = np.exp(-x)
+                E0 = 1 - E
+                E1 = x - E0
+                da = (ca_delayed[i] - ca_prev[i]) / x
+                f = E * f + ca_prev[i] * E0 + da * E1
+            ce[:, i] = f
+        ct[self._valid] = self._vp[self._valid, np.newaxis] * ca_delayed
+        ct[self._valid] += self._ve[:, np.newaxis] * ce
+
+        # Keep the recursion state and the AIF samples still needed for the delay
+        self._f = f
+        self.n_frames += len(t)
+        keep = max(np.searchsorted(t_all, t_all[-1] - self.Ta, side="right") - 1, 0)
+        keep = min(keep, len(t_all) - 1)
+        self._t = t_all[keep:]
+        self._ca = ca_all[keep:]
+        self._ca_delayed = ca_delayed[-1]
+        return ct.reshape(self.shape + t.shape)
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+# Number of exponent tables kept in memory by each time grid
+_EXP_TABLE_CACHE_SIZE = 32
+
+
+class TimeGrid:
+    """Array of time points with precomputed grid properties.
+
+    The models accept a TimeGrid wherever they accept an array of time points. Properties
+    of the grid such as the time steps, their uniformity and the exponentials used by the
+    convolutions are validated and calculated once, which saves time when a model is
+    evaluated many times on the same grid, e.g. in a fit.
+
+    Args:
+        t (NDArray[np.floating]):
+            array of strictly increasing time points in units of sec. [OSIPI code Q.GE1.004]
+
+    Attributes:
+        t (NDArray[np.floating]): read-only array of time points in units of sec.
+        diff (NDArray[np.floating]): time steps between consecutive time points in sec.
+        uniform (bool): True if the time points are uniformly spaced.
+        dt (np.floating): time step of a uniform grid, or the smallest step otherwise.
+
+    Example:
+        Create a grid covering 6 min in steps of 1 sec and use it for the AIF and
+        tissue concentrations.
+
+        >>> import osipi
+        >>> t = osipi.TimeGrid(np.arange(0, 6 * 60, 1))
+        >>> ca = osipi.aif_parker(t)
+        >>> ct = osipi.tofts(t, ca, Ktrans=0.6, ve=0.2)
+
+    """
+
+    def __init__(self, t: NDArray[np.floating]):
+        t = np.array(t, dtype=float)
+        if t.ndim != 1 or t.size < 2:
+            raise ValueError("t must be a 1D array with at least 2 time points")
+        diff = np.diff(t)
+        if not np.all(diff > 0):
+            raise ValueError("t must be strictly increasing")
+
+        t.flags.writeable = False
+        diff.flags.writeable = False
+        self.t = t
+        self.diff = diff
+        # The tolerance of np.allclose(diff, diff[0]), without its overhead per call
+        self.uniform = bool(np.max(np.abs(diff - diff[0])) <= 1e-8 + 1e-5 * diff[0])
+        self.dt = diff[0] if self.uniform else np.min(diff)
+        self._exp_tables = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def __array__(self, dtype=None, copy=None) -> NDArray[np.floating]:
+        return self.t if dtype is None else self.t.astype(dtype)
+
+    def exp_table(
+        self, T: Union[np.floating, NDArray[np.floating]]
+    ) -> Tuple[NDArray[np.floating], NDArray[np.floating]]:
+        """Time steps in units of T and their negative exponentials.
+
+        These are the terms of the exponential convolution recursion in `exp_conv`.
+        Tables for scalar time constants are cached, so that repeated evaluations with
+        the same time constant do not recompute the exponentials.
+
+        Args:
+            T (np.floating or NDArray[np.floating]): non-zero time constant(s) in sec.
+
+        Returns:
+            Tuple[NDArray[np.floating], NDArray[np.floating]]:
+                x = diff / T and exp(-x), each of shape (..., len(t) - 1).
+        """
+        T = np.asarray(T, dtype=float)
+        if T.ndim > 0:
+            x = self.diff / T[..., np.newaxis]
+            return x, np.exp(-x)
+
+        key = float(T)
+        if key in self._exp_tables:
+            self._exp_tables.move_to_end(key)
+            return self._exp_tables[key]
+
+        x = self.diff / key
+        table = (x, np.exp(-x))
+        for array in table:
+            array.flags.writeable = False
+        self._exp_tables[key] = table
+        if len(self._exp_tables) > _EXP_TABLE_CACHE_SIZE:
+            self._exp_tables.popitem(last=False)
+        return table
+
+
+def as_time_grid(t: Union[NDArray[np.floating], TimeGrid]) -> TimeGrid:
+    """Return t as a TimeGrid, without copying if it is one already.
+
+    Args:
+        t (NDArray[np.floating] or TimeGrid): time points in units of sec.
+
+    Returns:
+        TimeGrid: grid of the time points.
+    """
+    if isinstance(t, TimeGrid):
+        return t
+    return TimeGrid(t)
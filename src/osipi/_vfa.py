@@ -0,0 +1,153 @@
+from functools import partial
+from typing import Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ._electromagnetic_property import _voxel_maps
+from ._fitting import _levenberg_marquardt
+from ._mask import _check_mask, _compact, _scatter
+from ._signal import _spgr
+
+# Number of array elements (voxels x flip angles x parameters) refined at once
+_BLOCK_ELEMENTS = 2**22
+
+
+def S_to_R10_VFA(
+    S: NDArray[np.floating],
+    TR: np.floating,
+    a: NDArray[np.floating],
+    B1: Union[np.floating, NDArray[np.floating]] = 1.0,
+    method: str = "linear",
+    bounds: Tuple[Tuple[np.floating, ...], Tuple[np.floating, ...]] = (
+        (0.0, 0.0),
+        (np.inf, np.inf),
+    ),
+    max_iter: int = 100,
+    tol: np.floating = 1e-8,
+    mask: NDArray[np.bool_] = None,
+) -> Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+    """Native R1 and S0 maps from variable flip angle SPGR signals.
+
+    The SPGR signal model (see `signal_SPGR`) is linear in the ratios of the signals to
+    the sine and tangent of the flip angle:
+
+    S / sin(a) = E * S / tan(a) + S0 * (1 - E)
+
+    with E = exp(-TR * R10) (DESPOT1, Deoni et al 2003). Its linear least-squares
+    solution is computed in closed form for all voxels at once. Optionally, it is
+    refined with a Levenberg-Marquardt fit of the signal model itself, which weights
+    the signals evenly, for all voxels simultaneously.
+
+    Args:
+        S (NDArray[np.floating]): Pre-contrast magnitude signals in a.u. of shape
+            (..., n_angles), one series of flip angles per voxel. [OSIPI code Q.MS1.001]
+        TR (np.floating): Repetition time in units of s. [OSIPI code Q.MS1.006]
+        a (NDArray[np.floating]): Prescribed flip angles in units of deg, of shape
+            (n_angles,) or broadcastable to the shape of S. [OSIPI code Q.MS1.007]
+        B1 (np.floating or NDArray[np.floating], optional): Ratio of the actual to the
+            prescribed flip angle, of shape (...) or broadcastable to it. Defaults to 1.
+        method (str, optional): Defines the fitting method. Options include
+
+            – 'linear': Linear least-squares fit of the linearized model (default)
+
+            – 'lm': Levenberg-Marquardt least-squares fit of the signal model,
+            starting from the result of the 'linear' method
+        bounds (Tuple, optional): Lower and upper bounds of (R10, S0) for the 'lm' method.
+            Defaults to ((0, 0), (inf, inf)).
+        max_iter (int, optional): Maximum number of iterations. Defaults to 100.
+        tol (np.floating, optional): Convergence tolerance of the 'lm' method, see
+            `fit_tofts`. Defaults to 1e-8.
+        mask (NDArray[np.bool_], optional): Voxels to fit, of shape (...). The other
+            voxels are not fitted and get zero parameters and False flags. Defaults to
+            all voxels.
+
+    Returns:
+        Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+            Maps of R10 in units of /s [OSIPI code Q.EL1.002], S0 in a.u.
+            [OSIPI code Q.MS1.010] and flags, each of shape (...). For the 'linear'
+            method the flags mark voxels with a valid solution (0 < E < 1), for the
+            'lm' method they are the convergence flags. Voxels without a valid linear
+            solution have zero R10 and S0 for the 'linear' method.
+
+    See Also:
+        `signal_SPGR`
+        `S_to_C_via_R1_SPGR`
+
+    Example:
+
+        Map R10 from signals at three flip angles, refined by a nonlinear fit:
+
+        >>> import osipi
+        >>> a = np.array([2.0, 10.0, 15.0])
+        >>> R10 = np.random.uniform(0.5, 1.5, (64, 64))
+        >>> S = osipi.signal_SPGR(R10[..., np.newaxis], 1000.0, 0.005, a)
+        >>> S += np.random.normal(0, 1, S.shape)
+        >>> R10_map, S0_map, converged = osipi.S_to_R10_VFA(S, 0.005, a, method="lm")
+
+        The map can be passed to the conversion of DCE signals to concentrations
+        with `S_to_C_via_R1_SPGR`.
+
+    """
+    if method not in ("lm", "linear"):
+        raise ValueError(f"Unknown fitting method '{method}'")
+    S = np.asarray(S, dtype=float)
+    if S.ndim < 1:
+        raise ValueError("S must have one signal for each flip angle")
+    (B1,) = _voxel_maps(S, B1)
+    a = np.broadcast_to(np.asarray(a, dtype=float), S.shape)
+    if mask is not None:
+        mask = _check_mask(mask, S.shape[:-1])
+        B1 = _compact(mask, B1, trailing=1)[..., 0]
+        R10, S0, valid = S_to_R10_VFA(S[mask], TR, a[mask], B1, method, bounds, max_iter, tol)
+        return _scatter(mask, R10), _scatter(mask, S0), _scatter(mask, valid, fill=False)
+
+    a = B1 * a * np.pi / 180  # actual flip angles in rad
+    R10, S0, valid = _fit_vfa_linear(S, TR, a)
+    if method == "linear":
+        return R10, S0, valid
+
+    # Voxels without a valid linear solution start from R10 = 1/s and the
+    # corresponding S0 of the largest signal
+    S_max = np.max(S, axis=-1)
+    R10 = np.where(valid, R10, 1.0)
+    S0 = np.where(valid, S0, S_max / np.max(_spgr(1.0, 1.0, TR, a), axis=-1))
+
+    shape, n_angles = S.shape[:-1], S.shape[-1]
+    S = S.reshape(-1, n_angles)
+    a = a.reshape(-1, n_angles)
+    p0 = np.stack([R10.reshape(-1), S0.reshape(-1)], axis=-1)
+    lower, upper = (np.asarray(b, dtype=float) for b in bounds)
+
+    def fun(p, index, a):
+        return _spgr(p[:, :1], p[:, 1:], TR, a[index], jacobian=True)
+
+    params = np.empty((len(S), 2))
+    converged = np.empty(len(S), dtype=bool)
+    block = max(1, _BLOCK_ELEMENTS // (n_angles * 3))
+    for i in range(0, len(S), block):
+        rows = slice(i, i + block)
+        params[rows], converged[rows] = _levenberg_marquardt(
+            partial(fun, a=a[rows]), S[rows], p0[rows], lower, upper, max_iter, tol
+        )
+    params = params.reshape(shape + (2,))
+    return params[..., 0], params[..., 1], converged.reshape(shape)
+
+
+def _fit_vfa_linear(
+    S: NDArray[np.floating], TR: np.floating, a: NDArray[np.floating]
+) -> Tuple[NDArray[np.floating], NDArray[np.floating], NDArray[np.bool_]]:
+    """DESPOT1 linear fit of all voxels, with the actual flip angles a in rad."""
+    x = S / np.tan(a)
+    y = S / np.sin(a)
+    n = S.shape[-1]
+    x_mean = np.mean(x, axis=-1)
+    y_mean = np.mean(y, axis=-1)
+    sxx = np.sum(x * x, axis=-1) - n * x_mean**2
+    sxy = np.sum(x * y, axis=-1) - n * x_mean * y_mean
+    with np.errstate(divide="ignore", invalid="ignore"):
+        E = sxy / sxx
+        valid = (E > 0) & (E < 1)
+        R10 = np.where(valid, -np.log(E) / TR, 0.0)
+        S0 = np.where(valid, (y_mean - E * x_mean) / (1 - E), 0.0)
+    return R10, S0, valid
@@ -1,5 +1,6 @@
 import numpy as np
 import osipi
+from scipy.special import gamma
 
 
 def test_aif_parker():
@@ -9,27 +10,54 @@ def test_aif_parker():
     # Test that this generates values in the right range
     assert np.round(np.amax(ca)) == 6
 
+    # Test that arrays of bolus arrival times give one shifted AIF each
+    BAT = np.array([[0.0, 10.0], [30.0, 45.5]])
+    ca_bat = osipi.aif_parker(t, BAT, Hct=0.45)
+    assert ca_bat.shape == (2, 2, len(t))
+    for i in np.ndindex(BAT.shape):
+        np.testing.assert_allclose(ca_bat[i], osipi.aif_parker(t, BAT[i], Hct=0.45))
+
 
 def test_aif_georgiou():
-    # Not implemented yet so need to raise an error
     t = np.arange(0, 6 * 60, 1)
-    try:
-        osipi.aif_georgiou(t)
-    except Exception:
-        assert True
-    else:
-        assert False
+    ca = osipi.aif_georgiou(t)
+
+    # Test that this generates values in the right range
+    assert np.round(np.amax(ca)) == 13
+    assert ca[0] == 0
+
+    # Test that it agrees with a direct evaluation of the gamma variates
+    t_min = 2.5
+    gamma_variates = 0
+    for j in range(int(t_min / 0.129) + 1):
+        a = (j + 1) * 5.26 + j
+        s = t_min - j * 0.129
+        gamma_variates += s ** (a - 1) * np.exp(-s / 0.032) / (0.032**a * gamma(a))
+    exponentials = 0.37 * np.exp(-0.11 * t_min) + 0.33 * np.exp(-1.17 * t_min)
+    exponentials += 10.06 * np.exp(-16.02 * t_min)
+    np.testing.assert_allclose(ca[150], exponentials * gamma_variates, rtol=1e-4)
+
+    # Test that arrays of bolus arrival times give one shifted AIF each
+    BAT = np.array([[0.0, 10.0], [30.0, 45.5]])
+    ca_bat = osipi.aif_georgiou(t, BAT)
+    assert ca_bat.shape == (2, 2, len(t))
+    for i in np.ndindex(BAT.shape):
+        np.testing.assert_allclose(ca_bat[i], osipi.aif_georgiou(t - BAT[i]))
 
 
 def test_aif_weinmann():
-    # Not implemented yet so need to raise an error
     t = np.arange(0, 6 * 60, 1)
-    try:
-        osipi.aif_weinmann(t)
-    except BaseException:
-        assert True
-    else:
-        assert False
+    ca = osipi.aif_weinmann(t, BAT=20)
+
+    # Test that the bolus arrives at BAT with the peak concentration D * (a1 + a2)
+    assert np.all(ca[t < 20] == 0)
+    np.testing.assert_allclose(np.amax(ca), 0.1 * (3.99 + 4.78))
+    assert np.argmax(ca) == 20
+
+    # and that it decays biexponentially from there
+    t_min = (t[t >= 20] - 20) / 60
+    expected = 0.1 * (3.99 * np.exp(-0.144 * t_min) + 4.78 * np.exp(-0.0111 * t_min))
+    np.testing.assert_allclose(ca[t >= 20], expected)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import numpy as np
+import osipi
+from scipy.integrate import quad
+
+
+def test_tofts_analytic():
+    # 1. Agrees with direct numerical integration of the convolution integral
+    t = np.array([0.0, 20.0, 40.0, 45.0, 60.0, 100.0, 300.0])
+    Ktrans, ve, Ta, BAT = 0.3, 0.3, 17.3, 12.0
+    ct = osipi.tofts_analytic(t, Ktrans, ve, Ta=Ta, BAT=BAT)
+    kep = Ktrans / ve
+    for ti, cti in zip(t, ct):
+        tau = max(ti - Ta, 0) / 60
+
+        def integrand(u):
+            return osipi.aif_parker(np.array([u * 60]), BAT=BAT)[0] * np.exp(-kep * (tau - u))
+
+        expected = Ktrans * quad(integrand, 0, tau, epsabs=1e-14, limit=500)[0]
+        np.testing.assert_allclose(cti, expected, rtol=1e-10, atol=1e-14)
+
+    # 2. The numerical convolutions converge to it for fine time steps
+    t = np.arange(0, 6 * 60, 0.1)
+    ca = osipi.aif_parker(t, Hct=0.45)
+    Ktrans = np.array([0.05, 0.3, 0.6])
+    ve = np.array([0.1, 0.3, 0.2])
+    ct = osipi.tofts_analytic(t, Ktrans, ve, Hct=0.45)
+    ct_exp = osipi.tofts(t, ca, Ktrans, ve, discretization_method="exp")
+    np.testing.assert_allclose(ct[:, :-1], ct_exp[:, :-1], rtol=0, atol=1e-3)
+
+
+def test_extended_tofts_analytic():
+    # 1. Consistent with the Tofts model and the plasma term, on non-uniform grids
+    t = np.geomspace(1, 6 * 60 + 1, num=200) - 1
+    Ktrans = np.array([[0.05, 0.3], [0.6, 0.0]])
+    ve = np.array([[0.1, 0.3], [0.2, 0.3]])
+    vp = 0.05
+    ct = osipi.extended_tofts_analytic(t, Ktrans, ve, vp)
+    assert ct.shape == (2, 2, 200)
+    ca = osipi.aif_parker(t)
+    ca_delayed = (t > 30) * osipi.aif_parker(t - 30)
+    expected = osipi.tofts_analytic(t, Ktrans, ve) + vp * ca_delayed
+    expected[1, 1] = vp * ca
+    np.testing.assert_allclose(ct, expected, rtol=1e-12, atol=1e-15)
+
+    # 2. Unknown AIF models are rejected
+    try:
+        osipi.extended_tofts_analytic(t, Ktrans, ve, vp, aif="fritz-hansen")
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_tofts_analytic_weinmann():
+    # 1. Agrees with direct numerical integration of the convolution integral,
+    # including kep equal to a rate constant of the AIF
+    t = np.array([0.0, 20.0, 40.0, 100.0, 300.0])
+    Ktrans = np.array([0.3, 0.6, 0.144 * 0.2])
+    ve = np.array([0.3, 0.2, 0.2])
+    Ta, BAT = 12.0, 15.0
+    ct = osipi.tofts_analytic(t, Ktrans, ve, Ta=Ta, aif="weinmann", BAT=BAT)
+    for K, v, ct_voxel in zip(Ktrans, ve, ct):
+        for ti, cti in zip(t, ct_voxel):
+            tau = max(ti - Ta, 0) / 60
+
+            def integrand(u):
+                aif = osipi.aif_weinmann(np.array([u * 60]), BAT=BAT)[0]
+                return aif * np.exp(-K / v * (tau - u))
+
+            expected = K * quad(integrand, BAT / 60, max(tau, BAT / 60), epsabs=1e-14)[0]
+            np.testing.assert_allclose(cti, expected, rtol=1e-10, atol=1e-14)
+
+    # 2. The hematocrit only applies to the Parker AIF
+    try:
+        osipi.tofts_analytic(t, Ktrans, ve, aif="weinmann", Hct=0.45)
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_tofts_analytic()
+    test_extended_tofts_analytic()
+    test_tofts_analytic_weinmann()
+
+    print("All analytic tests passed!!")
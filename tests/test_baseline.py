@@ -0,0 +1,41 @@
+import numpy as np
+import osipi
+
+
+def test_estimate_S_baseline():
+    # 1. Fixed number of pre-contrast frames
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 5 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    Ta = rng.uniform(20, 40, (8, 9))
+    ct = osipi.tofts(t, ca, 0.3, 0.2, Ta=Ta)
+    S = osipi.signal_SPGR(1.0 + 4.5 * ct, 10000.0, 0.002, 13.0)
+    S_noisy = S + rng.normal(0, 1, S.shape)
+    S_baseline = osipi.estimate_S_baseline(S_noisy, n_baseline=10)
+    assert S_baseline.shape == Ta.shape
+    np.testing.assert_allclose(S_baseline, np.mean(S_noisy[..., :10], axis=-1))
+    S_baseline = osipi.estimate_S_baseline(S_noisy, n_baseline=10, method="median")
+    np.testing.assert_allclose(S_baseline, np.median(S_noisy[..., :10], axis=-1))
+
+    # 2. Detection of the bolus arrival: noise-free curves give the exact baseline,
+    # and noisy curves a baseline within the noise of the mean of a few frames
+    S_baseline = osipi.estimate_S_baseline(S)
+    np.testing.assert_allclose(S_baseline, S[..., 0], rtol=1e-6)
+    S_baseline = osipi.estimate_S_baseline(S_noisy)
+    np.testing.assert_allclose(S_baseline, S[..., 0], atol=2)
+
+    # 3. The baselines convert to concentrations with the signal series
+    C = osipi.S_to_C_via_R1_SPGR(S, osipi.estimate_S_baseline(S), 1.0, 0.002, 13.0, 4.5)
+    np.testing.assert_allclose(C, ct, atol=1e-4)
+
+    # 4. Voxels outside a mask get a baseline of zero
+    mask = Ta < 30
+    S_baseline = osipi.estimate_S_baseline(S, mask=mask)
+    assert np.all(S_baseline[~mask] == 0)
+    np.testing.assert_array_equal(S_baseline[mask], osipi.estimate_S_baseline(S[mask]))
+
+
+if __name__ == "__main__":
+    test_estimate_S_baseline()
+
+    print("All baseline tests passed!!")
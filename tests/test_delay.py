@@ -0,0 +1,47 @@
+import numpy as np
+import osipi
+
+
+def test_estimate_Ta():
+    # 1. Delays of noise-free Tofts and Extended Tofts curves are recovered, with the
+    # discretization of the model
+    t = np.arange(0, 6 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    Ta = np.array([[0.0, 7.3], [18.25, 41.6]])
+    Ktrans = np.array([[0.6, 0.1], [0.25, 0.35]])
+    ve = np.array([[0.2, 0.4], [0.15, 0.3]])
+    vp = np.array([[0.02, 0.0], [0.05, 0.01]])
+    ct = osipi.tofts(t, ca, Ktrans, ve, Ta=Ta)
+    Ta_est = osipi.estimate_Ta(t, ct, ca)
+    assert Ta_est.shape == Ta.shape
+    np.testing.assert_allclose(Ta_est, Ta, atol=0.1)
+
+    ct = osipi.tofts(t, ca, Ktrans, ve, Ta=Ta, discretization_method="exp")
+    Ta_est = osipi.estimate_Ta(t, ct, ca, discretization_method="exp")
+    np.testing.assert_allclose(Ta_est, Ta, atol=0.2)
+
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp, Ta=Ta)
+    Ta_est = osipi.estimate_Ta(t, ct, ca, model="extended_tofts")
+    np.testing.assert_allclose(Ta_est, Ta, atol=0.1)
+
+    # 2. The delays are unbiased for many voxels, and can be passed on to the fit
+    rng = np.random.default_rng(0)
+    Ta = rng.uniform(0, 50, 200)
+    Ktrans = rng.uniform(0.05, 0.6, 200)
+    ve = rng.uniform(0.1, 0.5, 200)
+    ct = osipi.tofts(t, ca, Ktrans, ve, Ta=Ta)
+    Ta_est = osipi.estimate_Ta(t, ct, ca)
+    assert abs(np.median(Ta_est - Ta)) < 0.02
+    Ktrans_est, ve_est, _ = osipi.fit_tofts(t, ct, ca, Ta=Ta_est)
+    np.testing.assert_allclose(Ktrans_est, Ktrans, rtol=0.02)
+    np.testing.assert_allclose(ve_est, ve, rtol=0.02)
+
+    # 3. Delays stay within the range searched
+    Ta_est = osipi.estimate_Ta(t, ct, ca, model="extended_tofts", Ta_range=(10.0, 30.0))
+    assert np.all((Ta_est >= 10) & (Ta_est <= 30))
+
+
+if __name__ == "__main__":
+    test_estimate_Ta()
+
+    print("All delay tests passed!!")
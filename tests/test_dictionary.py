@@ -0,0 +1,81 @@
+import os
+import tempfile
+
+import numpy as np
+import osipi
+
+
+def test_tofts_dictionary():
+    # 1. Matching recovers the parameters up to the spacing of the kep grid
+    t = np.arange(0, 6 * 60, 2)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([[0.05, 0.2], [0.4, 0.6]])
+    ve = np.array([[0.1, 0.3], [0.5, 0.2]])
+    ct = osipi.tofts(t, ca, Ktrans, ve)
+    dictionary = osipi.ToftsDictionary(t, ca, n_atoms=2000)
+    Ktrans_fit, ve_fit, valid = dictionary.fit(ct)
+    assert Ktrans_fit.shape == (2, 2)
+    assert np.all(valid)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-2)
+    np.testing.assert_allclose(ve_fit, ve, rtol=1e-2)
+
+    # 2. Refinement gives the exact parameters
+    Ktrans_fit, ve_fit, converged = dictionary.fit(ct, refine=True)
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+    np.testing.assert_allclose(ve_fit, ve, rtol=1e-4)
+
+    # 3. Curves without uptake do not match
+    Ktrans_fit, ve_fit, valid = dictionary.fit(-ct)
+    assert not np.any(valid)
+    assert np.all(Ktrans_fit == 0)
+
+
+def test_tofts_dictionary_extended():
+    # 1. The plasma volume is fitted by projection
+    t = np.arange(0, 6 * 60, 2)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.05, 0.2, 0.4, 0.6])
+    ve = np.array([0.1, 0.3, 0.5, 0.2])
+    vp = np.array([0.01, 0.05, 0.1, 0.02])
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp, discretization_method="exp")
+    dictionary = osipi.ToftsDictionary(
+        t, ca, model="extended_tofts", discretization_method="exp", n_atoms=2000
+    )
+    Ktrans_fit, ve_fit, vp_fit, valid = dictionary.fit(ct)
+    assert np.all(valid)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-2)
+    np.testing.assert_allclose(ve_fit, ve, rtol=1e-2)
+    np.testing.assert_allclose(vp_fit, vp, rtol=0, atol=1e-3)
+
+    # 2. A saved dictionary is memory-mapped and gives the same results
+    with tempfile.TemporaryDirectory() as path:
+        dictionary.save(path)
+        assert os.path.exists(os.path.join(path, "atoms.npy"))
+        loaded = osipi.ToftsDictionary.load(path)
+        assert isinstance(loaded.atoms, np.memmap)
+        for x, y in zip(dictionary.fit(ct), loaded.fit(ct)):
+            np.testing.assert_array_equal(x, y)
+        del loaded
+
+    # 3. Unknown models and wrong curve lengths are rejected
+    try:
+        osipi.ToftsDictionary(t, ca, model="patlak")
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+    try:
+        dictionary.fit(ct[:, 1:])
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_tofts_dictionary()
+    test_tofts_dictionary_extended()
+
+    print("All dictionary tests passed!!")
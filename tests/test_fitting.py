@@ -0,0 +1,126 @@
+import numpy as np
+import osipi
+
+
+def test_fit_tofts():
+    # 1. Noise-free curves are fitted exactly, for a map of voxels
+    t = np.arange(0, 6 * 60, 2)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([[0.05, 0.2], [0.4, 0.6]])
+    ve = np.array([[0.1, 0.3], [0.5, 0.2]])
+    ct = osipi.tofts(t, ca, Ktrans, ve)
+    Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca)
+    assert Ktrans_fit.shape == (2, 2)
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+    np.testing.assert_allclose(ve_fit, ve, rtol=1e-4)
+
+    # 2. Fits of noisy curves agree with the ground truth
+    rng = np.random.default_rng(0)
+    Ktrans = rng.uniform(0.05, 0.6, 100)
+    ve = rng.uniform(0.1, 0.6, 100)
+    ct = osipi.tofts(t, ca, Ktrans, ve, discretization_method="exp")
+    ct += rng.normal(0, 0.005, ct.shape)
+    Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca, discretization_method="exp")
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=0.1)
+    np.testing.assert_allclose(ve_fit, ve, rtol=0.1)
+
+    # 3. Bounds are respected
+    Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca, bounds=((0, 0), (5.0, 0.3)))
+    assert np.all(ve_fit <= 0.3)
+
+    # 4. Each voxel can have its own delay time
+    Ta = rng.uniform(5, 40, 100)
+    ct = osipi.tofts(t, ca, Ktrans, ve, Ta=Ta)
+    Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca, Ta=Ta)
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+    Ktrans_fit, ve_fit, valid = osipi.fit_tofts(t, ct, ca, Ta=Ta, method="linear")
+    assert np.all(valid)
+
+    # 5. Curves with missing values are not converged, and do not affect the others
+    ct[:10, 50] = np.nan
+    Ktrans_fit, ve_fit, converged = osipi.fit_tofts(t, ct, ca, Ta=Ta)
+    assert not np.any(converged[:10])
+    assert np.all(converged[10:])
+    np.testing.assert_allclose(Ktrans_fit[10:], Ktrans[10:], rtol=1e-4)
+
+
+def test_fit_extended_tofts():
+    # 1. Noise-free curves are fitted exactly
+    t = np.arange(0, 6 * 60, 2)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.05, 0.2, 0.4, 0.6])
+    ve = np.array([0.1, 0.3, 0.5, 0.2])
+    vp = np.array([0.01, 0.05, 0.1, 0.02])
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp)
+    Ktrans_fit, ve_fit, vp_fit, converged = osipi.fit_extended_tofts(t, ct, ca)
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+    np.testing.assert_allclose(ve_fit, ve, rtol=1e-4)
+    np.testing.assert_allclose(vp_fit, vp, rtol=1e-4)
+
+    # 2. Initial values can be given for each voxel
+    p0 = np.stack([Ktrans, ve, vp], axis=-1) * 1.1
+    Ktrans_fit, ve_fit, vp_fit, converged = osipi.fit_extended_tofts(t, ct, ca, p0=p0)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+
+    # 3. Curves must match the time points
+    try:
+        osipi.fit_extended_tofts(t, ct[:, 1:], ca)
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_fit_linear():
+    # 1. The linear fit recovers the parameters of well-sampled curves
+    t = np.arange(0, 6 * 60, 0.5)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.05, 0.2, 0.4, 0.6])
+    ve = np.array([0.1, 0.3, 0.5, 0.2])
+    vp = np.array([0.01, 0.05, 0.1, 0.02])
+    ct = osipi.tofts(t, ca, Ktrans, ve, discretization_method="exp")
+    Ktrans_fit, ve_fit, valid = osipi.fit_tofts(t, ct, ca, method="linear")
+    assert np.all(valid)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=0.02)
+    np.testing.assert_allclose(ve_fit, ve, rtol=0.02)
+
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp, discretization_method="exp")
+    Ktrans_fit, ve_fit, vp_fit, valid = osipi.fit_extended_tofts(t, ct, ca, method="linear")
+    assert np.all(valid)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=0.02)
+    np.testing.assert_allclose(ve_fit, ve, rtol=0.02)
+    np.testing.assert_allclose(vp_fit, vp, rtol=0.05)
+
+    # 2. Curves without uptake give invalid linear solutions, clipped to the bounds
+    ct = np.zeros((2, len(t)))
+    Ktrans_fit, ve_fit, valid = osipi.fit_tofts(t, ct, ca, method="linear")
+    assert not np.any(valid)
+    assert np.all(Ktrans_fit >= 1e-5)
+
+    # 3. The linear fit initializes the nonlinear fit
+    ct = osipi.extended_tofts(t[::4], ca[::4], Ktrans, ve, vp)
+    Ktrans_fit, ve_fit, vp_fit, converged = osipi.fit_extended_tofts(
+        t[::4], ct, ca[::4], p0="linear"
+    )
+    assert np.all(converged)
+    np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+
+    # 4. Unknown methods are rejected
+    try:
+        osipi.fit_tofts(t, ct, ca, method="nnls")
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_fit_tofts()
+    test_fit_extended_tofts()
+    test_fit_linear()
+
+    print("All fitting tests passed!!")
@@ -0,0 +1,89 @@
+import tempfile
+
+import numpy as np
+import osipi
+
+
+def test_R1LookupTable():
+    # 1. The SPGR table inverts the signal model to within its tolerance, is shared by
+    # calls with the same protocol and maps signals outside its range to NaN
+    TR, a = 0.005, 20.0
+    table = osipi.R1LookupTable.from_SPGR(TR, a, tol=1e-4)
+    assert osipi.R1LookupTable.from_SPGR(TR, a, tol=1e-4) is table
+    assert table.error <= 1e-4
+    R1 = np.linspace(0.1, 49.9, 10001)
+    y = osipi.signal_SPGR(R1, 1.0, TR, a)
+    np.testing.assert_allclose(table(y), R1, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(table.signal(R1), y, rtol=0, atol=1e-6)
+    assert np.all(np.isnan(table(np.array([-1.0, 2.0, np.nan]))))
+
+    # 2. A signal model without a closed-form inverse: SPGR with T2* decay, where
+    # R2* increases with R1. Tables can be saved and loaded.
+    TE = 0.002
+
+    def signal(R1):
+        return osipi.signal_SPGR(R1, 1.0, TR, a) * np.exp(-TE * 2 * R1)
+
+    table = osipi.R1LookupTable(signal, R1_range=(0.0, 20.0))
+    with tempfile.TemporaryDirectory() as path:
+        table.save(path + "/table.npz")
+        table = osipi.R1LookupTable.load(path + "/table.npz")
+    R1 = np.linspace(0.1, 19.9, 1001)
+    np.testing.assert_allclose(table(signal(R1)), R1, rtol=0, atol=1e-3)
+
+    # 3. The signal model must be monotone
+    try:
+        osipi.R1LookupTable(signal, R1_range=(0.0, 1000.0))
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_S_to_R1_SPGR_table():
+    # 1. The 'table' method agrees with the analytical inversion, with an R10 map
+    rng = np.random.default_rng(0)
+    TR, a, r1 = 0.005, 20.0, 4.5
+    shape = (5, 6)
+    R10 = rng.uniform(0.5, 1.5, shape)
+    C = rng.uniform(0, 5, shape + (40,))
+    C[..., 0] = 0
+    S = osipi.signal_SPGR(R10[..., np.newaxis] + r1 * C, 1000.0, TR, a)
+    R1 = osipi.S_to_R1_SPGR(S, S[..., 0], R10, TR, a)
+    R1_table = osipi.S_to_R1_SPGR(S, S[..., 0], R10, TR, a, method="table")
+    np.testing.assert_allclose(R1_table, R1, rtol=0, atol=1e-3)
+    np.testing.assert_allclose(R1_table[..., 0], R10, rtol=0, atol=1e-3)
+    C_table = osipi.S_to_C_via_R1_SPGR(S, S[..., 0], R10, TR, a, r1, method="table")
+    np.testing.assert_allclose(C_table, C, rtol=0, atol=1e-3)
+
+    # 2. A table of a signal model, with a mask. Its scale is interpolated too, which
+    # doubles the error of the table
+    table = osipi.R1LookupTable(lambda R1: osipi.signal_SPGR(R1, 1.0, TR, a), tol=5e-4)
+    mask = np.ones(shape, dtype=bool)
+    mask[0] = False
+    R1_table = osipi.S_to_R1_SPGR(S, S[..., 0], R10, TR, a, mask=mask, method=table)
+    assert np.all(R1_table[0] == 0)
+    np.testing.assert_allclose(R1_table[1:], R1[1:], rtol=0, atol=1e-3)
+
+    # 3. The 'table' method requires the same actual flip angle in all voxels
+    try:
+        osipi.S_to_R1_SPGR(
+            S, S[..., 0], R10, TR, a, B1=rng.uniform(0.9, 1.1, shape), method="table"
+        )
+    except ValueError:
+        assert True
+    else:
+        assert False
+    try:
+        osipi.S_to_R1_SPGR(S, S[..., 0], R10, TR, a, method="lut")
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_R1LookupTable()
+    test_S_to_R1_SPGR_table()
+
+    print("All lookup table tests passed!!")
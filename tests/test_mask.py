@@ -0,0 +1,79 @@
+import tempfile
+import warnings
+
+import numpy as np
+import osipi
+
+
+def test_mask():
+    # Volume with a block of tissue in a background of zero signal, R10 and delay
+    t = np.arange(0, 5 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    shape = (4, 5)
+    mask = np.zeros(shape, dtype=bool)
+    mask[1:3, 1:4] = True
+    rng = np.random.default_rng(0)
+    Ktrans = np.where(mask, rng.uniform(0.05, 0.6, shape), 0)
+    ve = np.where(mask, rng.uniform(0.1, 0.5, shape), 0)
+    R10 = np.where(mask, rng.uniform(0.5, 1.0, shape), 0)
+    Ta = np.where(mask, 30.0, 0)
+    TR, a, r1 = 0.002, 13.0, 4.5
+
+    # 1. Only the voxels in the mask are computed, the others are zero
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ct, jac = osipi.tofts(t, ca, Ktrans, ve, Ta=Ta, jacobian=True, mask=mask)
+        S = osipi.signal_SPGR(R10[..., np.newaxis] + r1 * ct, 1000.0, TR, a) * mask[..., None]
+        C = osipi.S_to_C_via_R1_SPGR(S, S[..., 0], R10, TR, a, r1, mask=mask)
+        R1 = osipi.S_to_R1_SPGR(S, S[..., 0], R10, TR, a, mask=mask)
+        C_R1 = osipi.R1_to_C_linear_relaxivity(R1, R10, r1, mask=mask)
+    assert ct.shape == shape + (len(t),)
+    assert jac.shape == shape + (len(t), 3)
+    for x in [ct, jac, C, R1, C_R1]:
+        assert np.all(x[~mask] == 0)
+
+    # 2. and the voxels in the mask are the same as without mask
+    ct_all, jac_all = osipi.tofts(t, ca, Ktrans[mask], ve[mask], jacobian=True)
+    np.testing.assert_array_equal(ct[mask], ct_all)
+    np.testing.assert_array_equal(jac[mask], jac_all)
+    S_tissue = S[mask]
+    C_tissue = osipi.S_to_C_via_R1_SPGR(S_tissue, S_tissue[..., 0], R10[mask], TR, a, r1)
+    np.testing.assert_array_equal(C[mask], C_tissue)
+    np.testing.assert_allclose(C_R1, C, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(C, ct, rtol=1e-8, atol=1e-12)
+
+    # 3. Fits
+    for results in [
+        osipi.fit_tofts(t, C, ca, Ta=Ta, mask=mask),
+        osipi.ToftsDictionary(t, ca, n_atoms=2000).fit(C, refine=True, mask=mask),
+    ]:
+        Ktrans_fit, ve_fit, converged = results
+        assert np.all(converged == mask)
+        np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+        np.testing.assert_allclose(ve_fit, ve, rtol=1e-4)
+    Ta_est = osipi.estimate_Ta(t, C, ca, mask=mask)
+    assert np.all(Ta_est[~mask] == 0)
+    np.testing.assert_array_equal(Ta_est[mask], osipi.estimate_Ta(t, C[mask], ca))
+
+    with tempfile.TemporaryDirectory() as path:
+        Ktrans_fit, ve_fit, converged, C_fit = osipi.fit_volume(
+            t, S, ca, S[..., 0], R10, TR, a, r1, path, memory=2**14, mask=mask
+        )
+        assert np.all(converged == mask)
+        np.testing.assert_array_equal(C_fit, C)
+        np.testing.assert_allclose(Ktrans_fit, Ktrans, rtol=1e-4)
+        del Ktrans_fit, ve_fit, converged, C_fit
+
+    # 4. The mask must match the voxels
+    try:
+        osipi.fit_tofts(t, C, ca, mask=mask[:-1])
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_mask()
+
+    print("All mask tests passed!!")
@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+import numpy as np
+import osipi
+
+
+def test_fit_volume():
+    # 1. Chunked fits of a memory-mapped series agree with fitting all voxels at once
+    t = np.arange(0, 5 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    shape = (4, 5, 6)
+    rng = np.random.default_rng(0)
+    Ktrans = rng.uniform(0.05, 0.6, shape)
+    ve = rng.uniform(0.1, 0.5, shape)
+    vp = rng.uniform(0.0, 0.1, shape)
+    Ta = rng.uniform(20, 40, shape[-1])
+    R10 = rng.uniform(0.5, 1.0, shape)
+    TR, a, r1 = 0.002, 13.0, 4.5
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp, Ta=Ta)
+    S = osipi.signal_SPGR(R10[..., np.newaxis] + r1 * ct, 1000.0, TR, a)
+    S_baseline = osipi.signal_SPGR(R10, 1000.0, TR, a)
+
+    with tempfile.TemporaryDirectory() as path:
+        file = os.path.join(path, "signal.npy")
+        np.save(file, S)
+        output = os.path.join(path, "results")
+        results = osipi.fit_volume(
+            t, file, ca, S_baseline, R10, TR, a, r1, output, "extended_tofts", Ta=Ta, memory=2**16
+        )
+        for name in ["Ktrans", "ve", "vp", "converged", "C"]:
+            assert os.path.exists(os.path.join(output, name + ".npy"))
+        assert all(isinstance(x, np.memmap) for x in results)
+        *params, converged, C = results
+
+        C_all = osipi.S_to_C_via_R1_SPGR(S, S_baseline, R10, TR, a, r1)
+        np.testing.assert_array_equal(C, C_all)
+        fit_all = osipi.fit_extended_tofts(t, C_all, ca, Ta=Ta)
+        for x, y in zip(params + [converged], fit_all):
+            np.testing.assert_allclose(x, y, rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(params[0], Ktrans, rtol=1e-4)
+        del results, params, converged, C
+
+    # 2. Fitting options are passed on, and series in memory are accepted
+    with tempfile.TemporaryDirectory() as path:
+        Ktrans_fit, ve_fit, converged, C = osipi.fit_volume(
+            t, S, ca, S_baseline, R10, TR, a, r1, path, Ta=30.0, method="linear"
+        )
+        fit_all = osipi.fit_tofts(t, C, ca, method="linear")
+        np.testing.assert_allclose(Ktrans_fit, fit_all[0])
+        del Ktrans_fit, ve_fit, converged, C
+
+
+if __name__ == "__main__":
+    test_fit_volume()
+
+    print("All pipeline tests passed!!")
@@ -0,0 +1,73 @@
+import numpy as np
+import osipi
+
+
+def test_SPGR_signal_model():
+    # 1. The signals are the SPGR signals of the tissue concentrations
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 5 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    TR, a, r1 = 0.002, 13.0, 4.5
+    shape = (4, 5)
+    R10 = rng.uniform(0.5, 1.5, shape)
+    S0 = rng.uniform(800, 1200, shape)
+    Ktrans = rng.uniform(0.05, 0.6, shape)
+    ve = rng.uniform(0.1, 0.5, shape)
+    params = np.stack([Ktrans, ve], axis=-1)
+    tissue_model = osipi.ToftsModel(t, ca)
+    model = osipi.SPGRSignalModel(tissue_model, R10, S0, TR, a, r1)
+    S = model.evaluate(params)
+    ct = osipi.tofts(t, ca, Ktrans, ve)
+    S_expected = osipi.signal_SPGR(R10[..., np.newaxis] + r1 * ct, S0[..., np.newaxis], TR, a)
+    np.testing.assert_allclose(S, S_expected, rtol=1e-12)
+
+    # 2. The Jacobian matches finite differences
+    _, jac = model.evaluate(params, jacobian=True)
+    assert jac.shape == shape + (len(t), 2)
+    for i in range(2):
+        dp = np.zeros(2)
+        dp[i] = 1e-6
+        jac_fd = (model.evaluate(params + dp) - model.evaluate(params - dp)) / 2e-6
+        np.testing.assert_allclose(jac[..., i], jac_fd, rtol=1e-5, atol=1e-5)
+
+    # 3. Fitting noise-free signals recovers the parameters, with a B1 map and a mask
+    B1 = rng.uniform(0.8, 1.2, shape)
+    model = osipi.SPGRSignalModel(tissue_model, R10, S0, TR, a, r1, B1=B1)
+    S = model.evaluate(params)
+    mask = np.ones(shape, dtype=bool)
+    mask[0] = False
+    Ktrans_fit, ve_fit, converged = model.fit(S, mask=mask)
+    assert np.all(converged[1:])
+    assert not np.any(converged[0])
+    assert np.all(Ktrans_fit[0] == 0)
+    np.testing.assert_allclose(Ktrans_fit[1:], Ktrans[1:], rtol=1e-6)
+    np.testing.assert_allclose(ve_fit[1:], ve[1:], rtol=1e-6)
+
+    # 4. The Extended Tofts model with a single R10 and S0 for all voxels
+    tissue_model = osipi.ExtendedToftsModel(t, ca)
+    model = osipi.SPGRSignalModel(tissue_model, 1.0, 1000.0, TR, a, r1)
+    vp = rng.uniform(0.01, 0.1, shape)
+    S = model.evaluate(np.stack([Ktrans, ve, vp], axis=-1))
+    Ktrans_fit, ve_fit, vp_fit, converged = model.fit(S)
+    assert np.all(converged)
+    np.testing.assert_allclose(vp_fit, vp, rtol=1e-6)
+
+    # 5. Parameters and signals must match the model
+    try:
+        model.evaluate(params)
+    except ValueError:
+        assert True
+    else:
+        assert False
+    try:
+        model.fit(S[..., 1:])
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_SPGR_signal_model()
+
+    print("All signal model tests passed!!")
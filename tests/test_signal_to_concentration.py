@@ -82,6 +82,40 @@ def test_S_to_C_via_R1_SPGR():
     )
     np.testing.assert_allclose(C_truth, C, rtol=0, atol=1e-7)
 
+    # 2. 4D series with maps of the baseline signal, R10, flip angle and B1
+    rng = np.random.default_rng(0)
+    shape = (2, 3, 4)
+    S_4d = S * rng.uniform(0.5, 2, shape + (1,))
+    S_baseline = S_4d[..., 0]
+    R10 = rng.uniform(0.5, 1, shape)
+    a = rng.uniform(10, 15, shape[-1])
+    B1 = rng.uniform(0.8, 1.2, shape)
+    C = osipi.S_to_C_via_R1_SPGR(S_4d, S_baseline, R10, TR, a, r1, B1=B1)
+    assert C.shape == S_4d.shape
+    for i in np.ndindex(shape):
+        C_voxel = osipi.S_to_C_via_R1_SPGR(S_4d[i], S_baseline[i], R10[i], TR, a[i[-1]] * B1[i], r1)
+        np.testing.assert_allclose(C[i], C_voxel, rtol=1e-12, atol=1e-12)
+
+    # 3. Concentrations can be written into a given array, or over the signals
+    out = np.empty_like(S_4d)
+    C_out = osipi.S_to_C_via_R1_SPGR(S_4d, S_baseline, R10, TR, a, r1, B1=B1, out=out)
+    assert C_out is out
+    np.testing.assert_array_equal(out, C)
+    S_copy = S_4d.copy()
+    osipi.S_to_C_via_R1_SPGR(S_copy, S_baseline, R10, TR, a, r1, B1=B1, out=S_copy)
+    np.testing.assert_array_equal(S_copy, C)
+    out = np.empty(S_4d.shape, dtype=np.float32)
+    osipi.S_to_C_via_R1_SPGR(S_4d, S_baseline, R10, TR, a, r1, B1=B1, out=out)
+    np.testing.assert_allclose(out, C, rtol=1e-5, atol=1e-5)
+
+    # 4. Maps must match the voxels of the series
+    try:
+        osipi.S_to_C_via_R1_SPGR(S_4d, S_baseline, R10[..., 0], TR, a, r1)
+    except ValueError:
+        assert True
+    else:
+        assert False
+
 
 def test_S_to_R1_SPGR():
     # 1. Simple use case
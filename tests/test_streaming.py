@@ -0,0 +1,37 @@
+import numpy as np
+import osipi
+
+
+def test_tofts_stream():
+    # 1. Streamed frames agree with the batch exponential convolution, except the last
+    # time point which the batch version copies from the one before
+    t = np.arange(0, 6 * 60, 1.0)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.05, 0.3, 0.6, 0.0])
+    ve = np.array([0.1, 0.3, 0.2, 0.3])
+    vp = np.array([0.01, 0.05, 0.0, 0.02])
+    for Ta in [0.0, 17.5]:
+        ct = osipi.extended_tofts(t, ca, Ktrans, ve, vp, Ta=Ta, discretization_method="exp")
+        stream = osipi.ToftsStream(Ktrans, ve, vp, Ta=Ta)
+        ct_stream = np.concatenate([stream.update(t[i], ca[i]) for i in range(len(t))], axis=-1)
+        assert stream.n_frames == len(t)
+        np.testing.assert_allclose(ct_stream[:, :-1], ct[:, :-1], rtol=0, atol=1e-12)
+
+    # 2. Frames can be added in chunks of any size
+    stream.reset()
+    ct_chunks = [stream.update(t[i : i + 7], ca[i : i + 7]) for i in range(0, len(t), 7)]
+    np.testing.assert_allclose(np.concatenate(ct_chunks, axis=-1), ct_stream, atol=1e-12)
+
+    # 3. Time points must keep increasing
+    try:
+        stream.update(t[0], ca[0])
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+if __name__ == "__main__":
+    test_tofts_stream()
+
+    print("All streaming tests passed!!")
@@ -0,0 +1,50 @@
+import numpy as np
+import osipi
+
+
+def test_time_grid():
+    # 1. Grid properties of a uniform grid
+    grid = osipi.TimeGrid(np.arange(0, 6 * 60, 2))
+    assert len(grid) == 180
+    assert grid.uniform
+    assert grid.dt == 2.0
+
+    # 2. Grid properties of a non-uniform grid
+    grid = osipi.TimeGrid(np.geomspace(1, 6 * 60 + 1, num=360) - 1)
+    assert not grid.uniform
+    assert grid.dt == np.min(np.diff(grid.t))
+
+    # 3. Exponent tables of scalar time constants are cached
+    x, E = grid.exp_table(10.0)
+    assert grid.exp_table(10.0)[1] is E
+    np.testing.assert_allclose(E, np.exp(-np.diff(grid.t) / 10.0))
+    x, E = grid.exp_table(np.array([10.0, 20.0]))
+    assert E.shape == (2, len(grid) - 1)
+
+    # 4. Invalid time points are rejected
+    for t in [np.array([0.0]), np.array([[0.0, 1.0]]), np.array([0.0, 2.0, 1.0])]:
+        try:
+            osipi.TimeGrid(t)
+        except ValueError:
+            assert True
+        else:
+            assert False
+
+
+def test_time_grid_models():
+    # 1. The models give the same results with a grid as with an array
+    for t in [np.arange(0, 6 * 60, 1.0), np.geomspace(1, 6 * 60 + 1, num=360) - 1]:
+        grid = osipi.TimeGrid(t)
+        ca = osipi.aif_parker(t)
+        np.testing.assert_array_equal(osipi.aif_parker(grid), ca)
+        for method in ["conv", "exp"]:
+            ct = osipi.extended_tofts(t, ca, 0.6, 0.2, 0.1, discretization_method=method)
+            ct_grid = osipi.extended_tofts(grid, ca, 0.6, 0.2, 0.1, discretization_method=method)
+            np.testing.assert_array_equal(ct, ct_grid)
+
+
+if __name__ == "__main__":
+    test_time_grid()
+    test_time_grid_models()
+
+    print("All time grid tests passed!!")
@@ -124,8 +124,312 @@ def test_tissue_extended_tofts():
     assert np.allclose(ct_conv, ca * 0.3, rtol=1e-4, atol=1e-3)
 
 
+def test_tissue_voxel_arrays():
+    # 1. Arrays of tissue parameters give one curve per voxel, identical to
+    # the curves calculated voxel by voxel
+    t = np.arange(0, 6 * 60, 1)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([[0.6, 0.2, 0.0], [0.05, 0.3, 0.6]])
+    ve = np.array([0.2, 0.5, 0.2])
+    for method in ["conv", "exp"]:
+        ct = osipi.tofts(t, ca, Ktrans, ve, discretization_method=method)
+        assert ct.shape == (2, 3, len(t))
+        for i, j in np.ndindex(Ktrans.shape):
+            ct_ij = osipi.tofts(t, ca, Ktrans[i, j], ve[j], discretization_method=method)
+            np.testing.assert_allclose(ct[i, j], ct_ij, rtol=0, atol=1e-12)
+
+        ct = osipi.extended_tofts(t, ca, Ktrans, ve, 0.1, discretization_method=method)
+        assert ct.shape == (2, 3, len(t))
+        for i, j in np.ndindex(Ktrans.shape):
+            ct_ij = osipi.extended_tofts(
+                t, ca, Ktrans[i, j], ve[j], 0.1, discretization_method=method
+            )
+            np.testing.assert_allclose(ct[i, j], ct_ij, rtol=0, atol=1e-12)
+
+    # 2. Non-uniform time grids are handled for all voxels at once
+    t = np.geomspace(1, 6 * 60 + 1, num=360) - 1
+    ca = osipi.aif_parker(t)
+    ct = osipi.extended_tofts(t, ca, [0.6, 0.2], 0.2, vp=[0.3, 0.1])
+    assert ct.shape == (2, len(t))
+    np.testing.assert_allclose(
+        ct[1], osipi.extended_tofts(t, ca, 0.2, 0.2, vp=0.1), rtol=0, atol=1e-6
+    )
+
+    # 3. Exponential convolution for more voxels than time points
+    t = np.arange(0, 60, 1)
+    ca = osipi.aif_parker(t, BAT=10)
+    Ktrans = np.linspace(0, 1.2, 100)
+    ct = osipi.tofts(t, ca, Ktrans, 0.2, Ta=0, discretization_method="exp")
+    for i in [0, 1, 50, 99]:
+        ct_i = osipi.tofts(t, ca, Ktrans[i], 0.2, Ta=0, discretization_method="exp")
+        np.testing.assert_allclose(ct[i], ct_i, rtol=0, atol=1e-12)
+
+
+def test_tissue_delay_arrays():
+    # 1. Arrays of delay times give one curve per voxel, identical to the curves
+    # calculated voxel by voxel, including the Jacobian
+    for t in [np.arange(0, 6 * 60, 1.0), np.geomspace(1, 6 * 60 + 1, num=150) - 1]:
+        ca = osipi.aif_parker(t)
+        Ktrans = np.array([0.1, 0.3, 0.6, 0.0])
+        ve = np.array([0.2, 0.3, 0.2, 0.1])
+        Ta = np.array([[0.0, 10.5, 30.0, 20.0], [45.3, 0.0, 12.0, 5.0]])
+        for method in ["conv", "exp"]:
+            ct, jac = osipi.extended_tofts(
+                t, ca, Ktrans, ve, 0.02, Ta=Ta, discretization_method=method, jacobian=True
+            )
+            assert ct.shape == (2, 4, len(t))
+            for i, j in np.ndindex(Ta.shape):
+                ct_ij, jac_ij = osipi.extended_tofts(
+                    t, ca, Ktrans[j], ve[j], 0.02, Ta[i, j], method, jacobian=True
+                )
+                np.testing.assert_allclose(ct[i, j], ct_ij, rtol=0, atol=1e-12)
+                np.testing.assert_allclose(jac[i, j], jac_ij, rtol=0, atol=1e-12)
+
+    # 2. The tissue models accept delay arrays too
+    model = osipi.ToftsModel(t, ca, Ta=Ta[0])
+    ct = model.evaluate(np.stack([Ktrans, ve], axis=-1))
+    np.testing.assert_allclose(ct, osipi.tofts(t, ca, Ktrans, ve, Ta=Ta[0]), rtol=0, atol=1e-12)
+
+
+def test_tissue_non_uniform():
+    # 1. On non-uniform grids the 'linear' discretization convolves the interpolated AIF
+    # exactly, which agrees with the exponential convolution and is close to the
+    # analytic solution
+    t = np.geomspace(1, 6 * 60 + 1, num=200) - 1
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.6, 0.05, 0.3])
+    ve = np.array([0.2, 0.4, 0.1])
+    ct = osipi.tofts(t, ca, Ktrans, ve, Ta=0, discretization_method="linear")
+    ct_exp = osipi.tofts(t, ca, Ktrans, ve, Ta=0, discretization_method="exp")
+    np.testing.assert_allclose(ct[:, :-1], ct_exp[:, :-1], rtol=0, atol=1e-12)
+    ct_analytic = osipi.tofts_analytic(t, Ktrans, ve, Ta=0)
+    np.testing.assert_allclose(ct, ct_analytic, rtol=0, atol=1e-3)
+
+    # 2. A single short time step does not refine the whole grid, and only changes the
+    # 'conv' sums by the weight of the samples around it
+    t = np.concatenate([[0, 1e-6], np.arange(1, 6 * 60, 1.0)])
+    ca = osipi.aif_parker(t, BAT=10.0)
+    ct = osipi.tofts(t, ca, 0.6, 0.2, Ta=0, discretization_method="linear")
+    np.testing.assert_allclose(ct, osipi.tofts_analytic(t, 0.6, 0.2, Ta=0, BAT=10.0), atol=1e-3)
+    ct = osipi.tofts(t, ca, 0.6, 0.2, Ta=0)
+    ct_uniform = osipi.tofts(t[1:] - 1e-6 * (t[1:] < 1), ca[1:], 0.6, 0.2, Ta=0)
+    np.testing.assert_allclose(ct[1:], ct_uniform, rtol=0, atol=1e-12)
+
+    # 3. Jittering a uniform grid changes the 'conv' curves and their derivatives
+    # continuously, as the same sum is used on both grids
+    t = np.arange(0, 6 * 60, 1.0)
+    ca = osipi.aif_parker(t)
+    ct, jac = osipi.extended_tofts(t, ca, Ktrans, ve, 0.1, Ta=0, jacobian=True)
+    rng = np.random.default_rng(0)
+    t_jitter = t + rng.uniform(-1e-3, 1e-3, size=len(t))
+    ct_jitter, jac_jitter = osipi.extended_tofts(t_jitter, ca, Ktrans, ve, 0.1, Ta=0, jacobian=True)
+    assert not osipi.TimeGrid(t_jitter).uniform
+    np.testing.assert_allclose(ct_jitter, ct, rtol=0, atol=2e-4)
+    np.testing.assert_allclose(jac_jitter[..., :3], jac[..., :3], rtol=0, atol=1e-3)
+    ct_jitter = osipi.extended_tofts(t + 1e-9 * t, ca, Ktrans, ve, 0.1, Ta=0)
+    np.testing.assert_allclose(ct_jitter, ct, rtol=0, atol=1e-8)
+
+    # 3. Uniform grids that do not start at zero give the same curves as those that do,
+    # and agree with the exponential convolution
+    t = np.arange(0, 6 * 60, 1.0)
+    ca = osipi.aif_parker(t)
+    ct = osipi.extended_tofts(t, ca, Ktrans, ve, 0.1, Ta=0)
+    ct_offset = osipi.extended_tofts(t + 10, ca, Ktrans, ve, 0.1, Ta=0)
+    np.testing.assert_allclose(ct_offset, ct, rtol=0, atol=1e-12)
+    ct_exp = osipi.extended_tofts(t + 10, ca, Ktrans, ve, 0.1, Ta=0, discretization_method="exp")
+    np.testing.assert_allclose(ct_offset, ct_exp, rtol=0, atol=5e-2)
+    _, jac = osipi.tofts(t, ca, 0.3, 0.2, Ta=0, jacobian=True)
+    _, jac_offset = osipi.tofts(t + 10, ca, 0.3, 0.2, Ta=0, jacobian=True)
+    np.testing.assert_allclose(jac_offset, jac, rtol=0, atol=1e-12)
+
+
+def test_tissue_adaptive():
+    # 1. The adaptive discretization stays within ve * tol of the exact convolution of
+    # the interpolated AIF, using a fraction of the time points
+    t = np.arange(0, 6 * 60, 0.05)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.6, 0.05, 0.3])
+    ve = np.array([0.2, 0.4, 0.1])
+    ct_exact = osipi.tofts(t, ca, Ktrans, ve, discretization_method="adaptive", tol=0)
+    for tol in [1e-2, 1e-4]:
+        model = osipi.ToftsModel(t, ca, discretization_method="adaptive", tol=tol)
+        ct = model.evaluate(np.stack([Ktrans, ve], axis=-1))
+        assert 0 < model.discretization_error <= tol
+        assert np.all(np.max(np.abs(ct - ct_exact), axis=-1) <= ve * model.discretization_error)
+        assert len(model._aif().nodes) < len(t) / 10
+    ct_analytic = osipi.tofts_analytic(t, Ktrans, ve)
+    np.testing.assert_allclose(ct_exact, ct_analytic, rtol=0, atol=1e-4)
+
+    # 2. Derivatives agree with central finite differences
+    p = np.array([0.3, 0.25, 0.05])
+    ct, jac = osipi.extended_tofts(t, ca, *p, discretization_method="adaptive", jacobian=True)
+    for k in range(3):
+        dp = np.zeros(3)
+        dp[k] = 1e-6 * p[k]
+        ct_plus = osipi.extended_tofts(t, ca, *(p + dp), discretization_method="adaptive")
+        ct_min = osipi.extended_tofts(t, ca, *(p - dp), discretization_method="adaptive")
+        fd = (ct_plus - ct_min) / (2 * dp[k])
+        assert np.max(np.abs(jac[:, k] - fd)) <= 1e-6 * np.max(np.abs(fd))
+
+    # 3. Calls with the same time points, AIF and tolerance reuse the selected nodes
+    osipi._tissue._node_cache.clear()
+    for Ktrans in [0.3, 0.2]:
+        ct = osipi.tofts(t, ca, Ktrans, 0.2, discretization_method="adaptive")
+    assert len(osipi._tissue._node_cache) == 1
+    ct_batch = osipi.tofts(t, ca, [0.3, 0.2], 0.2, discretization_method="adaptive")
+    np.testing.assert_allclose(ct, ct_batch[1], rtol=1e-12, atol=0)
+    osipi.tofts(t, ca, 0.3, 0.2, discretization_method="adaptive", tol=1e-2)
+    assert len(osipi._tissue._node_cache) == 2
+
+
+def test_tissue_convolution_methods():
+    # 1. Direct and FFT convolution give the same result
+    t = np.arange(0, 6 * 60, 0.5)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.array([0.6, 0.2, 0.05])
+    ct_direct = osipi.extended_tofts(t, ca, Ktrans, 0.2, 0.1, convolution_method="direct")
+    ct_fft = osipi.extended_tofts(t, ca, Ktrans, 0.2, 0.1, convolution_method="fft")
+    np.testing.assert_allclose(ct_direct, ct_fft, rtol=0, atol=1e-10)
+
+    # 2. FFT convolution is exactly zero before the delayed bolus arrives
+    ct = osipi.tofts(t, ca, Ktrans, 0.2, Ta=60.0, convolution_method="fft")
+    assert np.count_nonzero(ct[:, t <= 60.0]) == 0
+
+    # 3. The same for one delayed AIF per voxel, and for short time series, where
+    # 'auto' uses direct convolution for large batches only
+    Ta = np.array([20.0, 30.0, 40.0])
+    ct_direct = osipi.tofts(t, ca, Ktrans, 0.2, Ta=Ta, convolution_method="direct")
+    ct_fft = osipi.tofts(t, ca, Ktrans, 0.2, Ta=Ta, convolution_method="fft")
+    np.testing.assert_allclose(ct_direct, ct_fft, rtol=0, atol=1e-10)
+    # Single voxels of clinical length use direct convolution, which keeps one-off
+    # calls with raw time arrays at least as fast as np.convolve was before the
+    # FFT backend (about 110 vs 120-150 us per call for 150 points)
+    assert osipi._convolution.conv_method(150) == "direct"
+    assert osipi._convolution.conv_method(150, batch=100) == "fft"
+    assert osipi._convolution.conv_method(150, batch=100000) == "direct"
+    assert osipi._convolution.conv_method(32) == "direct"
+    assert osipi._convolution.conv_method(600) == "fft"
+    t = np.arange(0, 5 * 60, 2.0)
+    ca = osipi.aif_parker(t)
+    Ktrans = np.random.default_rng(0).uniform(0.05, 0.6, 3000)
+    ct_auto = osipi.tofts(t, ca, Ktrans, 0.2)
+    ct_fft = osipi.tofts(t, ca, Ktrans, 0.2, convolution_method="fft")
+    np.testing.assert_allclose(ct_auto, ct_fft, rtol=0, atol=1e-10)
+    ct_auto = osipi.tofts(t, ca, Ktrans, 0.2, Ta=np.full(3000, 30.0))
+    np.testing.assert_allclose(ct_auto, ct_fft, rtol=0, atol=1e-10)
+
+    # The transform of the AIF is only computed once a batch uses FFTs
+    model = osipi.ToftsModel(t, ca)
+    model.evaluate(np.stack([Ktrans, np.full(3000, 0.2)], axis=-1))
+    assert model._aif()._ca_fft is None
+    model.evaluate(np.stack([Ktrans[:100], np.full(100, 0.2)], axis=-1))
+    assert model._aif()._ca_fft is not None
+
+    # 4. Unknown methods are rejected
+    try:
+        osipi.tofts(t, ca, 0.6, 0.2, convolution_method="fast")
+    except ValueError:
+        assert True
+    else:
+        assert False
+
+
+def test_tissue_models():
+    # 1. Model objects reproduce the model functions, for one and for many voxels
+    t = np.arange(0, 6 * 60, 1)
+    ca = osipi.aif_parker(t)
+    for method in ["conv", "exp"]:
+        model = osipi.ToftsModel(t, ca, Ta=20.0, discretization_method=method)
+        ct = osipi.tofts(t, ca, 0.6, 0.2, Ta=20.0, discretization_method=method)
+        np.testing.assert_allclose(model([0.6, 0.2]), ct, rtol=0, atol=1e-12)
+
+        model = osipi.ExtendedToftsModel(t, ca, Ta=20.0, discretization_method=method)
+        params = np.array([[0.6, 0.2, 0.1], [0.2, 0.5, 0.05], [0.0, 0.2, 0.3]])
+        ct = osipi.extended_tofts(
+            t, ca, params[:, 0], params[:, 1], params[:, 2], Ta=20.0, discretization_method=method
+        )
+        np.testing.assert_allclose(model.evaluate(params), ct, rtol=0, atol=1e-12)
+
+    # 2. Changing the arterial delay time uses a new delayed AIF
+    model = osipi.ToftsModel(t, ca)
+    ct = model([0.6, 0.2])
+    model.Ta = 60.0
+    np.testing.assert_allclose(
+        model([0.6, 0.2]), osipi.tofts(t, ca, 0.6, 0.2, Ta=60.0), rtol=0, atol=1e-12
+    )
+    model.Ta = 30.0
+    np.testing.assert_array_equal(model([0.6, 0.2]), ct)
+
+    # Changing the discretization after an evaluation does the same
+    for method in ["exp", "adaptive", "conv"]:
+        model.discretization_method = method
+        ct_method = osipi.tofts(t, ca, 0.6, 0.2, discretization_method=method)
+        np.testing.assert_allclose(model([0.6, 0.2]), ct_method, rtol=0, atol=1e-12)
+        _, jac = model.evaluate([0.6, 0.2], jacobian=True)
+    model.convolution_method = "fft"
+    ct_fft = osipi.tofts(t, ca, 0.6, 0.2, convolution_method="fft")
+    np.testing.assert_allclose(model([0.6, 0.2]), ct_fft, rtol=0, atol=1e-12)
+
+    # 3. Wrong numbers of parameters or concentrations are rejected
+    for args in [(model, [0.6, 0.2, 0.1]), (osipi.ToftsModel, t, ca[1:])]:
+        try:
+            args[0](*args[1:])
+        except ValueError:
+            assert True
+        else:
+            assert False
+
+
+def test_tissue_jacobian():
+    # 1. Derivatives agree with central finite differences, also on a coarse grid where
+    # the discretizations differ from the continuous convolution
+    t = np.arange(0, 6 * 60, 2.0)
+    ca = osipi.aif_parker(t, BAT=10.0)
+    p = np.array([0.3, 0.25, 0.05, 20.3])
+    for method in ["conv", "exp"]:
+        ct, jac = osipi.extended_tofts(
+            t, ca, *p[:3], Ta=p[3], discretization_method=method, jacobian=True
+        )
+        assert jac.shape == (len(t), 4)
+        np.testing.assert_array_equal(
+            ct, osipi.extended_tofts(t, ca, *p[:3], Ta=p[3], discretization_method=method)
+        )
+        for k, atol in enumerate([0, 0, 0, 0.02]):
+            h = 1e-5 * p[k]
+            dp = np.zeros(4)
+            dp[k] = h
+            ct_plus = osipi.extended_tofts(
+                t, ca, *(p + dp)[:3], Ta=(p + dp)[3], discretization_method=method
+            )
+            ct_min = osipi.extended_tofts(
+                t, ca, *(p - dp)[:3], Ta=(p - dp)[3], discretization_method=method
+            )
+            fd = (ct_plus - ct_min) / (2 * h)
+            assert np.max(np.abs(jac[:, k] - fd)) <= 1e-8 * np.max(np.abs(fd)) + atol
+
+    # 2. The Tofts model and the model objects return the columns of their parameters
+    ct, jac = osipi.tofts(t, ca, [0.3, 0.0], 0.25, Ta=20.3, jacobian=True)
+    assert jac.shape == (2, len(t), 3)
+    assert np.count_nonzero(jac[1]) == 0
+    _, jac_ext = osipi.extended_tofts(t, ca, [0.3, 0.0], 0.25, 0.0, Ta=20.3, jacobian=True)
+    np.testing.assert_allclose(jac, jac_ext[..., [0, 1, 3]], rtol=0, atol=1e-12)
+
+    model = osipi.ExtendedToftsModel(t, ca, Ta=20.3)
+    _, jac_model = model.evaluate([0.3, 0.25, 0.0], jacobian=True)
+    np.testing.assert_allclose(jac_model, jac_ext[0, :, :3], rtol=0, atol=1e-12)
+    _, jac_model = osipi.ToftsModel(t, ca, Ta=20.3).evaluate([[0.3, 0.25]], jacobian=True)
+    np.testing.assert_allclose(jac_model[0], jac[0, :, :2], rtol=0, atol=1e-12)
+
+
 if __name__ == "__main__":
     test_tissue_tofts()
     test_tissue_extended_tofts()
+    test_tissue_voxel_arrays()
+    test_tissue_delay_arrays()
+    test_tissue_non_uniform()
+    test_tissue_adaptive()
+    test_tissue_convolution_methods()
+    test_tissue_models()
+    test_tissue_jacobian()
 
     print("All tissue concentration model tests passed!!")
@@ -0,0 +1,55 @@
+import numpy as np
+import osipi
+
+
+def test_S_to_R10_VFA():
+    # 1. The linear fit recovers R10 and S0 from noise-free signals, with a B1 map
+    rng = np.random.default_rng(0)
+    shape = (6, 7)
+    a = np.array([2.0, 5.0, 10.0, 15.0])
+    TR = 0.005
+    R10 = rng.uniform(0.5, 1.5, shape)
+    S0 = rng.uniform(800, 1200, shape)
+    B1 = rng.uniform(0.8, 1.2, shape)
+    S = osipi.signal_SPGR(R10[..., np.newaxis], S0[..., np.newaxis], TR, a * B1[..., np.newaxis])
+    R10_fit, S0_fit, valid = osipi.S_to_R10_VFA(S, TR, a, B1=B1)
+    assert R10_fit.shape == shape
+    assert np.all(valid)
+    np.testing.assert_allclose(R10_fit, R10, rtol=1e-8)
+    np.testing.assert_allclose(S0_fit, S0, rtol=1e-8)
+
+    # 2. The nonlinear refinement reduces the residuals of noisy signals
+    S_noisy = S + rng.normal(0, 5, S.shape)
+    R10_lin, S0_lin, _ = osipi.S_to_R10_VFA(S_noisy, TR, a, B1=B1)
+    R10_lm, S0_lm, converged = osipi.S_to_R10_VFA(S_noisy, TR, a, B1=B1, method="lm")
+    assert np.all(converged)
+
+    def residuals(R10, S0):
+        S_fit = osipi.signal_SPGR(
+            R10[..., np.newaxis], S0[..., np.newaxis], TR, a * B1[..., np.newaxis]
+        )
+        return np.sum((S_fit - S_noisy) ** 2, axis=-1)
+
+    assert np.all(residuals(R10_lm, S0_lm) <= residuals(R10_lin, S0_lin) * (1 + 1e-12))
+
+    # Signals with missing values are not converged
+    S_noisy[0, 0, 1] = np.nan
+    _, _, converged = osipi.S_to_R10_VFA(S_noisy, TR, a, B1=B1, method="lm")
+    assert not converged[0, 0]
+    assert np.all(converged.ravel()[1:])
+
+    # 3. Voxels outside a mask, or without signal, are not fitted
+    mask = np.ones(shape, dtype=bool)
+    mask[0] = False
+    S[1] = 0
+    R10_fit, S0_fit, valid = osipi.S_to_R10_VFA(S, TR, a, B1=B1, mask=mask)
+    assert not np.any(valid[:2])
+    assert np.all(valid[2:])
+    assert np.all(R10_fit[:2] == 0)
+    np.testing.assert_allclose(R10_fit[2:], R10[2:], rtol=1e-8)
+
+
+if __name__ == "__main__":
+    test_S_to_R10_VFA()
+
+    print("All VFA tests passed!!")